@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+#
+
+##################################################
+# DV8 (c) Marcus Dillavou <line72@line72.net
+#  https://github.com/line72/dv8
+##################################################
+
+# MIT License
+#
+# Copyright (c) 2017 Marcus Dillavou <line72@line72.net>
+# https://github.com/line72/dv8
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import json
+import calendar
+import shutil
+import datetime
+
+import numpy
+import sqlalchemy
+
+from dv8.Database import Point, RollupState, epoch
+from dv8.Rollup import Rollup
+
+def microseconds(d):
+    '''Microseconds since the epoch of a naive datetime, treating
+    it as UTC like sqlite's strftime('%s') does.'''
+    return calendar.timegm(d.timetuple()) * 1000000 + d.microsecond
+
+class Archive:
+    '''A columnar archive of the waypoints of days that are over,
+    so they don't have to live in sqlite forever.
+
+    Each day is a directory (YYYYMMDD) of .npy files, one per
+    column, sorted by route, trip and date. The low cardinality
+    strings (opStatus, direction, driver) are dictionary encoded, with
+    their dictionaries in strings.json, and everything else is stored
+    with the narrowest type that doesn't lose anything. Dates are in
+    microseconds since the epoch, so the archive is lossless.
+
+    The files are plain (uncompressed) .npy so that reading them is
+    just a memory map. Days can optionally be split further into
+    a sub directory per route.'''
+
+    DIRECTORY = 'archive'
+    NULL = -2147483648 # a missing deviation or onBoard
+
+    # name, dtype and the sql to fetch each column
+    COLUMNS = (
+        ('id', 'int64', 'p.id'),
+        ('date', 'int64', 'p.time * 1000000'),
+        ('valid_until', 'int64', 'COALESCE(p.valid_until * 1000000, -1)'),
+        ('route', 'int32', 't.route_id'),
+        ('trip', 'int32', 'p.trip_id'),
+        ('deviation', 'int32', 'COALESCE(p.deviation, %d)' % NULL),
+        ('onBoard', 'int32', 'COALESCE(p.onBoard, %d)' % NULL),
+        ('latitude', 'float64', 'p.latitude / %d.0' % Point.SCALE),
+        ('longitude', 'float64', 'p.longitude / %d.0' % Point.SCALE),
+        ('opStatus', None, 'o.value'),
+        ('direction', None, 'd.value'),
+        ('driver', None, 'r.value'),
+    )
+    STRINGS = ('opStatus', 'direction', 'driver')
+
+    def __init__(self, directory = DIRECTORY):
+        self._directory = directory
+
+    def days(self):
+        '''All the archived days, as datetime.dates'''
+        if not os.path.isdir(self._directory):
+            return []
+
+        return sorted(datetime.datetime.strptime(name, '%Y%m%d').date()
+                      for name in os.listdir(self._directory)
+                      if len(name) == 8 and name.isdigit())
+
+    ## Writing ##
+
+    def archive_before(self, session, before, by_route = False):
+        '''Archive every day before `before` (a datetime.date), one
+        day per transaction. Returns the number of waypoints moved.'''
+        days = session.execute(sqlalchemy.text(
+            "SELECT DISTINCT date(time, 'unixepoch') FROM points WHERE time < :before ORDER BY 1"),
+            {'before': epoch(before)}).fetchall()
+
+        total = 0
+        for (day,) in days:
+            day = datetime.datetime.strptime(day, '%Y-%m-%d').date()
+            count = self.archive(session, day, by_route)
+            print('Archived %d waypoints from %s' % (count, day))
+            total += count
+
+        return total
+
+    def archive(self, session, day, by_route = False):
+        '''Move a day's waypoints out of the database and into the
+        archive. Returns the number of waypoints moved.'''
+        # a run can still be extended for MAX_RUN after the
+        #  day is over, so wait for that
+        start = datetime.datetime.combine(day, datetime.time.min)
+        end = start + datetime.timedelta(days = 1)
+        if end + Point.MAX_RUN > datetime.datetime.now():
+            print('Not archiving %s until its runs are over' % day)
+            return 0
+
+        # the rollups need to have seen these before they go
+        if session.query(RollupState).get(Rollup.NAME) != None:
+            Rollup(session).update()
+
+        sql = 'SELECT %s FROM points p JOIN trips t ON p.trip_id = t.id ' \
+              'LEFT JOIN labels o ON o.id = p.opStatus_id ' \
+              'LEFT JOIN labels d ON d.id = p.direction_id ' \
+              'LEFT JOIN labels r ON r.id = p.driver_id ' \
+              'WHERE p.time >= :start AND p.time < :end ' \
+              'ORDER BY t.route_id, p.trip_id, p.time' % ', '.join(c[2] for c in Archive.COLUMNS)
+        rows = session.execute(sqlalchemy.text(sql),
+                               {'start': epoch(start), 'end': epoch(end)}).fetchall()
+        if len(rows) == 0:
+            return 0
+
+        columns = dict(zip((c[0] for c in Archive.COLUMNS), zip(*rows)))
+        columns = {name: list(values) for name, values in columns.items()}
+
+        # if this day was (partially) archived before, merge
+        #  with what's already there
+        path = os.path.join(self._directory, day.strftime('%Y%m%d'))
+        if os.path.isdir(path):
+            existing = self.read_all(path)
+            for name in columns.keys():
+                columns[name] = list(existing[name]) + columns[name]
+
+            order = sorted(range(len(columns['id'])),
+                           key = lambda i: (columns['route'][i], columns['trip'][i], columns['date'][i]))
+            columns = {name: [values[i] for i in order] for name, values in columns.items()}
+
+        self.write(path, columns, by_route)
+
+        # now that they're safely on disk, remove them
+        ids = [{'id': row[0]} for row in rows]
+        session.execute(sqlalchemy.text('DELETE FROM points WHERE id = :id'), ids)
+        session.commit()
+
+        return len(rows)
+
+    def write(self, path, columns, by_route):
+        '''Write a day's columns (lists of values) into `path`,
+        replacing whatever was there. If an id is in there more than
+        once, only the last copy is kept.'''
+        # a crash between writing a day and deleting its waypoints
+        #  from the database means they get merged in again
+        seen = set()
+        keep = []
+        for i in reversed(range(len(columns['id']))):
+            if columns['id'][i] not in seen:
+                seen.add(columns['id'][i])
+                keep.append(i)
+        if len(keep) < len(columns['id']):
+            keep.reverse()
+            columns = {name: [values[i] for i in keep] for name, values in columns.items()}
+
+        tmp = path + '.tmp'
+        if os.path.isdir(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+
+        arrays = self.encode(columns)
+        if by_route:
+            routes = arrays['route']
+            for route_id in numpy.unique(routes).tolist():
+                lo, hi = numpy.searchsorted(routes, [route_id, route_id + 1])
+                self.write_arrays(os.path.join(tmp, str(route_id)),
+                                  {name: a[lo:hi] for name, a in arrays.items() if name != 'strings'},
+                                  arrays['strings'])
+        else:
+            self.write_arrays(tmp, {name: a for name, a in arrays.items() if name != 'strings'},
+                              arrays['strings'])
+
+        # swap the new version in
+        if os.path.isdir(path):
+            old = path + '.old'
+            os.replace(path, old)
+            os.replace(tmp, path)
+            shutil.rmtree(old)
+        else:
+            os.replace(tmp, path)
+
+    def remove(self, start, end):
+        '''Remove the archived waypoints from `start` up to `end`
+        (naive datetimes), rewriting the days they were in. Returns
+        the days that changed, as datetime.dates.'''
+        changed = []
+        for day in self.days_in(start, end):
+            path = os.path.join(self._directory, day.strftime('%Y%m%d'))
+            by_route = not os.path.exists(os.path.join(path, 'id.npy'))
+            columns = self.read_all(path)
+
+            keep = [i for i, d in enumerate(columns['date'])
+                    if d < microseconds(start) or d >= microseconds(end)]
+            if len(keep) == len(columns['date']):
+                continue
+
+            if len(keep) == 0:
+                shutil.rmtree(path)
+            else:
+                self.write(path, {name: [values[i] for i in keep] for name, values in columns.items()},
+                           by_route)
+            changed.append(day)
+
+        return changed
+
+    def encode(self, columns):
+        arrays = {}
+        strings = {}
+        for name, dtype, sql in Archive.COLUMNS:
+            if name in Archive.STRINGS:
+                # keep real Nones apart from the string 'None'
+                dictionary = sorted(set(columns[name]), key = lambda v: (v == None, str(v)))
+                lookup = {v: i for i, v in enumerate(dictionary)}
+                codes = numpy.array([lookup[v] for v in columns[name]],
+                                    dtype = 'uint8' if len(dictionary) <= 256 else 'uint16')
+                arrays[name] = codes
+                strings[name] = dictionary
+            else:
+                arrays[name] = numpy.array(columns[name], dtype = dtype)
+
+        arrays['strings'] = strings
+        return arrays
+
+    def write_arrays(self, path, arrays, strings):
+        os.makedirs(path, exist_ok = True)
+        for name, a in arrays.items():
+            numpy.save(os.path.join(path, '%s.npy' % name), a)
+        with open(os.path.join(path, 'strings.json'), 'w') as f:
+            json.dump(strings, f)
+
+    ## Reading ##
+
+    def partitions(self, day, route_id = None):
+        '''The directories holding a day's columns, optionally only
+        those that might hold `route_id`.'''
+        path = os.path.join(self._directory, day.strftime('%Y%m%d'))
+        if not os.path.isdir(path):
+            return []
+        if os.path.exists(os.path.join(path, 'id.npy')):
+            return [path]
+
+        routes = sorted(int(name) for name in os.listdir(path) if name.isdigit())
+        if route_id != None:
+            routes = [r for r in routes if r == route_id]
+
+        return [os.path.join(path, str(r)) for r in routes]
+
+    def columns(self, path, names):
+        '''Memory map the named columns of a partition.'''
+        return {name: numpy.load(os.path.join(path, '%s.npy' % name), mmap_mode = 'r')
+                for name in names}
+
+    def read_all(self, path):
+        '''Read back every column of a day (decoding the strings),
+        for merging.'''
+        names = [c[0] for c in Archive.COLUMNS]
+        columns = {name: [] for name in names}
+        for partition in self.partitions_of(path):
+            arrays = self.columns(partition, names)
+            with open(os.path.join(partition, 'strings.json')) as f:
+                strings = json.load(f)
+            for name in names:
+                if name in Archive.STRINGS:
+                    columns[name].extend(strings[name][i] for i in arrays[name].tolist())
+                else:
+                    columns[name].extend(arrays[name].tolist())
+
+        return columns
+
+    def partitions_of(self, path):
+        return self.partitions(datetime.datetime.strptime(os.path.basename(path), '%Y%m%d').date())
+
+    def days_in(self, start, end):
+        '''The archived days with any time from `start` up to `end`.'''
+        return [day for day in self.days()
+                if datetime.datetime.combine(day, datetime.time.min) < end and
+                datetime.datetime.combine(day, datetime.time.min) + datetime.timedelta(days = 1) > start]
+
+    def groups(self, start, end):
+        '''Aggregate the archived waypoints from `start` up to `end`
+        the same way dv8.Rollup does, into (route_id, hour, direction,
+        deviation, count, onBoard_sum, onBoard_max) groups.'''
+        groups = {}
+        for day in self.days_in(start, end):
+            for partition in self.partitions(day):
+                arrays = self.columns(partition, ('date', 'route', 'direction', 'deviation', 'onBoard'))
+                with open(os.path.join(partition, 'strings.json')) as f:
+                    directions = json.load(f)['direction']
+
+                mask = (arrays['date'] >= microseconds(start)) & (arrays['date'] < microseconds(end))
+                hours = (numpy.asarray(arrays['date'][mask]) // 3600000000).tolist()
+                for hour, route_id, direction, deviation, onBoard in zip(hours,
+                                                                         arrays['route'][mask].tolist(),
+                                                                         arrays['direction'][mask].tolist(),
+                                                                         arrays['deviation'][mask].tolist(),
+                                                                         arrays['onBoard'][mask].tolist()):
+                    if deviation == Archive.NULL:
+                        continue
+                    key = (route_id, hour, directions[direction], deviation)
+                    group = groups.setdefault(key, [0, None, None])
+                    group[0] += 1
+                    if onBoard != Archive.NULL:
+                        group[1] = onBoard if group[1] == None else group[1] + onBoard
+                        group[2] = onBoard if group[2] == None else max(group[2], onBoard)
+
+        return [(route_id, datetime.datetime.utcfromtimestamp(hour * 3600).strftime('%Y-%m-%d %H:00:00'),
+                 direction, deviation, count, onBoard_sum, onBoard_max)
+                for (route_id, hour, direction, deviation), (count, onBoard_sum, onBoard_max) in groups.items()]
+
+    def load(self, start_date, end_date, route_id = None):
+        '''Load the archived waypoints with a date between two
+        datetimes (inclusive, either may be None), optionally only for
+        one route. Returns a dict of arrays with the dates (and
+        valid_untils) in seconds since the epoch, and missing values as
+        NaNs, or None if nothing was found.'''
+        names = ('date', 'valid_until', 'route', 'trip', 'deviation', 'onBoard', 'latitude', 'longitude')
+
+        parts = []
+        for day in self.days():
+            day_start = datetime.datetime.combine(day, datetime.time.min)
+            if (start_date != None and day_start + datetime.timedelta(days = 1) <= start_date) or \
+               (end_date != None and day_start > end_date):
+                continue
+
+            for partition in self.partitions(day, route_id):
+                arrays = self.columns(partition, names)
+
+                mask = numpy.ones(len(arrays['date']), dtype = bool)
+                if start_date != None:
+                    mask &= arrays['date'] >= microseconds(start_date)
+                if end_date != None:
+                    mask &= arrays['date'] <= microseconds(end_date)
+                if route_id != None:
+                    mask &= arrays['route'] == route_id
+
+                parts.append({name: numpy.asarray(a[mask]) for name, a in arrays.items()})
+
+        if len(parts) == 0:
+            return None
+
+        arrays = {name: numpy.concatenate([p[name] for p in parts]) for name in names}
+        arrays['date'] = arrays['date'] // 1000000
+        runs = arrays['valid_until'] >= 0
+        arrays['valid_until'][runs] //= 1000000
+
+        return Archive.nulls(arrays)
+
+    @staticmethod
+    def nulls(arrays):
+        '''Turn the missing deviations and onBoards in a dict of
+        arrays back into NaNs (which makes them floats).'''
+        for name in ('deviation', 'onBoard'):
+            if name in arrays:
+                values = arrays[name].astype('float64')
+                values[arrays[name] == Archive.NULL] = numpy.nan
+                arrays[name] = values
+
+        return arrays
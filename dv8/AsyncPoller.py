@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+#
+
+##################################################
+# DV8 (c) Marcus Dillavou <line72@line72.net
+#  https://github.com/line72/dv8
+##################################################
+
+# MIT License
+#
+# Copyright (c) 2017 Marcus Dillavou <line72@line72.net>
+# https://github.com/line72/dv8
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import sys
+import time
+import asyncio
+import datetime
+import concurrent.futures
+
+from dv8.Poller import Poller
+from dv8.Feed import Feed
+from dv8.Transport import Transport
+from dv8.Cadence import Cadence
+
+class AsyncPoller(Poller):
+    '''Polls several feeds at the same time.
+
+    Each feed is polled on its own fixed rate schedule, so the time
+    spent fetching and recording a response is subtracted from the
+    sleep instead of being added to it, and a slow feed can't hold up
+    any of the others. Requests share one pooled HTTP session, and all
+    of the database work happens on a single writer thread.
+
+    In adaptive mode, each feed is polled just after its own expected
+    updates instead.'''
+
+    def __init__(self, feeds = None, interval = Poller.SLEEP, write_behind = False, dedup = False, rollup = False,
+                 url = Poller.URL, database = 'poller.db', metrics_port = None, stats_log = None,
+                 adaptive = False, snapshot_log = None):
+        super().__init__(write_behind, dedup, rollup, url, database, metrics_port, stats_log, adaptive,
+                         snapshot_log = snapshot_log)
+
+        if feeds == None or len(feeds) == 0:
+            feeds = [Feed('default', self._url)]
+
+        self._feeds = feeds
+        self._interval = interval
+
+        # each feed has its own timeout
+        self._transport = Transport(pool_size = len(feeds))
+
+        self._fetchers = concurrent.futures.ThreadPoolExecutor(max_workers = len(feeds))
+        self._writer = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+
+    def go(self):
+        asyncio.run(self.run())
+
+    async def run(self):
+        await asyncio.gather(*[self.poll_forever(feed) for feed in self._feeds])
+
+    async def poll_forever(self, feed):
+        loop = asyncio.get_running_loop()
+        next_poll = loop.time()
+        cadence = Cadence() if self._adaptive else None
+
+        while True:
+            await self.poll(feed, cadence)
+
+            delay = self.delay(feed.url, cadence, self._interval)
+            if delay != None:
+                # backing off, or following the feed's own cadence
+                next_poll = loop.time() + delay
+                await asyncio.sleep(delay)
+                continue
+
+            # schedule from when this poll was supposed to start, not
+            #  from when it finished. If we overran, skip the polls we
+            #  missed rather than firing them all at once.
+            next_poll += self._interval
+            now = loop.time()
+            if next_poll < now:
+                missed = int((now - next_poll) // self._interval) + 1
+                print('%s: running behind, skipping %d poll(s)' % (feed.name, missed), file = sys.stderr)
+                next_poll += missed * self._interval
+
+            await asyncio.sleep(next_poll - now)
+
+    async def poll(self, feed, cadence = None):
+        '''Fetch and record a single response from a feed.'''
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            print('Requesting %s...' % feed.name)
+            data, now = await asyncio.wait_for(loop.run_in_executor(self._fetchers, self.fetch, feed),
+                                               feed.timeout)
+        except asyncio.TimeoutError:
+            print('Error: %s timed out after %ss' % (feed.name, feed.timeout), file = sys.stderr)
+            self.metrics.count('errors', stage = 'fetch', type = 'TimeoutError', feed = feed.name)
+        except Exception as e:
+            print('Error: %s: %s' % (feed.name, e), file = sys.stderr)
+            self.metrics.count('errors', stage = 'fetch', type = type(e).__name__, feed = feed.name)
+        else:
+            if cadence != None:
+                cadence.observe(data)
+
+            if data == None:
+                print('%s: unchanged' % feed.name)
+                self.metrics.count('unchanged', feed = feed.name)
+            else:
+                try:
+                    await loop.run_in_executor(self._writer, self.submit, feed.rewrite(data), now)
+                except Exception as e:
+                    # ingest_batch has already counted this
+                    print('Error: %s: %s' % (feed.name, e), file = sys.stderr)
+
+        self.metrics.observe('cycle', time.perf_counter() - start)
+        self.metrics.tick()
+
+    def fetch(self, feed):
+        '''The decoded response from a feed and when we got it. The
+        response is None if it hasn't changed.'''
+        with self.metrics.time('fetch'):
+            r = self._transport.fetch(feed.url, feed.timeout)
+        now = datetime.datetime.now()
+
+        if r == None:
+            return None, now
+
+        self.log(feed.name, r.content, now)
+        with self.metrics.time('decode'):
+            return r.json(), now
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+#
+
+##################################################
+# DV8 (c) Marcus Dillavou <line72@line72.net
+#  https://github.com/line72/dv8
+##################################################
+
+# MIT License
+#
+# Copyright (c) 2017 Marcus Dillavou <line72@line72.net>
+# https://github.com/line72/dv8
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import datetime
+import tempfile
+import contextlib
+import subprocess
+
+import numpy
+import requests
+import sqlalchemy
+
+from dv8.Database import Point, create_engine, epoch
+from dv8.DataLoader import DataLoader
+from dv8.Fleet import Fleet
+from dv8.FeedServer import FeedServer
+from dv8.Migrator import Migrator
+from dv8.Poller import Poller
+from dv8.DeviationPlotter import DeviationPlotter
+
+class Benchmark:
+    '''Times the poller, the graphs and the hot queries against the
+    `poller.db` in the current directory (usually one made by
+    populate_db), so that versions can be compared.
+
+    Each benchmark returns a dict of metrics. Timings are in seconds,
+    except per query/cycle latencies, which are in milliseconds.'''
+
+    NAMES = ('poller', 'graphs', 'queries', 'layout')
+    GRAPHS = ('deviation', 'onboard', 'headway', 'heatmap')
+    RESULTS = 'benchmarks'
+    # a metric is flagged when it gets this much worse
+    THRESHOLD = 0.1
+
+    def __init__(self, start_date = None, end_date = None, cycles = 20, repeat = 3):
+        engine = create_engine()
+        self._session = sqlalchemy.orm.sessionmaker(bind = engine)()
+        self._cycles = cycles
+        self._repeat = repeat
+
+        # by default, graph and query the last whole day
+        if start_date == None:
+            first, last = self._session.execute(sqlalchemy.text('SELECT MIN(day), MAX(day) FROM day_marks')).fetchone()
+            if last == None:
+                raise Exception('There are no waypoints to benchmark with. Please run populate_db first.')
+            start_date = max(datetime.datetime.strptime(first, '%Y-%m-%d'),
+                             datetime.datetime.strptime(last, '%Y-%m-%d') - datetime.timedelta(days = 1))
+        if end_date == None:
+            end_date = start_date + datetime.timedelta(days = 1)
+        self._start_date = start_date
+        self._end_date = end_date
+
+    def run(self, names = NAMES):
+        '''Run some benchmarks, returning the results along with what
+        they were run against.'''
+        results = {}
+        for name in names:
+            print('Running %s...' % name)
+            for key, metrics in getattr(self, name)().items():
+                results[key] = metrics
+                print('  %s: %s' % (key, ', '.join('%s=%.4g' % m for m in sorted(metrics.items()))))
+
+        return {'version': self.version(),
+                'date': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                'dataset': {'name': os.path.basename(os.getcwd()),
+                            'waypoints': self._session.execute(sqlalchemy.text('SELECT MAX(id) FROM points')).scalar(),
+                            'start_date': self._start_date.strftime('%Y%m%d'),
+                            'end_date': self._end_date.strftime('%Y%m%d')},
+                'results': results}
+
+    ## Benchmarks ##
+
+    def poller(self):
+        '''Poll a local fake feed into a scratch database (so the
+        dataset stays the same between runs), timing each cycle.
+        Also time the bulk path, which records many snapshots in
+        one transaction.'''
+        fleet = Fleet()
+        server = FeedServer(fleet, port = 0)
+        server.start()
+
+        cycles = []
+        ingests = []
+        rows = 0
+        with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(io.StringIO()):
+            poller = Poller(url = server.url(), database = os.path.join(directory, 'poller.db'))
+            http = requests.Session()
+            for i in range(self._cycles):
+                start = time.perf_counter()
+                data = http.get(server.url()).json()
+                fetched = time.perf_counter()
+                rows += poller.ingest(data, datetime.datetime.now())
+                end = time.perf_counter()
+
+                cycles.append(end - start)
+                ingests.append(end - fetched)
+
+            generator = fleet.snapshots(datetime.datetime(2017, 1, 1))
+            snapshots = [next(generator) for i in range(100)]
+            start = time.perf_counter()
+            bulk = poller.ingest_batch(snapshots)
+            bulk_time = time.perf_counter() - start
+
+        server.stop()
+
+        cycles = numpy.array(cycles) * 1000
+        return {'poller': {'cycle_p50_ms': float(numpy.percentile(cycles, 50)),
+                           'cycle_p95_ms': float(numpy.percentile(cycles, 95)),
+                           'cycle_max_ms': float(cycles.max()),
+                           'rows_per_sec': rows / sum(ingests),
+                           'bulk_rows_per_sec': bulk / bulk_time}}
+
+    def graphs(self):
+        '''Run create_graph for each graph type (without the cache),
+        measuring its wall time and peak memory.'''
+        script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'create_graph')
+
+        results = {}
+        for graph_type in Benchmark.GRAPHS:
+            start = time.perf_counter()
+            process = subprocess.Popen([sys.executable, script, graph_type, '-t', 'benchmark', '--no-cache',
+                                        '-s', self._start_date.strftime('%Y%m%d'),
+                                        '-e', self._end_date.strftime('%Y%m%d')],
+                                       stdout = subprocess.DEVNULL)
+            pid, status, usage = os.wait4(process.pid, 0)
+            elapsed = time.perf_counter() - start
+            if status != 0:
+                raise Exception('create_graph %s failed' % graph_type)
+
+            # ru_maxrss is in KiB on Linux
+            results['graph_%s' % graph_type] = {'wall_s': elapsed,
+                                                'max_rss_mb': usage.ru_maxrss / 1024.0}
+
+        return results
+
+    def queries(self):
+        '''Time loading the graphs' data, and the poller's hot
+        lookups (see dv8.Migrator).'''
+        results = {}
+
+        for name, route_id in (('all routes', None), ('one route', self.sample('t.route_id'))):
+            loader = DataLoader(self._session, self._start_date, self._end_date)
+            elapsed = self.best(lambda: loader.load(route_id))
+            results['load_%s' % name.replace(' ', '_')] = {'seconds': elapsed}
+
+        params = {'rId': self.sample('r.rId'),
+                  'tId': self.sample('t.tId'),
+                  'runId': self.sample('t.runId'),
+                  'route_id': self.sample('t.route_id'),
+                  'trip_id': self.sample('t.id'),
+                  'start': epoch(self._start_date),
+                  'end': epoch(self._end_date)}
+
+        # the graphs' query of the points in an area, for a box
+        #  about a km across around the most recent waypoint
+        latitude, longitude = self._session.execute(sqlalchemy.text(
+            'SELECT latitude, longitude FROM points ORDER BY id DESC LIMIT 1')).first()
+        latitude /= Point.SCALE
+        longitude /= Point.SCALE
+        area = Migrator.area_query(self._session.connection(),
+                                   (latitude - 0.005, longitude - 0.005, latitude + 0.005, longitude + 0.005),
+                                   self._start_date, self._end_date)
+
+        for name, sql, example, index in Migrator.QUERIES + [area]:
+            query = sqlalchemy.text(sql)
+            # (the area query comes with its own cell ranges)
+            args = {key: params.get(key, value) for key, value in example.items()}
+            # the area query reads thousands of rows, not a handful
+            count = 10 if sql == area[1] else 1000
+            elapsed = self.best(lambda: [self._session.execute(query, args).fetchall() for i in range(count)])
+            results['query_%s' % name.replace(' ', '_')] = {'ms': elapsed * 1000 / count}
+
+        return results
+
+    def layout(self):
+        '''Time laying out the bars of 100000 trips.'''
+        plotter = DeviationPlotter('benchmark', cache = None)
+
+        rnd = random.Random(0)
+        count = 100000
+        starts = numpy.sort(numpy.array([rnd.randint(0, 86400 * 30) for i in range(count)]))
+        ends = starts + numpy.array([rnd.randint(600, 7200) for i in range(count)])
+
+        elapsed = self.best(lambda: plotter.assign_lanes(starts, ends))
+        return {'layout': {'seconds': elapsed}}
+
+    ## Results ##
+
+    def save(self, results, directory = RESULTS):
+        '''Save results as json, named by date and version.'''
+        os.makedirs(directory, exist_ok = True)
+        path = os.path.join(directory, '%s-%s.json' % (datetime.datetime.now().strftime('%Y%m%d-%H%M%S'),
+                                                       results['version']))
+        with open(path, 'w') as f:
+            json.dump(results, f, indent = 2, sort_keys = True)
+
+        return path
+
+    @staticmethod
+    def previous(results, directory = RESULTS):
+        '''The most recent saved results for the same dataset, or None.'''
+        if not os.path.isdir(directory):
+            return None
+
+        for name in sorted(os.listdir(directory), reverse = True):
+            if not name.endswith('.json'):
+                continue
+            with open(os.path.join(directory, name)) as f:
+                saved = json.load(f)
+            if saved['dataset'] == results['dataset']:
+                return saved
+
+        return None
+
+    @staticmethod
+    def compare(previous, results):
+        '''Return a line per metric comparing two sets of results,
+        flagging anything that got more than THRESHOLD worse.'''
+        lines = ['%-28s %-18s %12s %12s %8s' % ('benchmark', 'metric', previous['version'], results['version'], 'change')]
+        for key, metrics in sorted(results['results'].items()):
+            for metric, value in sorted(metrics.items()):
+                old = previous['results'].get(key, {}).get(metric)
+                if old == None or old == 0:
+                    continue
+
+                change = (value - old) / old
+                # for throughputs, bigger is better
+                worse = -change if metric.endswith('per_sec') else change
+                flag = ' !' if worse > Benchmark.THRESHOLD else ''
+                lines.append('%-28s %-18s %12.4g %12.4g %+7.1f%%%s' % (key, metric, old, value, change * 100, flag))
+
+        return lines
+
+    ## Helpers ##
+
+    def best(self, f):
+        '''The best time, in seconds, of a few runs of f.'''
+        times = []
+        for i in range(self._repeat):
+            start = time.perf_counter()
+            f()
+            times.append(time.perf_counter() - start)
+
+        return min(times)
+
+    def sample(self, column):
+        '''A value of a trips (t) or routes (r) column, for the
+        trip of the most recent waypoint.'''
+        return self._session.execute(sqlalchemy.text(
+            'SELECT %s FROM trips t JOIN routes r ON t.route_id = r.id '
+            'WHERE t.id = (SELECT trip_id FROM points ORDER BY id DESC LIMIT 1)' % column)).scalar()
+
+    def version(self):
+        '''The git revision we're running, if we can tell.'''
+        try:
+            return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                           cwd = os.path.dirname(os.path.abspath(__file__)),
+                                           stderr = subprocess.DEVNULL).decode('utf-8').strip()
+        except (OSError, subprocess.CalledProcessError):
+            return 'unknown'
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+#
+
+##################################################
+# DV8 (c) Marcus Dillavou <line72@line72.net
+#  https://github.com/line72/dv8
+##################################################
+
+# MIT License
+#
+# Copyright (c) 2017 Marcus Dillavou <line72@line72.net>
+# https://github.com/line72/dv8
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import re
+import time
+import collections
+import statistics
+
+class Cadence:
+    '''Learns how often a feed really updates, from the LastUpdated
+    times of its vehicles, so we can poll just after each update
+    instead of on a fixed interval.
+
+    The newest LastUpdated in a response moves forward every time the
+    feed updates, and the gaps between those moves give the feed's
+    period. What we don't know is when, on our own clock, an update
+    becomes visible (this includes any time zone or clock skew, and
+    the feed's own delay). The earliest we've seen an update, relative
+    to its LastUpdated, is an upper bound on that, and the latest we've
+    polled without seeing one is a lower bound. Until they're within
+    MARGIN of each other, each poll probes halfway between them, and
+    if it's too early, it's retried at the upper bound.'''
+
+    SAMPLES = 20 # updates to learn from
+    MIN_SAMPLES = 3
+    MARGIN = 1.0 # in seconds
+    MIN_PERIOD = 5 # in seconds
+    MAX_PERIOD = 300 # in seconds
+
+    DATE = re.compile(r'/Date\((-?\d+)')
+
+    def __init__(self):
+        self._last = None
+        self._periods = collections.deque(maxlen = Cadence.SAMPLES)
+        # when (our time - LastUpdated) we saw each update (upper bounds),
+        #  and when we probed for one too early (lower bounds)
+        self._seen = collections.deque(maxlen = Cadence.SAMPLES)
+        self._early = collections.deque(maxlen = Cadence.SAMPLES)
+        # whether the next poll is a probe, or a retry of one
+        self._probing = False
+        self._retry = False
+
+    @staticmethod
+    def newest(data):
+        '''The newest LastUpdated of any vehicle in a GetAllRoutes
+        response, in seconds, or None if there aren't any.'''
+        newest = None
+        for route_info in data:
+            for vehicle in route_info.get('Vehicles') or []:
+                m = Cadence.DATE.match(vehicle.get('LastUpdated') or '')
+                if m != None:
+                    updated = int(m.group(1)) / 1000.0
+                    if newest == None or updated > newest:
+                        newest = updated
+
+        return newest
+
+    def observe(self, data, seen = None):
+        '''Learn from a response that we received at `seen` (an
+        epoch time, defaulting to now). `data` is None when the
+        response hadn't changed.'''
+        if seen == None:
+            seen = time.time()
+
+        probing = self._probing
+        self._probing = False
+
+        newest = Cadence.newest(data) if data != None else None
+        if newest == None or (self._last != None and newest <= self._last):
+            # nothing new. If this was a probe, the next update isn't
+            #  visible this soon after its LastUpdated
+            if probing:
+                self._early.append(seen - (self._last + self.period()))
+                self._retry = True
+            return
+
+        if self._last != None:
+            self._periods.append(newest - self._last)
+        self._seen.append(seen - newest)
+        self._last = newest
+
+    def period(self):
+        '''The feed's update period in seconds, or None if we haven't
+        seen enough updates yet.'''
+        if len(self._periods) < Cadence.MIN_SAMPLES:
+            return None
+
+        period = statistics.median(self._periods)
+        return min(Cadence.MAX_PERIOD, max(Cadence.MIN_PERIOD, period))
+
+    def delay(self, now = None):
+        '''How long to wait until the next poll, or None if we don't
+        know the feed's cadence yet.'''
+        period = self.period()
+        if period == None:
+            return None
+
+        if now == None:
+            now = time.time()
+
+        upper = min(self._seen)
+        lower = upper - period
+        if len(self._early) > 0:
+            lower = max(self._early)
+            if lower >= upper:
+                # the clocks have drifted, start over
+                self._early.clear()
+                lower = upper - period
+
+        if self._retry or upper - lower <= Cadence.MARGIN:
+            offset = upper
+        else:
+            offset = (lower + upper) / 2
+            self._probing = True
+        self._retry = False
+
+        expected = self._last + period + offset
+        if expected <= now:
+            # we missed one (or more), wait for the next
+            expected += ((now - expected) // period + 1) * period
+
+        return expected - now
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+#
+
+##################################################
+# DV8 (c) Marcus Dillavou <line72@line72.net
+#  https://github.com/line72/dv8
+##################################################
+
+# MIT License
+#
+# Copyright (c) 2017 Marcus Dillavou <line72@line72.net>
+# https://github.com/line72/dv8
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import datetime
+
+import numpy
+import sqlalchemy
+
+from dv8.Database import Trip, Point, epoch
+from dv8.Archive import Archive
+from dv8.Grid import Grid
+
+class Columns:
+    '''A set of waypoints, stored column by column in NumPy
+    arrays instead of as individual objects.
+
+    `date` is in seconds since the epoch (of the local time the
+    poller recorded), `route` and `trip` are the database ids. A
+    missing deviation or onBoard is NaN.
+
+    Only some of the fields may be present, as long as `date`
+    is one of them. With no arrays at all, every field is present
+    (and empty).'''
+
+    FIELDS = ('date', 'route', 'trip', 'deviation', 'onBoard', 'latitude', 'longitude')
+    DTYPES = ('int64', 'int64', 'int64', 'float64', 'float64', 'float64', 'float64')
+
+    def __init__(self, **arrays):
+        self.fields = tuple(f for f in Columns.FIELDS if f in arrays or len(arrays) == 0)
+        for field, dtype in zip(Columns.FIELDS, Columns.DTYPES):
+            if field in self.fields:
+                setattr(self, field, numpy.asarray(arrays.get(field, []), dtype = dtype))
+
+    def __len__(self):
+        return len(self.date)
+
+    def __getitem__(self, index):
+        '''Select a subset of the rows, using anything that
+        NumPy accepts as an index.'''
+        return Columns(**{field: getattr(self, field)[index] for field in self.fields})
+
+    @staticmethod
+    def concatenate(parts, fields):
+        '''Join several sets of waypoints (with at least `fields`)
+        into one, keeping only `fields`.'''
+        return Columns(**{field: numpy.concatenate([getattr(p, field) for p in parts])
+                          for field in fields})
+
+    def dates(self):
+        '''The dates as datetime64s, which matplotlib can plot.'''
+        return self.date.astype('datetime64[s]')
+
+    def groups(self, field):
+        '''Split the rows into contiguous runs with the same value of
+        `field`. Returns the values and the start/end of each run.'''
+        values = getattr(self, field)
+        if len(values) == 0:
+            return values, values, values
+
+        starts = numpy.flatnonzero(values[1:] != values[:-1]) + 1
+        starts = numpy.concatenate(([0], starts))
+        ends = numpy.concatenate((starts[1:], [len(values)]))
+
+        return values[starts], starts, ends
+
+class DataLoader:
+    '''Loads every waypoint in a date range with a single joined
+    query, ordered by route, trip and date.
+
+    Deduplicated runs (waypoints with a `valid_until`) are expanded
+    back out into a reading at the start and end of the run, so they
+    plot exactly like the repeated readings would have.
+
+    Any days that have been moved to the archive are read from there
+    and merged in, so callers don't need to care where they live.
+
+    With a `bbox` of (south, west, north, east) in degrees, only the
+    waypoints inside it are loaded, using the grid cell index (see
+    dv8.Grid) to find them.
+
+    For date ranges too long to load at once, extents() and series()
+    summarize the waypoints in sqlite, and stream() reads them back
+    one series at a time (these ignore the bbox).'''
+
+    BATCH = 10000 # rows fetched at a time when streaming
+
+    def __init__(self, session, start_date = None, end_date = None, archive = Archive.DIRECTORY,
+                 bbox = None):
+        self._session = session
+        self._start_date = start_date
+        self._end_date = end_date
+        self._archive = Archive(archive)
+        self._bbox = bbox
+
+    def load(self, route_id = None):
+        '''Load our date range, optionally only for one route.'''
+        waypoints, valid_until = self.columns(self.query(route_id).all())
+
+        start = None if self._start_date == None else self._start_date - Point.MAX_RUN
+        archived = self._archive.load(start, self._end_date, route_id)
+        if archived != None:
+            waypoints = Columns.concatenate([waypoints, Columns(**archived)], Columns.FIELDS)
+            valid_until = numpy.concatenate((valid_until, archived['valid_until']))
+
+            order = numpy.lexsort((waypoints.date, waypoints.trip, waypoints.route))
+            waypoints = waypoints[order]
+            valid_until = valid_until[order]
+
+        if self._bbox != None and archived != None:
+            south, west, north, east = self._bbox
+            inside = ((waypoints.latitude >= south) & (waypoints.latitude <= north) &
+                      (waypoints.longitude >= west) & (waypoints.longitude <= east))
+            waypoints = waypoints[inside]
+            valid_until = valid_until[inside]
+
+        if len(waypoints) == 0:
+            return Columns()
+
+        return self.expand(waypoints, valid_until)
+
+    def query(self, route_id = None):
+        '''The query load() reads our date range from (in sqlite),
+        optionally only for one route.'''
+        trip_id = Point.trip_id
+        if self._bbox != None:
+            # sqlite would rather walk every trip than use the cell
+            #  index, unless the trip index can't be used for the join
+            trip_id = Point.trip_id + sqlalchemy.literal_column('0')
+
+        query = self._session.query(
+            Point.time,
+            Trip.route_id,
+            Point.trip_id,
+            Point.deviation,
+            Point.onBoard,
+            Point.latitude,
+            Point.longitude,
+            sqlalchemy.func.coalesce(Point.valid_until, -1)).join(Trip, trip_id == Trip.id)
+
+        if route_id != None:
+            query = query.filter(Trip.route_id == route_id)
+
+        if self._bbox != None:
+            # the cells cover the box, then the edge cells are trimmed
+            south, west, north, east = self._bbox
+            cells = [Point.cell.between(first, last) for first, last in Grid.ranges(*self._bbox)]
+            query = query.filter(sqlalchemy.or_(*cells),
+                                 Point.latitude.between(Grid.scaled(south), Grid.scaled(north)),
+                                 Point.longitude.between(Grid.scaled(west), Grid.scaled(east)))
+
+        return query.filter(*self.conditions()).order_by(Trip.route_id, Point.trip_id, Point.time)
+
+    def extents(self, fields):
+        '''The first and last date, and the lowest and highest value of
+        each of `fields`, of every route's waypoints, worked out by
+        sqlite (and a pass over the archive) without loading them.
+        Returns a dict of (first, last, lows, highs) by route id, the
+        lows and highs being dicts by field.'''
+        columns = [getattr(Point, field) for field in fields]
+        query = self._session.query(
+            Trip.route_id,
+            sqlalchemy.func.min(Point.time),
+            sqlalchemy.func.max(sqlalchemy.func.coalesce(Point.valid_until, Point.time)),
+            *[sqlalchemy.func.coalesce(sqlalchemy.func.min(c), 0) for c in columns],
+            *[sqlalchemy.func.coalesce(sqlalchemy.func.max(c), 0) for c in columns]).\
+            join(Trip, Point.trip_id == Trip.id).filter(*self.conditions()).group_by(Trip.route_id)
+
+        scale = [Point.SCALE if field in ('latitude', 'longitude') else 1 for field in fields]
+        start, end = self.limits()
+
+        n = len(fields)
+        extents = {}
+        for row in query:
+            extents[row[0]] = (max(row[1], start), min(row[2], end),
+                               {f: v / k for f, v, k in zip(fields, row[3:3 + n], scale)},
+                               {f: v / k for f, v, k in zip(fields, row[3 + n:], scale)})
+
+        for route, trip, day, waypoints in self.archived():
+            first, last, lows, highs = extents.get(route, (numpy.inf, -numpy.inf, {}, {}))
+            extents[route] = (min(first, waypoints.date.min()), max(last, waypoints.date.max()),
+                              {f: numpy.fmin(lows.get(f, numpy.inf), numpy.nanmin(getattr(waypoints, f), initial = numpy.inf))
+                               for f in fields},
+                              {f: numpy.fmax(highs.get(f, -numpy.inf), numpy.nanmax(getattr(waypoints, f), initial = -numpy.inf))
+                               for f in fields})
+
+        return extents
+
+    def series(self, route_id):
+        '''The (trip, day, first date, last date) of each series (the
+        readings of a trip on one day) of a route, in trip and day
+        order, worked out by sqlite without loading them. Days are
+        counted since the epoch.'''
+        day = Point.time / (24 * 60 * 60)
+        query = self._session.query(
+            Point.trip_id,
+            day,
+            sqlalchemy.func.min(Point.time),
+            sqlalchemy.func.max(sqlalchemy.func.coalesce(Point.valid_until, Point.time))).\
+            join(Trip, Point.trip_id == Trip.id).filter(Trip.route_id == route_id, *self.conditions()).\
+            group_by(Trip.id, day)
+
+        start, end = self.limits()
+        series = [(trip, day, max(first, start), min(last, end)) for trip, day, first, last in query]
+        series.extend((trip, day, waypoints.date.min(), waypoints.date.max())
+                      for route, trip, day, waypoints in self.archived(route_id))
+
+        return sorted(series)
+
+    def stream(self, route_id):
+        '''Read a route's waypoints a series (the readings of a trip on
+        one day) at a time, yielding (trip, day, waypoints) for each.
+        These are in trip and date order, except that archived days
+        come last. The waypoints are just like load()'s, but only a
+        single series is ever held in memory.'''
+        # (ordered by the trip's own id, sqlite can walk the
+        #  indexes in order instead of sorting the whole route first)
+        query = self._session.query(
+            Point.time,
+            Trip.route_id,
+            Point.trip_id,
+            Point.deviation,
+            Point.onBoard,
+            Point.latitude,
+            Point.longitude,
+            sqlalchemy.func.coalesce(Point.valid_until, -1)).join(Trip, Point.trip_id == Trip.id).\
+            filter(Trip.route_id == route_id, *self.conditions()).\
+            order_by(Trip.id, Point.time).yield_per(DataLoader.BATCH)
+
+        key = None
+        rows = []
+        for row in query:
+            if (row[2], row[0] // (24 * 60 * 60)) != key:
+                if len(rows) > 0:
+                    yield key + (self.expand(*self.columns(rows)),)
+                key = (row[2], row[0] // (24 * 60 * 60))
+                rows = []
+            rows.append(row)
+        if len(rows) > 0:
+            yield key + (self.expand(*self.columns(rows)),)
+
+        for route, trip, day, waypoints in self.archived(route_id):
+            yield trip, day, waypoints
+
+    def archived(self, route_id = None):
+        '''Walk the archived waypoints in our date range (optionally
+        only for one route) a series at a time, yielding (route, trip,
+        day, waypoints). The archive is memory mapped and sorted by
+        route and trip, so only one series is ever read in.'''
+        start, end = self.limits()
+        names = ('date', 'valid_until', 'route', 'trip', 'deviation', 'onBoard', 'latitude', 'longitude')
+
+        for day in self._archive.days():
+            day_start = epoch(datetime.datetime.combine(day, datetime.time.min))
+            if day_start + 24 * 60 * 60 <= start - Point.MAX_RUN.total_seconds() or day_start > end:
+                continue
+
+            for partition in self._archive.partitions(day, route_id):
+                arrays = self._archive.columns(partition, names)
+                lo, hi = 0, len(arrays['route'])
+                if route_id != None:
+                    lo, hi = numpy.searchsorted(arrays['route'], [route_id, route_id + 1])
+
+                for route, route_start, route_end in self.runs(arrays['route'], lo, hi):
+                    for trip, trip_start, trip_end in self.runs(arrays['trip'], route_start, route_end):
+                        columns = {name: numpy.array(a[trip_start:trip_end]) for name, a in arrays.items()}
+                        columns['date'] //= 1000000
+                        valid_until = columns.pop('valid_until')
+                        valid_until[valid_until >= 0] //= 1000000
+
+                        waypoints = self.expand(Columns(**Archive.nulls(columns)), valid_until)
+                        if len(waypoints) > 0:
+                            yield int(route), int(trip), day_start // (24 * 60 * 60), waypoints
+
+    def columns(self, rows):
+        '''Turn rows of (time, route, trip, deviation, onBoard, latitude,
+        longitude, valid_until) into waypoints and their valid_untils.'''
+        if len(rows) == 0:
+            return Columns(), numpy.zeros(0, dtype = 'int64')
+
+        columns = list(zip(*rows))
+        waypoints = Columns(**dict(zip(Columns.FIELDS, columns)))
+        waypoints.latitude /= Point.SCALE
+        waypoints.longitude /= Point.SCALE
+
+        return waypoints, numpy.asarray(columns[-1], dtype = 'int64')
+
+    def conditions(self):
+        '''The conditions (on points) that pick out the readings in
+        our date range, along with the runs that reach into it.'''
+        conditions = []
+        if self._start_date != None:
+            conditions.append(Point.time >= epoch(self._start_date - Point.MAX_RUN))
+            conditions.append(sqlalchemy.func.coalesce(Point.valid_until, Point.time) >= epoch(self._start_date))
+        if self._end_date != None:
+            conditions.append(Point.time <= epoch(self._end_date))
+
+        return conditions
+
+    def limits(self):
+        '''Our date range in seconds since the epoch, unbounded
+        ends being infinite.'''
+        start = -numpy.inf if self._start_date == None else epoch(self._start_date)
+        end = numpy.inf if self._end_date == None else epoch(self._end_date)
+
+        return start, end
+
+    @staticmethod
+    def runs(values, lo, hi):
+        '''Walk the stretches of equal values in the sorted
+        values[lo:hi], yielding (value, start, end) for each, with a
+        binary search for each end rather than reading them all in.'''
+        while lo < hi:
+            value = values[lo]
+            end = lo + numpy.searchsorted(values[lo:hi], value, side = 'right')
+            yield value, lo, end
+            lo = end
+
+    def expand(self, waypoints, valid_until):
+        '''Turn each run into a reading at its start and its end,
+        keeping only the readings in our date range. The vehicle
+        really did report at both ends of a run, so nothing is made
+        up; a run that straddles the edge of our range just loses its
+        reading on the far side.'''
+        runs = valid_until >= 0
+
+        if numpy.any(runs):
+            # repeat each run's row, the copy goes right after it
+            #  (before the trip's next reading) and is moved to
+            #  the end of the run
+            counts = runs.astype('int64') + 1
+            ends = numpy.cumsum(counts)[runs] - 1
+
+            waypoints = waypoints[numpy.repeat(numpy.arange(len(runs)), counts)]
+            waypoints.date[ends] = valid_until[runs]
+
+        start, end = self.limits()
+        return waypoints[(waypoints.date >= start) & (waypoints.date <= end)]
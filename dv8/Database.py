@@ -26,14 +26,120 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import calendar
+import datetime
+
+import sqlalchemy
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
-from sqlalchemy import Column, String, Integer, ForeignKey, DateTime, Float
+from sqlalchemy import Column, String, Integer, ForeignKey, DateTime, Float, Index
 
 Base = declarative_base()
+# tables that are really views, and so aren't created by create_all
+Views = sqlalchemy.MetaData()
+
+def epoch(d):
+    '''Seconds since the epoch of a naive datetime, treating it as
+    UTC like sqlite's strftime('%s') does.'''
+    return calendar.timegm(d.timetuple())
+
+def create_engine(database = 'poller.db'):
+    '''Create an engine for a poller database.
+
+    The database is switched to WAL journaling, so graphs can be
+    made while the poller is writing without either blocking the
+    other. With WAL, synchronous=NORMAL is still safe against
+    corruption and saves an fsync on every commit.'''
+    engine = sqlalchemy.create_engine('sqlite:///%s' % database)
+
+    @sqlalchemy.event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode = WAL')
+        cursor.execute('PRAGMA synchronous = NORMAL')
+        cursor.execute('PRAGMA cache_size = -65536') # in KiB, so 64MB
+        cursor.close()
+
+    return engine
+
+def create_schema(engine, legacy = False):
+    '''Create any missing tables, and add any missing columns to
+    the existing ones. New columns are always nullable, so sqlite
+    can add them without rewriting the table. Missing indexes are
+    left to migrate_db, since building those can take a while.
+
+    Databases from before the compact layout still have a waypoints
+    table, which has to be converted by migrate_db first (unless
+    `legacy` is set, which only migrate_db should do).'''
+    Base.metadata.create_all(engine)
+
+    inspector = sqlalchemy.inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = set(c['name'] for c in inspector.get_columns(table.name))
+            for column in table.columns:
+                if column.name not in existing:
+                    print('Adding column %s.%s' % (table.name, column.name))
+                    conn.execute(sqlalchemy.text('ALTER TABLE %s ADD COLUMN "%s" %s' %
+                                                 (table.name, column.name,
+                                                  column.type.compile(engine.dialect))))
+
+        if 'waypoints' in inspector.get_table_names():
+            if not legacy:
+                raise Exception('This database uses the old waypoints table. '
+                                'Please run migrate_db to convert it first.')
+        else:
+            create_waypoints_view(conn)
+
+def create_waypoints_view(conn):
+    '''Create the waypoints view (see WayPoint), along with the
+    triggers that let it be written to like the old table.'''
+    label = lambda column: '(SELECT id FROM labels WHERE value = NEW.%s)' % column
+    ensure_label = lambda column: \
+        'INSERT OR IGNORE INTO labels (value) SELECT NEW.%s WHERE NEW.%s IS NOT NULL;' % (column, column)
+    ensure_labels = ' '.join(ensure_label(c) for c in ('opStatus', 'direction', 'driver'))
+    values = "CAST(strftime('%%s', NEW.date) AS INTEGER), " \
+             "CAST(strftime('%%s', NEW.valid_until) AS INTEGER), " \
+             "CAST(round(NEW.latitude * %d) AS INTEGER), " \
+             "CAST(round(NEW.longitude * %d) AS INTEGER), " \
+             "NEW.deviation, NEW.onBoard, %s, %s, %s, NEW.trip_id" % \
+             (Point.SCALE, Point.SCALE, label('opStatus'), label('direction'), label('driver'))
+    columns = 'time, valid_until, latitude, longitude, deviation, onBoard, ' \
+              'opStatus_id, direction_id, driver_id, trip_id'
+
+    statements = [
+        # the old layout stored dates as text with microseconds
+        "CREATE VIEW IF NOT EXISTS waypoints AS "
+        "SELECT p.id AS id, "
+        "datetime(p.time, 'unixepoch') || '.000000' AS date, "
+        "p.latitude / %d.0 AS latitude, "
+        "p.longitude / %d.0 AS longitude, "
+        "p.deviation AS deviation, "
+        "o.value AS opStatus, "
+        "p.onBoard AS onBoard, "
+        "d.value AS direction, "
+        "r.value AS driver, "
+        "datetime(p.valid_until, 'unixepoch') || '.000000' AS valid_until, "
+        "p.trip_id AS trip_id "
+        "FROM points p "
+        "LEFT JOIN labels o ON o.id = p.opStatus_id "
+        "LEFT JOIN labels d ON d.id = p.direction_id "
+        "LEFT JOIN labels r ON r.id = p.driver_id" % (Point.SCALE, Point.SCALE),
+        "CREATE TRIGGER IF NOT EXISTS waypoints_insert INSTEAD OF INSERT ON waypoints BEGIN "
+        "%s INSERT INTO points (id, %s) VALUES (NEW.id, %s); END" % (ensure_labels, columns, values),
+        "CREATE TRIGGER IF NOT EXISTS waypoints_update INSTEAD OF UPDATE ON waypoints BEGIN "
+        "%s UPDATE points SET (%s) = (%s) WHERE id = OLD.id; END" % (ensure_labels, columns, values),
+        "CREATE TRIGGER IF NOT EXISTS waypoints_delete INSTEAD OF DELETE ON waypoints BEGIN "
+        "DELETE FROM points WHERE id = OLD.id; END",
+    ]
+    for statement in statements:
+        conn.execute(sqlalchemy.text(statement))
 
 class Route(Base):
     __tablename__ = 'routes'
+    __table_args__ = (
+        Index('ix_routes_rId', 'rId', unique = True),
+    )
 
     id = Column(Integer, primary_key = True)
     rId = Column(String)
@@ -43,6 +149,11 @@ class Route(Base):
     
 class Trip(Base):
     __tablename__ = 'trips'
+    __table_args__ = (
+        # a trip is identified by its trip id, run id and route
+        Index('ix_trips_identity', 'tId', 'runId', 'route_id', unique = True),
+        Index('ix_trips_route_id', 'route_id'),
+    )
 
     id = Column(Integer, primary_key = True)
     tId = Column(String)
@@ -50,19 +161,222 @@ class Trip(Base):
     runId = Column(String)
 
     route_id = Column(ForeignKey('routes.id'))
-    waypoints = relationship("WayPoint", backref="trips", order_by="WayPoint.id", lazy="dynamic")
+    points = relationship("Point", backref="trips", order_by="Point.id", lazy="dynamic")
+    waypoints = relationship("WayPoint", primaryjoin="Trip.id == foreign(WayPoint.trip_id)",
+                             order_by="WayPoint.id", lazy="dynamic", viewonly = True)
 
-class WayPoint(Base):
-    __tablename__ = 'waypoints'
+class Label(Base):
+    '''A string that would otherwise be repeated on every point,
+    like an opStatus, direction or driver.'''
+    __tablename__ = 'labels'
+    __table_args__ = (
+        Index('ix_labels_value', 'value', unique = True),
+    )
 
     id = Column(Integer, primary_key = True)
-    date = Column(DateTime)
-    latitude = Column(Float)
-    longitude = Column(Float)
+    value = Column(String)
+
+class Point(Base):
+    '''A single reading of a vehicle, stored compactly: `time` and
+    `valid_until` are seconds since the epoch (of the local time,
+    treated as UTC), latitude and longitude are in millionths of a
+    degree, and the strings are ids in the labels table.
+
+    When the poller is deduplicating, a vehicle that keeps reporting
+    the exact same reading (sitting at a layover, for example) only
+    gets one row, and `valid_until` is pushed forward to the last
+    time it was seen. A run never lasts longer than MAX_RUN.
+
+    `cell` is the dv8.Grid cell the point is in, so the points in
+    an area can be found without a full scan.
+
+    Ids are never reused (AUTOINCREMENT), even after the newest
+    points have been archived, since the rollups (see dv8.Rollup)
+    keep track of which points they've counted by id.'''
+
+    MAX_RUN = datetime.timedelta(hours = 1)
+    SCALE = 1000000
+
+    __tablename__ = 'points'
+    __table_args__ = (
+        Index('ix_points_trip_id_time', 'trip_id', 'time'),
+        Index('ix_points_cell_time', 'cell', 'time'),
+        {'sqlite_autoincrement': True},
+    )
+
+    id = Column(Integer, primary_key = True)
+    time = Column(Integer)
+    latitude = Column(Integer)
+    longitude = Column(Integer)
     deviation = Column(Integer)
-    opStatus = Column(String)
     onBoard = Column(Integer)
-    direction = Column(String)
-    driver = Column(String)
+    valid_until = Column(Integer)
+    cell = Column(Integer) # see dv8.Grid
 
+    opStatus_id = Column(ForeignKey('labels.id'))
+    direction_id = Column(ForeignKey('labels.id'))
+    driver_id = Column(ForeignKey('labels.id'))
     trip_id = Column(ForeignKey('trips.id'))
+
+class WayPoint(Base):
+    '''A point in the old, one string per column, layout. This is
+    a view over points and labels (created by create_schema), so
+    that existing queries keep working. It can also be written to.'''
+    __table__ = sqlalchemy.Table('waypoints', Views,
+                                 Column('id', Integer, primary_key = True),
+                                 Column('date', DateTime),
+                                 Column('latitude', Float),
+                                 Column('longitude', Float),
+                                 Column('deviation', Integer),
+                                 Column('opStatus', String),
+                                 Column('onBoard', Integer),
+                                 Column('direction', String),
+                                 Column('driver', String),
+                                 Column('valid_until', DateTime),
+                                 Column('trip_id', Integer))
+
+class RouteHour(Base):
+    '''An hourly summary of a route in one direction, kept up to
+    date incrementally by dv8.Rollup.
+
+    `histogram` is a JSON object of deviation (in minutes) to the
+    number of readings with that deviation, which is enough to get
+    exact percentiles back out.'''
+    __tablename__ = 'route_hours'
+    __table_args__ = (
+        Index('ix_route_hours_identity', 'route_id', 'hour', 'direction', unique = True),
+        Index('ix_route_hours_hour', 'hour'),
+    )
+
+    id = Column(Integer, primary_key = True)
+    hour = Column(DateTime)
+    direction = Column(String)
+    count = Column(Integer)
+    deviation_sum = Column(Integer)
+    deviation_min = Column(Integer)
+    deviation_max = Column(Integer)
+    on_time = Column(Integer)
+    onBoard_sum = Column(Integer)
+    onBoard_max = Column(Integer)
+    histogram = Column(String)
+
+    route_id = Column(ForeignKey('routes.id'))
+
+class RollupState(Base):
+    '''How far each rollup has gotten, as the id of the last
+    waypoint it has processed.'''
+    __tablename__ = 'rollup_state'
+
+    name = Column(String, primary_key = True)
+    waypoint_id = Column(Integer)
+
+class DayMark(Base):
+    '''A version number for each day's waypoints, bumped by every
+    transaction that writes to that day, so caches of a day's data
+    can tell when they're out of date.'''
+    __tablename__ = 'day_marks'
+
+    day = Column(String, primary_key = True) # YYYY-MM-DD
+    version = Column(Integer)
+
+    @staticmethod
+    def bump(session, days):
+        '''Bump the version of each day (datetime.dates) in `days`.'''
+        if len(days) > 0:
+            session.execute(sqlalchemy.text(
+                'INSERT INTO day_marks (day, version) VALUES (:day, 1) '
+                'ON CONFLICT (day) DO UPDATE SET version = version + 1'),
+                [{'day': d.isoformat()} for d in sorted(days)])
+
+class VehicleState(Base):
+    '''The latest reading of each active trip, stored like a Point,
+    and upserted by the poller in the same transaction as its points.
+    Finding where the fleet is right now is then a scan of a table
+    with one row per vehicle, rather than a search of every point.
+
+    A trip is expired once its vehicle (the same run on the same
+    route) starts a newer trip, or once it hasn't been seen for
+    EXPIRY.'''
+
+    EXPIRY = datetime.timedelta(minutes = 10)
+
+    __tablename__ = 'vehicle_state'
+
+    trip_id = Column(ForeignKey('trips.id'), primary_key = True)
+    time = Column(Integer) # when it was last seen
+    latitude = Column(Integer)
+    longitude = Column(Integer)
+    deviation = Column(Integer)
+    onBoard = Column(Integer)
+
+    opStatus_id = Column(ForeignKey('labels.id'))
+    direction_id = Column(ForeignKey('labels.id'))
+    driver_id = Column(ForeignKey('labels.id'))
+
+    @staticmethod
+    def upsert(session, rows):
+        '''Record the latest reading of some trips, as rows in the
+        points table layout (at most one per trip). An older reading
+        (when replaying, say) never replaces a newer one.'''
+        if len(rows) > 0:
+            session.execute(sqlalchemy.text(
+                'INSERT INTO vehicle_state (trip_id, time, latitude, longitude, deviation, onBoard, '
+                'opStatus_id, direction_id, driver_id) '
+                'VALUES (:trip_id, :time, :latitude, :longitude, :deviation, :onBoard, '
+                ':opStatus_id, :direction_id, :driver_id) '
+                'ON CONFLICT (trip_id) DO UPDATE SET time = excluded.time, '
+                'latitude = excluded.latitude, longitude = excluded.longitude, '
+                'deviation = excluded.deviation, onBoard = excluded.onBoard, '
+                'opStatus_id = excluded.opStatus_id, direction_id = excluded.direction_id, '
+                'driver_id = excluded.driver_id '
+                'WHERE excluded.time >= vehicle_state.time'),
+                rows)
+
+    @staticmethod
+    def expire(session, now):
+        '''Remove the trips that have ended, or that haven't been
+        seen for EXPIRY before `now` (a naive datetime).'''
+        session.execute(sqlalchemy.text(
+            'DELETE FROM vehicle_state WHERE time < :cutoff OR trip_id IN ('
+            # CROSS JOIN keeps sqlite from scanning all of
+            #  trips, rather than just the active ones
+            'SELECT s.trip_id FROM vehicle_state s CROSS JOIN trips t CROSS JOIN vehicle_state n '
+            'CROSS JOIN trips newer '
+            'WHERE t.id = s.trip_id AND n.time > s.time AND newer.id = n.trip_id '
+            'AND newer.route_id = t.route_id AND newer.runId = t.runId)'),
+            {'cutoff': epoch(now - VehicleState.EXPIRY)})
+
+    @staticmethod
+    def current(session, route = None, now = None):
+        '''The current fleet, as a list of dicts, one per vehicle,
+        ordered by route and run. `route` (a route id from the feed)
+        limits it to one route. Vehicles that haven't been seen for
+        EXPIRY before `now` (a naive datetime, by default right now)
+        are left out, since they're only expired while polling.'''
+        if now == None:
+            now = datetime.datetime.now()
+
+        sql = 'SELECT r.rId AS route, r.name AS route_name, t.tId AS trip, t.runId AS run, ' \
+              't.name AS trip_name, s.time AS time, ' \
+              's.latitude / %d.0 AS latitude, s.longitude / %d.0 AS longitude, ' \
+              's.deviation AS deviation, s.onBoard AS onBoard, ' \
+              'o.value AS opStatus, d.value AS direction, v.value AS driver ' \
+              'FROM vehicle_state s JOIN trips t ON t.id = s.trip_id ' \
+              'JOIN routes r ON r.id = t.route_id ' \
+              'LEFT JOIN labels o ON o.id = s.opStatus_id ' \
+              'LEFT JOIN labels d ON d.id = s.direction_id ' \
+              'LEFT JOIN labels v ON v.id = s.driver_id ' % (Point.SCALE, Point.SCALE)
+        sql += 'WHERE s.time >= :cutoff '
+        params = {'cutoff': epoch(now - VehicleState.EXPIRY)}
+        if route != None:
+            sql += 'AND r.rId = :route '
+            params['route'] = str(route)
+        sql += 'ORDER BY r.id, t.runId'
+
+        vehicles = []
+        for row in session.execute(sqlalchemy.text(sql), params):
+            vehicle = dict(row._mapping)
+            vehicle['time'] = datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds = vehicle['time'])
+            vehicles.append(vehicle)
+
+        return vehicles
@@ -32,6 +32,7 @@
 import itertools
 import datetime
 
+import numpy
 import sqlalchemy
 import matplotlib.pyplot
 
@@ -42,13 +43,10 @@ class DeviationPlotter(Plotter):
     '''Simple class to plot the on time performance (deviation)
     for each bus at any given time.'''
 
-    def y_value(self, waypoint):
-        if waypoint.deviation > 20:
-            return 20
-        elif waypoint.deviation < -10:
-            return -10
-        else:
-            return waypoint.deviation
+    FIELDS = ('deviation',)
+
+    def y_value(self, waypoints):
+        return numpy.clip(waypoints.deviation, -10, 20)
 
     def output_name(self):
         return 'deviation.pdf'
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+#
+
+##################################################
+# DV8 (c) Marcus Dillavou <line72@line72.net
+#  https://github.com/line72/dv8
+##################################################
+
+# MIT License
+#
+# Copyright (c) 2017 Marcus Dillavou <line72@line72.net>
+# https://github.com/line72/dv8
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import numpy
+
+class Downsampler:
+    '''Thins out a series so it has no more points than can
+    actually be told apart at the output resolution, while keeping
+    its shape.
+
+    The point budget of a series is the number of pixels it covers
+    (its share of the figure width, at our dpi), times
+    POINTS_PER_PIXEL. Two methods are available:
+
+     - minmax: keeps the first, last, smallest and largest point
+       in each pixel column, so no peak is ever lost.
+     - lttb: Largest-Triangle-Three-Buckets, which keeps the point
+       of each bucket that forms the largest triangle with its
+       neighbours. This tends to look closest to the original.'''
+
+    METHODS = ('minmax', 'lttb', 'none')
+    POINTS_PER_PIXEL = 2
+    MIN_POINTS = 4
+
+    def __init__(self, method, width, dpi):
+        '''`width` is the figure width in inches.'''
+        if method not in Downsampler.METHODS:
+            raise Exception('Invalid downsampling method: %s. Please use one of %s' %
+                            (method, ', '.join(Downsampler.METHODS)))
+
+        self._method = method
+        self._pixels = width * dpi
+
+    def budget(self, x, x_span):
+        '''How many points a series covering x should keep, when the
+        whole axis covers x_span.'''
+        if x_span <= 0:
+            return len(x)
+
+        pixels = self._pixels * (x[-1] - x[0]) / x_span
+        return max(Downsampler.MIN_POINTS, int(pixels * Downsampler.POINTS_PER_PIXEL))
+
+    def downsample(self, x, y, x_span):
+        '''Return the indices of the points of (x, y) to keep. x
+        must be sorted, and in the same units as x_span.'''
+        n = self.budget(x, x_span)
+        if self._method == 'none' or len(x) <= n:
+            return numpy.arange(len(x))
+        elif self._method == 'minmax':
+            return self.minmax(x, y, n // 4)
+        else:
+            return self.lttb(x, y, n)
+
+    def minmax(self, x, y, buckets):
+        '''Split x into equal width buckets, and keep the first, last,
+        min and max point of each. If every point has the same x,
+        there's nothing to split, so they're all kept.'''
+        if x[-1] == x[0]:
+            return numpy.arange(len(x))
+
+        x = x.astype('float64')
+        bucket = ((x - x[0]) * buckets / (x[-1] - x[0])).astype('int64')
+        bucket = numpy.minimum(bucket, buckets - 1)
+
+        # within each bucket, sort by y, so the first and
+        #  last of each group are its min and max
+        by_y = numpy.lexsort((y, bucket))
+        starts = numpy.flatnonzero(numpy.diff(bucket, prepend = -1))
+        ends = numpy.concatenate((starts[1:], [len(x)])) - 1
+
+        keep = numpy.concatenate((starts, ends, by_y[starts], by_y[ends]))
+        return numpy.unique(keep)
+
+    def lttb(self, x, y, n):
+        '''Largest-Triangle-Three-Buckets, keeping n points.'''
+        x = x.astype('float64')
+        y = y.astype('float64')
+
+        # the first and last points are always kept, the rest
+        #  are split into n - 2 buckets of (nearly) equal size
+        edges = numpy.linspace(1, len(x) - 1, n - 1).astype('int64')
+
+        # the average of each bucket, used as the third
+        #  point of the triangle for the bucket before it
+        counts = numpy.diff(edges)
+        avg_x = numpy.add.reduceat(x[:-1], edges[:-1])[:len(counts)] / counts
+        avg_y = numpy.add.reduceat(y[:-1], edges[:-1])[:len(counts)] / counts
+        avg_x = numpy.append(avg_x[1:], x[-1])
+        avg_y = numpy.append(avg_y[1:], y[-1])
+
+        keep = numpy.empty(n, dtype = 'int64')
+        keep[0] = 0
+        keep[-1] = len(x) - 1
+
+        a = 0
+        for i in range(n - 2):
+            lo = edges[i]
+            hi = edges[i + 1]
+
+            # twice the area of the triangle made by the previously
+            #  kept point, each candidate, and the next bucket's average
+            area = numpy.abs((x[a] - avg_x[i]) * (y[lo:hi] - y[a]) -
+                             (x[a] - x[lo:hi]) * (avg_y[i] - y[a]))
+            a = lo + int(numpy.argmax(area))
+            keep[i + 1] = a
+
+        return keep
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+#
+
+##################################################
+# DV8 (c) Marcus Dillavou <line72@line72.net
+#  https://github.com/line72/dv8
+##################################################
+
+# MIT License
+#
+# Copyright (c) 2017 Marcus Dillavou <line72@line72.net>
+# https://github.com/line72/dv8
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+class Feed:
+    '''An InfoPoint style GetAllRoutes endpoint to poll.
+
+    Route ids are only unique within a single agency, so when
+    polling more than one feed, each extra feed should have a
+    prefix that gets prepended to its route ids.'''
+
+    TIMEOUT = 10 # in seconds
+    #!mwd Route 999 and 80 is some fake thing,
+    #  skip it.
+    IGNORED_ROUTES = (80, 999)
+
+    def __init__(self, name, url, prefix = None, timeout = TIMEOUT):
+        self.name = name
+        self.url = url
+        self.prefix = prefix
+        self.timeout = timeout
+
+    @staticmethod
+    def parse(spec, timeout = TIMEOUT):
+        '''Create a feed from a NAME=URL string. The name is
+        also used as its route id prefix.'''
+        name, sep, url = spec.partition('=')
+        if sep == '' or name == '' or url == '':
+            raise Exception('Invalid feed: %s. Please format as NAME=URL' % spec)
+
+        return Feed(name, url, prefix = name, timeout = timeout)
+
+    def rewrite(self, data):
+        '''Drop the routes we ignore from a GetAllRoutes response, and
+        apply our prefix to the route ids of the rest. The ignored
+        routes are the agency's own ids, so this is done first.'''
+        data = [route_info for route_info in data
+                if route_info.get('RouteId') not in Feed.IGNORED_ROUTES]
+        if self.prefix == None:
+            return data
+
+        return [dict(route_info, RouteId = '%s:%s' % (self.prefix, route_info['RouteId']))
+                for route_info in data]
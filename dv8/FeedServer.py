@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+#
+
+##################################################
+# DV8 (c) Marcus Dillavou <line72@line72.net
+#  https://github.com/line72/dv8
+##################################################
+
+# MIT License
+#
+# Copyright (c) 2017 Marcus Dillavou <line72@line72.net>
+# https://github.com/line72/dv8
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import gzip
+import json
+import time
+import hashlib
+import datetime
+import threading
+import http.server
+
+from dv8.Fleet import Fleet
+
+class FeedServer:
+    '''A local stand in for the real feed, serving GetAllRoutes
+    responses for a (made up) Fleet over HTTP.
+
+    The snapshot served is for the current time, unless a `clock`
+    (a function returning a naive datetime) is given. Like a real
+    server, it gzips responses for clients that accept it, and
+    answers a request for an unchanged snapshot (by ETag) with
+    a 304. A `delay` (in seconds) makes it a slow server.'''
+
+    PATH = '/InfoPoint/rest/Routes/GetAllRoutes'
+
+    def __init__(self, fleet = None, host = '127.0.0.1', port = 8000, clock = datetime.datetime.now, delay = 0):
+        self._fleet = fleet if fleet != None else Fleet()
+        self._clock = clock
+        self._delay = delay
+        self._thread = None
+
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != FeedServer.PATH:
+                    self.send_error(404)
+                    return
+
+                if server._delay > 0:
+                    time.sleep(server._delay)
+
+                body = json.dumps(server._fleet.snapshot(server._clock())).encode('utf-8')
+                etag = '"%s"' % hashlib.sha1(body).hexdigest()
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('ETag', etag)
+                if 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+                    body = gzip.compress(body)
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return 'http://%s:%d%s' % (host, port, FeedServer.PATH)
+
+    def serve_forever(self):
+        self._httpd.serve_forever()
+
+    def start(self):
+        '''Serve from a background thread.'''
+        self._thread = threading.Thread(target = self._httpd.serve_forever, daemon = True)
+        self._thread.start()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread != None:
+            self._thread.join()
+            self._thread = None
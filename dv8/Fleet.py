@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+#
+
+##################################################
+# DV8 (c) Marcus Dillavou <line72@line72.net
+#  https://github.com/line72/dv8
+##################################################
+
+# MIT License
+#
+# Copyright (c) 2017 Marcus Dillavou <line72@line72.net>
+# https://github.com/line72/dv8
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import math
+import random
+import datetime
+
+from dv8.Database import epoch
+
+def mix(x):
+    '''A cheap 64 bit hash of an integer (the splitmix64 finalizer),
+    much faster than seeding a random.Random for every reading.'''
+    x &= 0xffffffffffffffff
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & 0xffffffffffffffff
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & 0xffffffffffffffff
+    return x ^ (x >> 31)
+
+class Fleet:
+    '''A made up fleet of buses, for testing and benchmarking without
+    the real feed.
+
+    Each route runs back and forth along a straight line, with its
+    vehicles spread out evenly along it. A vehicle takes TRIP_LENGTH
+    to get from one end to the other, then sits for LAYOVER (sending
+    the exact same reading) before starting its next trip in the
+    other direction. Everything is derived from the time, so the
+    same fleet gives the same snapshot for the same time.'''
+
+    CENTER = (33.52, -86.80) # Birmingham, AL
+    TRIP_LENGTH = datetime.timedelta(minutes = 60)
+    LAYOVER = datetime.timedelta(minutes = 5)
+    UPDATE = 30 # vehicles report their position every this many seconds
+    UTC_OFFSET = 5 * 3600 # the feed's local time is UTC-05:00
+
+    def __init__(self, routes = 30, vehicles = 4, seed = 0):
+        self._seed = seed
+        self._vehicles = vehicles
+
+        self._trip_length = int(Fleet.TRIP_LENGTH.total_seconds())
+        self._cycle = self._trip_length + int(Fleet.LAYOVER.total_seconds())
+        self._trips_per_day = 86400 // self._cycle + 1
+
+        rnd = random.Random(seed)
+        self._routes = []
+        for route_id in range(1, routes + 1):
+            # a line through (or near) downtown
+            angle = rnd.uniform(0, math.pi)
+            length = rnd.uniform(0.05, 0.15)
+            lat = Fleet.CENTER[0] + rnd.uniform(-0.02, 0.02)
+            lon = Fleet.CENTER[1] + rnd.uniform(-0.02, 0.02)
+            start = (lat - math.sin(angle) * length / 2, lon - math.cos(angle) * length / 2)
+            end = (lat + math.sin(angle) * length / 2, lon + math.cos(angle) * length / 2)
+            self._routes.append((route_id, 'Route %d' % route_id, start, end))
+
+    def snapshot(self, now):
+        '''A GetAllRoutes response for `now` (a naive datetime).'''
+        # the whole fleet reports at the same time, every UPDATE
+        t = epoch(now)
+        t -= t % Fleet.UPDATE
+
+        data = []
+        for route_id, name, start, end in self._routes:
+            vehicles = [self.vehicle(route_id, start, end, v, t) for v in range(self._vehicles)]
+            data.append({'RouteId': route_id, 'LongName': name, 'Vehicles': vehicles})
+
+        return data
+
+    def snapshots(self, start, interval = datetime.timedelta(seconds = 30)):
+        '''Yield (snapshot, time) forever, every `interval` from `start`.'''
+        now = start
+        while True:
+            yield self.snapshot(now), now
+            now += interval
+
+    def vehicle(self, route_id, start, end, v, t):
+        '''The reading of vehicle `v` of a route at `t` (in seconds).'''
+        # spread the route's vehicles out along the cycle
+        t += v * self._cycle // self._vehicles
+        trip, phase = divmod(t, self._cycle)
+
+        # anything that's fixed for a whole trip comes
+        #  from a hash of the trip
+        h = mix(((self._seed * 1000003 + route_id) * 1009 + v) * 100003 + trip)
+        deviation = h % 8 - 2
+        drift = (h >> 8) % 14 - 3
+        riders = (h >> 16) % 56 + 5
+
+        if phase < self._trip_length:
+            # readings only change when the vehicle updates
+            step = phase - phase % Fleet.UPDATE
+            progress = step / self._trip_length
+            deviation += int(drift * progress)
+            onBoard = max(0, int(riders * math.sin(math.pi * progress)) + mix(h + step) % 5 - 2)
+        else:
+            # at the end of the line, nothing changes
+            progress = 1.0
+            deviation += drift
+            onBoard = 0
+
+        if trip % 2 == 1:
+            start, end = end, start
+        latitude = start[0] + (end[0] - start[0]) * progress
+        longitude = start[1] + (end[1] - start[1]) * progress
+
+        updated = t - v * self._cycle // self._vehicles
+        updated -= updated % Fleet.UPDATE
+        # the feed's times are in UTC, with the local offset
+        updated += Fleet.UTC_OFFSET
+        return {'VehicleId': route_id * 100 + v,
+                'TripId': route_id * 1000 + trip % self._trips_per_day,
+                'RunId': v,
+                'Name': 'Trip %d' % (trip % self._trips_per_day),
+                'Latitude': latitude,
+                'Longitude': longitude,
+                'Deviation': deviation,
+                'OpStatus': 'ONTIME' if deviation <= 5 else 'LATE',
+                'OnBoard': onBoard,
+                'Direction': 'Outbound' if trip % 2 == 0 else 'Inbound',
+                'DriverName': 'Driver %d-%d' % (route_id, v),
+                'LastUpdated': '/Date(%d000-0500)/' % updated}
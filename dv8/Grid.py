@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+#
+
+##################################################
+# DV8 (c) Marcus Dillavou <line72@line72.net
+#  https://github.com/line72/dv8
+##################################################
+
+# MIT License
+#
+# Copyright (c) 2017 Marcus Dillavou <line72@line72.net>
+# https://github.com/line72/dv8
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import numpy
+
+from dv8.Database import Point
+
+class Grid:
+    '''A fixed grid over the globe, used as a spatial index on
+    points. Each cell is CELL millionths of a degree (see
+    dv8.Database.Point.SCALE) on a side, about 220m north to south,
+    and its id counts along each row of cells from the south west,
+    so every row of a bounding box is one range of ids.'''
+
+    CELL = 2000 # in millionths of a degree
+    ROWS = 180 * Point.SCALE // CELL
+    COLUMNS = 360 * Point.SCALE // CELL
+
+    # the same as cell(), for sqlite, on the points table's columns
+    SQL = '((latitude + %d) / %d) * %d + (longitude + %d) / %d' % \
+          (90 * Point.SCALE, CELL, COLUMNS, 180 * Point.SCALE, CELL)
+
+    @staticmethod
+    def row(latitude):
+        '''The row of a latitude in millionths of a degree (or an array of them).'''
+        return (latitude + 90 * Point.SCALE) // Grid.CELL
+
+    @staticmethod
+    def column(longitude):
+        return (longitude + 180 * Point.SCALE) // Grid.CELL
+
+    @staticmethod
+    def cell(latitude, longitude):
+        '''The id of the cell a point (in millionths of a degree,
+        or arrays of them) is in.'''
+        return Grid.row(latitude) * Grid.COLUMNS + Grid.column(longitude)
+
+    @staticmethod
+    def scaled(degrees):
+        '''Degrees (or an array of them) in millionths of a degree.'''
+        if isinstance(degrees, numpy.ndarray):
+            return numpy.round(degrees * Point.SCALE).astype('int64')
+        return int(round(degrees * Point.SCALE))
+
+    @staticmethod
+    def ranges(south, west, north, east):
+        '''The (first, last) cell ids, inclusive, of each row of cells
+        that covers a bounding box in degrees. The edge cells cover
+        a little more than the box, so points in them still need
+        checking against it.'''
+        first = Grid.column(Grid.scaled(west))
+        last = Grid.column(Grid.scaled(east))
+        return [(row * Grid.COLUMNS + first, row * Grid.COLUMNS + last)
+                for row in range(Grid.row(Grid.scaled(south)), Grid.row(Grid.scaled(north)) + 1)]
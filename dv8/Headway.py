@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+#
+
+##################################################
+# DV8 (c) Marcus Dillavou <line72@line72.net
+#  https://github.com/line72/dv8
+##################################################
+
+# MIT License
+#
+# Copyright (c) 2017 Marcus Dillavou <line72@line72.net>
+# https://github.com/line72/dv8
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import math
+
+import numpy
+
+class Headway:
+    '''Works out the headways of a route: how long after the bus ahead
+    of it (going the same way) each bus passes the same spot, and
+    where buses have bunched up.
+
+    We don't have the routes' shapes, so a route's path is taken from
+    the trip that covered the most ground, and every reading is
+    projected onto it, giving its distance along the route. Each trip
+    is then going one way or the other along the path, depending on
+    whether that distance grows or shrinks. Trips that don't cover
+    at least MIN_TRAVEL of the path get no direction, and are left out.
+
+    The path is split into CHECKPOINTS, and the time each trip passed
+    each checkpoint is interpolated from the readings either side of
+    it. Sorting those passing times by direction, checkpoint and time
+    puts consecutive buses next to each other, so the headways are
+    just the differences. A headway of less than BUNCHING times the
+    route's median headway (in that direction) is bunching, and the
+    bunched checkpoints of each pair of buses make up one event.
+
+    Everything is done with whole array operations, so a route with
+    millions of readings only takes a moment.'''
+
+    CHECKPOINTS = 20
+    PATH_POINTS = 200 # the most vertices a path is simplified to
+    MIN_TRAVEL = 0.25 # of the path length
+    BUNCHING = 0.25 # of the median headway
+    CHUNK = 1000000 # point to segment distances to work out at once
+    METERS_PER_DEGREE = 111320
+
+    def __init__(self, checkpoints = CHECKPOINTS, bunching = BUNCHING):
+        self._checkpoints = checkpoints
+        self._bunching = bunching
+
+    def analyze(self, waypoints):
+        '''Analyze the waypoints (a dv8.DataLoader.Columns with
+        latitude and longitude) of a single route, sorted by trip
+        and date. Returns a dict of:
+
+         - headway: the headway (in seconds) of every waypoint, as of
+           the last checkpoint its trip passed, or NaN if it has none
+           yet (the first bus of the day, say).
+         - crossings: arrays of every checkpoint passed, with the
+           time, checkpoint, direction, headway, trip (the follower)
+           and leader (the trip ahead), and whether it's bunched.
+         - events: arrays of bunching events, with the time of their
+           first bunched checkpoint, leader, trip, their smallest
+           headway and how many checkpoints it lasted.
+         - median: the median headway in each direction (-1 and 1).'''
+        n = len(waypoints)
+        result = {'headway': numpy.full(n, numpy.nan),
+                  'crossings': Headway.empty(('time', 'checkpoint', 'direction', 'headway',
+                                              'trip', 'leader', 'bunched')),
+                  'events': Headway.empty(('time', 'leader', 'trip', 'headway', 'checkpoints')),
+                  'median': {}}
+        if n < 2:
+            return result
+
+        x, y = self.planar(waypoints.latitude, waypoints.longitude)
+        starts, ends = self.segment(waypoints)
+        segments = numpy.repeat(numpy.arange(len(starts)), ends - starts)
+
+        path = self.path(x, y, starts, ends)
+        if path == None:
+            return result
+        distance = self.project(x, y, *path)
+        length = path[2][-1]
+
+        # which way each segment (trip and day) goes along the path
+        travel = distance[ends - 1] - distance[starts]
+        direction = numpy.where(numpy.abs(travel) >= Headway.MIN_TRAVEL * length, numpy.sign(travel), 0)
+
+        # progress along the path in the segment's own direction,
+        #  never going backwards (GPS wanders, buses don't)
+        progress = numpy.where(direction[segments] > 0, distance, length - distance)
+        offset = segments * (2.0 * length + 1)
+        progress = numpy.maximum.accumulate(progress + offset) - offset
+
+        crossings = self.crossings(waypoints.date, progress, segments, direction, length)
+        crossings['trip'] = waypoints.trip[starts][crossings['segment']]
+        self.headways(crossings, waypoints.trip[starts])
+        result['crossings'] = {k: v for k, v in crossings.items() if k != 'segment'}
+
+        for d in (-1, 1):
+            h = crossings['headway'][(crossings['direction'] == d) & ~numpy.isnan(crossings['headway'])]
+            if len(h) > 0:
+                result['median'][d] = float(numpy.median(h))
+        result['events'] = self.events(crossings)
+        result['headway'] = self.waypoint_headways(waypoints.date, segments, crossings)
+
+        return result
+
+    ## Internal Functions ##
+
+    @staticmethod
+    def empty(fields):
+        return {field: numpy.empty(0) for field in fields}
+
+    def planar(self, latitude, longitude):
+        '''Latitude and longitude as x and y in meters, which is
+        close enough over the size of a city.'''
+        scale = math.cos(math.radians(float(numpy.mean(latitude))))
+        return longitude * Headway.METERS_PER_DEGREE * scale, latitude * Headway.METERS_PER_DEGREE
+
+    def segment(self, waypoints):
+        '''The start and end of each trip on each service day (see
+        dv8.Plotter.segment_trips).'''
+        days = waypoints.date // (24 * 60 * 60)
+        breaks = numpy.flatnonzero((waypoints.trip[1:] != waypoints.trip[:-1]) |
+                                   (days[1:] != days[:-1])) + 1
+        return numpy.concatenate(([0], breaks)), numpy.concatenate((breaks, [len(waypoints)]))
+
+    def path(self, x, y, starts, ends):
+        '''The route's path, from the segment that covered the most
+        ground, simplified to at most PATH_POINTS vertices. Returns
+        the x and y of each vertex, and the distance along the path
+        to each, or None if nothing moved.'''
+        steps = numpy.hypot(numpy.diff(x), numpy.diff(y))
+        steps[ends[:-1] - 1] = 0 # don't count the jump between segments
+        travelled = numpy.add.reduceat(numpy.append(steps, 0), starts)
+        best = int(numpy.argmax(travelled))
+        if travelled[best] <= 0:
+            return None
+
+        s, e = starts[best], ends[best]
+        along = numpy.concatenate(([0], numpy.cumsum(steps[s:e - 1])))
+        # keep the first point of each stretch of path_length / PATH_POINTS
+        keep = numpy.flatnonzero(numpy.diff((along * Headway.PATH_POINTS / along[-1]).astype('int64'),
+                                            prepend = -1))
+        keep = numpy.unique(numpy.append(keep, e - s - 1))
+
+        px = x[s:e][keep]
+        py = y[s:e][keep]
+        return px, py, numpy.concatenate(([0], numpy.cumsum(numpy.hypot(numpy.diff(px), numpy.diff(py)))))
+
+    def project(self, x, y, px, py, along):
+        '''The distance along the path of each point, from the
+        nearest point on the path.'''
+        ax = px[:-1]
+        ay = py[:-1]
+        dx = numpy.diff(px)
+        dy = numpy.diff(py)
+        lengths = numpy.maximum(dx * dx + dy * dy, 1e-9)
+
+        distance = numpy.empty(len(x))
+        chunk = max(1, Headway.CHUNK // len(ax))
+        for i in range(0, len(x), chunk):
+            cx = x[i:i + chunk, None]
+            cy = y[i:i + chunk, None]
+            # how far along each segment the nearest point is
+            t = numpy.clip(((cx - ax) * dx + (cy - ay) * dy) / lengths, 0, 1)
+            d = (ax + t * dx - cx) ** 2 + (ay + t * dy - cy) ** 2
+            nearest = numpy.argmin(d, axis = 1)
+            rows = numpy.arange(len(nearest))
+            distance[i:i + chunk] = along[nearest] + t[rows, nearest] * numpy.sqrt(lengths[nearest])
+
+        return distance
+
+    def crossings(self, date, progress, segments, direction, length):
+        '''Every checkpoint passed, between consecutive readings of
+        a segment that has a direction.'''
+        checkpoints = (numpy.arange(self._checkpoints) + 0.5) * length / self._checkpoints
+
+        pairs = numpy.flatnonzero((segments[1:] == segments[:-1]) & (direction[segments[:-1]] != 0))
+        q0 = progress[pairs]
+        q1 = progress[pairs + 1]
+        first = numpy.searchsorted(checkpoints, q0, 'right')
+        count = numpy.searchsorted(checkpoints, q1, 'right') - first
+
+        # one row per checkpoint passed
+        pair = numpy.repeat(numpy.arange(len(pairs)), count)
+        k = first[pair] + numpy.arange(len(pair)) - numpy.repeat(numpy.cumsum(count) - count, count)
+
+        i = pairs[pair]
+        t0 = date[i].astype('float64')
+        t1 = date[i + 1].astype('float64')
+        time = t0 + (t1 - t0) * (checkpoints[k] - q0[pair]) / (q1[pair] - q0[pair])
+
+        return {'time': time, 'checkpoint': k, 'direction': direction[segments[i]].astype('int64'),
+                'segment': segments[i]}
+
+    def headways(self, crossings, trips):
+        '''Sort the crossings by direction, checkpoint and time, so
+        each one follows the bus ahead of it, and work out the
+        headways and bunching. Adds headway, leader and bunched to
+        crossings (and reorders them).'''
+        order = numpy.lexsort((crossings['time'], crossings['checkpoint'], crossings['direction']))
+        for field in list(crossings.keys()):
+            crossings[field] = crossings[field][order]
+
+        time = crossings['time']
+        same = numpy.zeros(len(time), dtype = bool)
+        # the same direction and checkpoint, and the same service day
+        same[1:] = ((crossings['direction'][1:] == crossings['direction'][:-1]) &
+                    (crossings['checkpoint'][1:] == crossings['checkpoint'][:-1]) &
+                    (time[1:] // 86400 == time[:-1] // 86400))
+
+        headway = numpy.full(len(time), numpy.nan)
+        headway[1:] = numpy.where(same[1:], numpy.diff(time), numpy.nan)
+        leader = numpy.full(len(time), -1, dtype = 'int64')
+        leader[1:] = numpy.where(same[1:], trips[crossings['segment'][:-1]], -1)
+
+        bunched = numpy.zeros(len(time), dtype = bool)
+        for d in (-1, 1):
+            mask = (crossings['direction'] == d) & same
+            if mask.any():
+                threshold = self._bunching * numpy.median(headway[mask])
+                bunched |= mask & (headway < threshold)
+
+        crossings['headway'] = headway
+        crossings['leader'] = leader
+        crossings['bunched'] = bunched
+
+    def events(self, crossings):
+        '''Group the bunched crossings of each pair of buses (on
+        each service day) into events.'''
+        b = {field: values[crossings['bunched']] for field, values in crossings.items()}
+        if len(b['time']) == 0:
+            return Headway.empty(('time', 'leader', 'trip', 'headway', 'checkpoints'))
+
+        day = (b['time'] // 86400).astype('int64')
+        order = numpy.lexsort((b['time'], day, b['leader'], b['segment']))
+        segment = b['segment'][order]
+        leader = b['leader'][order]
+        day = day[order]
+        starts = numpy.flatnonzero(numpy.concatenate(([True], (segment[1:] != segment[:-1]) |
+                                                      (leader[1:] != leader[:-1]) |
+                                                      (day[1:] != day[:-1]))))
+
+        events = {'time': numpy.minimum.reduceat(b['time'][order], starts),
+                  'leader': leader[starts],
+                  'trip': b['trip'][order][starts],
+                  'headway': numpy.minimum.reduceat(b['headway'][order], starts),
+                  'checkpoints': numpy.diff(numpy.append(starts, len(order)))}
+
+        by_time = numpy.argsort(events['time'], kind = 'stable')
+        return {field: values[by_time] for field, values in events.items()}
+
+    def waypoint_headways(self, date, segments, crossings):
+        '''The headway of each waypoint, as of the last checkpoint
+        its segment passed.'''
+        # sort the crossings by segment and time, and find the last
+        #  one before each waypoint of the same segment
+        order = numpy.lexsort((crossings['time'], crossings['segment']))
+        segment = crossings['segment'][order]
+        time = crossings['time'][order]
+        headway = crossings['headway'][order]
+
+        # segments and times both fit comfortably in a float64 key
+        scale = float(date.max() - date.min() + 1)
+        base = float(date.min())
+        keys = segment * scale + (time - base)
+        idx = numpy.searchsorted(keys, segments * scale + (date - base), 'right') - 1
+
+        result = numpy.full(len(date), numpy.nan)
+        valid = idx >= 0
+        valid[valid] = segment[idx[valid]] == segments[valid]
+        result[valid] = headway[idx[valid]]
+        return result
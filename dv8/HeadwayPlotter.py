@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+#
+
+##################################################
+# DV8 (c) Marcus Dillavou <line72@line72.net
+#  https://github.com/line72/dv8
+##################################################
+
+# MIT License
+#
+# Copyright (c) 2017 Marcus Dillavou <line72@line72.net>
+# https://github.com/line72/dv8
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import numpy
+
+from dv8.Plotter import Plotter
+from dv8.Headway import Headway
+
+class HeadwayPlotter(Plotter):
+    '''Plots the headway of each bus: how long after the bus ahead
+    of it (on the same route, going the same way) it passed the same
+    spot. Bunching events (see dv8.Headway) are marked with a red x.'''
+
+    FIELDS = ('latitude', 'longitude')
+    MAX_HEADWAY = 90 # in minutes, longer gaps are clipped
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._headway = Headway()
+        # route id -> (waypoints, analysis)
+        self._analyses = {}
+
+    def analyze(self, waypoints):
+        '''Headway.analyze a route's waypoints. go() asks for the
+        headways of every route (for the spans) before make_plot
+        asks again for the same waypoints trimmed to our date range,
+        and for the bunching events, so a route is analyzed once and
+        then trimmed down. The last analysis of each route is only
+        reused if it was of the very same readings.'''
+        route_id = int(waypoints.route[0])
+        if route_id in self._analyses:
+            analyzed, analysis = self._analyses[route_id]
+            if self.same(analyzed, waypoints):
+                return analysis
+
+            in_range = self.in_date_range(analyzed.dates())
+            if self.same(analyzed[in_range], waypoints):
+                events = analysis['events']
+                events = {k: v[self.in_date_range(events['time'].astype('int64').astype('datetime64[s]'))]
+                          for k, v in events.items()}
+                return {'headway': analysis['headway'][in_range], 'events': events}
+
+        analysis = self._headway.analyze(waypoints)
+        self._analyses[route_id] = (waypoints, analysis)
+        return analysis
+
+    def same(self, a, b):
+        '''Whether two sets of waypoints are the same readings.'''
+        return len(a) == len(b) and all(numpy.array_equal(getattr(a, field), getattr(b, field))
+                                        for field in ('trip', 'date', 'latitude', 'longitude'))
+
+    def y_span(self, lows, highs):
+        '''Headways can't be worked out from the extents alone, so
+        every route gets the most room a headway can take.'''
+        return HeadwayPlotter.MAX_HEADWAY
+
+    def y_value(self, waypoints):
+        '''Headways in minutes, or NaN until a bus has one.'''
+        ys = numpy.full(len(waypoints), numpy.nan)
+        route_ids, starts, ends = waypoints.groups('route')
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            ys[start:end] = self.analyze(waypoints[start:end])['headway'] / 60
+
+        return numpy.minimum(ys, HeadwayPlotter.MAX_HEADWAY)
+
+    def go_stream(self):
+        raise Exception('Headways need a whole route at once, so they can\'t be streamed')
+
+    def make_plot(self, ax, route, waypoints):
+        super().make_plot(ax, route, waypoints)
+
+        with self.metrics.time('shaping'):
+            waypoints = waypoints[self.in_date_range(waypoints.dates())]
+            if len(waypoints) == 0:
+                return
+            events = self.analyze(waypoints)['events']
+        if len(events['time']) == 0:
+            return
+
+        print('  %d bunching events' % len(events['time']))
+        with self.metrics.time('drawing'):
+            ax.scatter(events['time'].astype('int64').astype('datetime64[s]'),
+                       numpy.minimum(events['headway'] / 60, HeadwayPlotter.MAX_HEADWAY),
+                       color = 'r', marker = 'x', s = 400, linewidths = 4.0, zorder = 200)
+
+    def output_name(self):
+        return 'headway.pdf'
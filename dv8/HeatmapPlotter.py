@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+#
+
+##################################################
+# DV8 (c) Marcus Dillavou <line72@line72.net
+#  https://github.com/line72/dv8
+##################################################
+
+# MIT License
+#
+# Copyright (c) 2017 Marcus Dillavou <line72@line72.net>
+# https://github.com/line72/dv8
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import sys
+import time
+
+import numpy
+import matplotlib.pyplot
+
+from dv8.Plotter import Plotter
+from dv8.DataLoader import DataLoader
+from dv8.Database import Point
+from dv8.Grid import Grid
+
+class HeatmapPlotter(Plotter):
+    '''Plots where along the network buses lose time, and where they
+    are busiest, as two maps of grid cells (see dv8.Grid): the mean
+    change in deviation between consecutive readings of a trip, put
+    in the cell of the later reading, and the mean number on board.
+
+    Everything is binned at once with numpy.bincount, so this draws
+    a single page, whatever the number of jobs.'''
+
+    FIELDS = ('deviation', 'onBoard', 'latitude', 'longitude')
+    MAX_GAP = 5 * 60 # in seconds, longer gaps don't count as a change
+    MIN_READINGS = 10 # cells with fewer are left blank
+
+    def __init__(self, *args, bbox = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # (south, west, north, east) in degrees
+        self._bbox = bbox
+
+    def go(self, jobs = 1):
+        with self.metrics.time('query'):
+            waypoints = self.load()
+
+        with self.metrics.time('shaping'):
+            waypoints = waypoints[self.in_date_range(waypoints.dates())]
+        if len(waypoints) == 0:
+            print('No data points found in this date range!')
+            sys.exit(1);
+
+        shaping_start = time.perf_counter()
+        rows = Grid.row(Grid.scaled(waypoints.latitude))
+        columns = Grid.column(Grid.scaled(waypoints.longitude))
+        first_row = rows.min()
+        first_column = columns.min()
+        height = rows.max() - first_row + 1
+        width = columns.max() - first_column + 1
+        cells = (rows - first_row) * width + (columns - first_column)
+
+        # waypoints are sorted by route, trip and date, so a change
+        #  is a step to the next reading of the same trip on the same day
+        days = waypoints.date // (24 * 60 * 60)
+        step = ((waypoints.trip[1:] == waypoints.trip[:-1]) &
+                (days[1:] == days[:-1]) &
+                (waypoints.date[1:] - waypoints.date[:-1] <= HeatmapPlotter.MAX_GAP))
+        change = waypoints.deviation[1:] - waypoints.deviation[:-1]
+        # and a missing deviation or onBoard isn't counted
+        step &= ~numpy.isnan(change)
+        known = ~numpy.isnan(waypoints.onBoard)
+
+        size = height * width
+        changes = numpy.bincount(cells[1:][step], minlength = size)
+        deviation = self.mean(numpy.bincount(cells[1:][step], weights = change[step], minlength = size),
+                              changes, (height, width))
+        readings = numpy.bincount(cells, minlength = size)
+        on_board = self.mean(numpy.bincount(cells[known], weights = waypoints.onBoard[known], minlength = size),
+                             numpy.bincount(cells[known], minlength = size), (height, width))
+
+        # cell edges, in degrees
+        ys = (numpy.arange(height + 1) + first_row) * Grid.CELL / Point.SCALE - 90
+        xs = (numpy.arange(width + 1) + first_column) * Grid.CELL / Point.SCALE - 180
+        self.metrics.observe('shaping', time.perf_counter() - shaping_start)
+
+        print('binned %d waypoints into %d cells' % (len(waypoints), numpy.count_nonzero(readings)))
+
+        with self.metrics.time('drawing'):
+            fig, plts = matplotlib.pyplot.subplots(1, 2, sharex = True, sharey = True,
+                                                   figsize = (Plotter.WIDTH / 4, Plotter.HEIGHT / 4))
+            fig.suptitle(self._title, fontsize = 64)
+
+            # gaining and losing time are centered on white
+            limit = numpy.nanmax(numpy.abs(deviation)) if numpy.any(numpy.isfinite(deviation)) else 1
+            self.draw(fig, plts[0], xs, ys, deviation, 'RdBu_r', -limit, limit,
+                      'Mean change in deviation (minutes)')
+            self.draw(fig, plts[1], xs, ys, on_board, 'viridis', None, None,
+                      'Mean on board')
+
+        with self.metrics.time('savefig'):
+            matplotlib.pyplot.savefig(self.output_name(), dpi = self._dpi)
+
+    def go_stream(self):
+        raise Exception('The heatmap can\'t be streamed, try a --bbox instead')
+
+    def output_name(self):
+        return 'heatmap.pdf'
+
+    ## Internal Functions ##
+
+    def load(self, route_id = None):
+        '''Load the waypoints in our date range, only keeping those
+        in our bounding box. Without the cache, the box is handed to
+        the query, so only the waypoints in it are read.'''
+        if self._bbox == None:
+            return super().load(route_id)
+        if self._cache != None and self._start_date != None:
+            waypoints = self._cache.load(self._start_date, self._end_date, route_id)
+            south, west, north, east = self._bbox
+            return waypoints[(waypoints.latitude >= south) & (waypoints.latitude <= north) &
+                             (waypoints.longitude >= west) & (waypoints.longitude <= east)]
+        return DataLoader(self._session, self._start_date, self._end_date, bbox = self._bbox).load(route_id)
+
+    def mean(self, sums, counts, shape):
+        '''The mean of each cell, masked where there are too few readings.'''
+        means = numpy.full(len(sums), numpy.nan)
+        enough = counts >= HeatmapPlotter.MIN_READINGS
+        means[enough] = sums[enough] / counts[enough]
+        return numpy.ma.masked_invalid(means.reshape(shape))
+
+    def draw(self, fig, ax, xs, ys, values, cmap, vmin, vmax, title):
+        mesh = ax.pcolormesh(xs, ys, values, cmap = cmap, vmin = vmin, vmax = vmax)
+        fig.colorbar(mesh, ax = ax)
+        ax.set_title(title, loc = 'left')
+        # a degree of longitude shrinks away from the equator
+        ax.set_aspect(1 / numpy.cos(numpy.radians((ys[0] + ys[-1]) / 2)))
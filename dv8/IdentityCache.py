@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+#
+
+##################################################
+# DV8 (c) Marcus Dillavou <line72@line72.net
+#  https://github.com/line72/dv8
+##################################################
+
+# MIT License
+#
+# Copyright (c) 2017 Marcus Dillavou <line72@line72.net>
+# https://github.com/line72/dv8
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import datetime
+
+import sqlalchemy
+
+from dv8.Database import Route, Trip, Point, Label, epoch
+
+class IdentityCache:
+    '''Keeps the routes and trips we've already seen in memory, keyed
+    by their identity in the feed, so that ingesting a poll doesn't
+    need to query the database to find them.
+
+    Routes are keyed by `rId` and trips by `(route_id, tId, runId)`.
+    The ids of labels (see dv8.Database.Label) are cached too.
+    Trips that haven't been seen for `max_age` service days are
+    evicted, since trip ids get reused each day and old ones would
+    otherwise pile up forever.'''
+
+    MAX_AGE = 2 # in service days
+    CHUNK = 500 # keep under sqlite's bound parameter limit
+    LABELS = ('OpStatus', 'Direction', 'DriverName')
+
+    def __init__(self, session, max_age = MAX_AGE):
+        self._session = session
+        self._max_age = datetime.timedelta(days = max_age)
+
+        # how many routes and trips we've created
+        self.created_routes = 0
+        self.created_trips = 0
+
+        self._routes = {}
+        self._trips = {}
+        self._last_seen = {}
+        self._labels = {}
+        self._today = datetime.date.today()
+
+        self.load()
+
+    def load(self):
+        '''Warm the cache from the routes and trips tables, with only
+        the trips seen in the last `max_age` service days (older ones
+        would just be evicted). This also throws away anything that's
+        already cached.'''
+        self._routes.clear()
+        self._trips.clear()
+        self._last_seen.clear()
+        self._labels.clear()
+
+        for route in self._session.query(Route):
+            self._routes[route.rId] = route
+
+        # (one lookup in the points index per trip)
+        cutoff = datetime.datetime.combine(self._today - self._max_age, datetime.time.min)
+        last_seen = sqlalchemy.select(sqlalchemy.func.max(Point.time)).\
+            where(Point.trip_id == Trip.id).scalar_subquery()
+        for trip, seen in self._session.query(Trip, last_seen).filter(last_seen >= epoch(cutoff)):
+            key = (trip.route_id, trip.tId, trip.runId)
+            self._trips[key] = trip
+            self._last_seen[key] = datetime.datetime.utcfromtimestamp(seen).date()
+
+        for label in self._session.query(Label):
+            self._labels[label.value] = label.id
+
+    def prefetch(self, data, now):
+        '''Resolve every route and trip in a GetAllRoutes response,
+        creating any that don't exist yet. Anything not already cached
+        is looked up with a single batched query per table.'''
+        day = now.date()
+
+        # routes
+        missing_routes = {}
+        for route_info in data:
+            rId = str(route_info['RouteId'])
+            if rId not in self._routes:
+                missing_routes[rId] = route_info
+
+        if len(missing_routes) > 0:
+            for route in self._query_in(Route, Route.rId, list(missing_routes.keys())):
+                self._routes[route.rId] = route
+
+            for rId, route_info in missing_routes.items():
+                if rId not in self._routes:
+                    self._create_route(rId, route_info)
+
+            # new routes need an id before we can key trips on them
+            self._session.flush()
+
+        # trips
+        missing_trips = {}
+        for route_info in data:
+            route = self._routes[str(route_info['RouteId'])]
+            for vehicle_info in route_info['Vehicles']:
+                key = self._trip_key(route, vehicle_info)
+                if key in self._trips:
+                    self._last_seen[key] = day
+                else:
+                    missing_trips[key] = (route, vehicle_info)
+
+        if len(missing_trips) > 0:
+            tIds = list(set(key[1] for key in missing_trips.keys()))
+            for trip in self._query_in(Trip, Trip.tId, tIds):
+                key = (trip.route_id, trip.tId, trip.runId)
+                if key in missing_trips:
+                    self._trips[key] = trip
+
+            for key, (route, vehicle_info) in missing_trips.items():
+                if key not in self._trips:
+                    self._create_trip(key, route, vehicle_info)
+                self._last_seen[key] = day
+
+        # labels
+        missing_labels = set()
+        for route_info in data:
+            for vehicle_info in route_info['Vehicles']:
+                for field in IdentityCache.LABELS:
+                    value = vehicle_info.get(field)
+                    if value != None and value not in self._labels:
+                        missing_labels.add(value)
+
+        if len(missing_labels) > 0:
+            self._create_labels(sorted(missing_labels))
+
+        self.evict(day)
+
+    def get_or_create_route(self, route_info):
+        rId = str(route_info['RouteId'])
+        route = self._routes.get(rId)
+        if route == None:
+            route = self._session.query(Route).filter(Route.rId == rId).one_or_none()
+            if route == None:
+                route = self._create_route(rId, route_info)
+                self._session.flush()
+            else:
+                self._routes[rId] = route
+
+        return route
+
+    def get_or_create_trip(self, route, vehicle_info):
+        key = self._trip_key(route, vehicle_info)
+        trip = self._trips.get(key)
+        if trip == None:
+            trip = self._session.query(Trip).filter(Trip.route_id == key[0],
+                                                    Trip.tId == key[1],
+                                                    Trip.runId == key[2]).one_or_none()
+            if trip == None:
+                trip = self._create_trip(key, route, vehicle_info)
+            else:
+                self._trips[key] = trip
+            self._last_seen[key] = self._today
+
+        return trip
+
+    def label_id(self, value):
+        '''The id of a label, creating it if needed.'''
+        if value == None:
+            return None
+
+        label_id = self._labels.get(value)
+        if label_id == None:
+            self._create_labels([value])
+            label_id = self._labels[value]
+
+        return label_id
+
+    def evict(self, day):
+        '''Drop any trips that haven't been seen in the last few
+        service days. This only does any work once per day.'''
+        if day == self._today:
+            return
+        self._today = day
+
+        cutoff = day - self._max_age
+        stale = [key for key, seen in self._last_seen.items() if seen < cutoff]
+        for key in stale:
+            del self._trips[key]
+            del self._last_seen[key]
+
+        if len(stale) > 0:
+            print('Evicted %d stale trips' % len(stale))
+
+    ## Internal Functions ##
+
+    def _trip_key(self, route, vehicle_info):
+        return (route.id, str(vehicle_info['TripId']), str(vehicle_info['RunId']))
+
+    def _query_in(self, cls, column, values):
+        for i in range(0, len(values), IdentityCache.CHUNK):
+            chunk = values[i:i + IdentityCache.CHUNK]
+            for obj in self._session.query(cls).filter(column.in_(chunk)):
+                yield obj
+
+    def _create_labels(self, values):
+        # another writer may have added some of these already
+        self._session.execute(sqlalchemy.text('INSERT OR IGNORE INTO labels (value) VALUES (:value)'),
+                              [{'value': v} for v in values])
+        for label in self._query_in(Label, Label.value, values):
+            self._labels[label.value] = label.id
+
+    def _create_route(self, rId, route_info):
+        print('Creating new route: %s' % rId)
+        route = Route(rId = rId, name = route_info['LongName'])
+        self._session.add(route)
+        self._routes[rId] = route
+        self.created_routes += 1
+
+        return route
+
+    def _create_trip(self, key, route, vehicle_info):
+        print('Creating new trip: %s' % vehicle_info['TripId'])
+        trip = Trip(tId = key[1],
+                    name = vehicle_info['Name'],
+                    runId = key[2],
+                    route_id = route.id)
+        self._session.add(trip)
+        self._trips[key] = trip
+        self.created_trips += 1
+
+        return trip
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+#
+
+##################################################
+# DV8 (c) Marcus Dillavou <line72@line72.net
+#  https://github.com/line72/dv8
+##################################################
+
+# MIT License
+#
+# Copyright (c) 2017 Marcus Dillavou <line72@line72.net>
+# https://github.com/line72/dv8
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import sys
+import json
+import time
+import queue
+import datetime
+import threading
+
+class IngestQueue:
+    '''A bounded queue of fetched snapshots, drained by a
+    dedicated writer thread.
+
+    When the writer falls behind, it coalesces everything that's
+    waiting into a single transaction. If the queue is still full,
+    `put` blocks for a little while (backpressure) and then spills the
+    snapshot to disk instead. If a batch can't be written, its
+    snapshots are retried one at a time, so one bad snapshot doesn't
+    hold up the rest, and those that still fail are spilled. Spilled
+    snapshots are picked back up once the writer catches up, so a
+    database stall never loses any data, and a spilled snapshot that
+    keeps failing while other writes work is moved aside into
+    `failed/` rather than being retried forever.'''
+
+    MAX_SIZE = 20 # snapshots
+    MAX_BATCH = 10 # snapshots per transaction
+    PUT_TIMEOUT = 5 # in seconds
+    RETRY = 5 # in seconds
+    MAX_ATTEMPTS = 3 # before a spilled snapshot is set aside
+
+    def __init__(self, write, spill_dir = 'spill',
+                 max_size = MAX_SIZE, max_batch = MAX_BATCH):
+        '''`write` is called with a list of (data, now) snapshots,
+        and should record them all in one transaction.'''
+        self._write = write
+        self._spill_dir = spill_dir
+        self._max_batch = max_batch
+
+        # how many writes have worked, and for each spill file
+        #  that has failed, how often and as of which write
+        self._writes = 0
+        self._failures = {}
+
+        self._queue = queue.Queue(maxsize = max_size)
+        self._thread = threading.Thread(target = self.run, name = 'writer', daemon = True)
+
+    def start(self):
+        self._thread.start()
+
+    def put(self, data, now):
+        try:
+            self._queue.put((data, now), timeout = IngestQueue.PUT_TIMEOUT)
+        except queue.Full:
+            print('Ingest queue is full, spilling to disk', file = sys.stderr)
+            self.spill([(data, now)])
+
+    def run(self):
+        while True:
+            batch, names = self.next_batch()
+            if len(batch) == 0:
+                continue
+
+            if self.write(batch, names):
+                continue
+
+            if len(batch) > 1:
+                # try them one at a time, so one bad
+                #  snapshot doesn't hold up the rest
+                worked = [self.write([snapshot], [name]) for snapshot, name in zip(batch, names)]
+                if any(worked):
+                    continue
+
+            # probably the database, give it a moment
+            time.sleep(IngestQueue.RETRY)
+
+    def write(self, batch, names):
+        '''Write a batch of snapshots in one transaction, and remove
+        the spill files (`names`, None for those that weren't spilled)
+        they came from. If that fails, spill them or count it against
+        their spill files. Returns whether it worked.'''
+        try:
+            self._write(batch)
+        except Exception as e:
+            print('Error: writing %d snapshot(s): %s' % (len(batch), e), file = sys.stderr)
+            if len(batch) == 1:
+                self.failed(batch[0], names[0])
+            return False
+
+        self._writes += 1
+        for name in names:
+            if name != None:
+                os.remove(name)
+                self._failures.pop(name, None)
+
+        return True
+
+    def next_batch(self):
+        '''Wait for a snapshot, then take as many more as are
+        already waiting, up to our batch size. If nothing is waiting,
+        pick up any spilled snapshots instead.
+
+        Returns the batch, along with the spill file each snapshot
+        came from (None if it wasn't spilled).'''
+        try:
+            batch = [self._queue.get(timeout = 1)]
+        except queue.Empty:
+            return self.unspill()
+
+        while len(batch) < self._max_batch:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        if len(batch) > 1:
+            print('Writer is behind, coalescing %d snapshots' % len(batch))
+
+        return batch, [None] * len(batch)
+
+    ## Spilling ##
+
+    def spill(self, snapshots):
+        os.makedirs(self._spill_dir, exist_ok = True)
+
+        for data, now in snapshots:
+            name = os.path.join(self._spill_dir, '%s.json' % now.strftime('%Y%m%d%H%M%S%f'))
+            # write to a temp file first, so a crash can't
+            #  leave a half written snapshot behind
+            with open(name + '.tmp', 'w') as f:
+                json.dump({'now': now.isoformat(), 'data': data}, f)
+            os.replace(name + '.tmp', name)
+
+    def failed(self, snapshot, name):
+        '''A snapshot couldn't be written on its own. Spill it, or if
+        it already was, and other writes have worked since it last
+        failed (so it's not just the database), count it against
+        the spill file, and set the file aside if that's too many.'''
+        if name == None:
+            self.spill([snapshot])
+            return
+
+        attempts, writes = self._failures.get(name, (0, None))
+        if writes != self._writes:
+            attempts += 1
+        self._failures[name] = (attempts, self._writes)
+
+        if attempts >= IngestQueue.MAX_ATTEMPTS:
+            failed = os.path.join(self._spill_dir, 'failed')
+            os.makedirs(failed, exist_ok = True)
+            os.replace(name, os.path.join(failed, os.path.basename(name)))
+            del self._failures[name]
+            print('Error: %s failed %d times, moved it to %s' % (name, attempts, failed), file = sys.stderr)
+
+    def unspill(self):
+        '''Load up to a batch of the oldest spilled snapshots. The
+        files are only removed once they've been written.'''
+        if not os.path.isdir(self._spill_dir):
+            return [], []
+
+        names = sorted(n for n in os.listdir(self._spill_dir) if n.endswith('.json'))
+        names = [os.path.join(self._spill_dir, n) for n in names[:self._max_batch]]
+
+        batch = []
+        for name in names:
+            with open(name) as f:
+                snapshot = json.load(f)
+            batch.append((snapshot['data'], datetime.datetime.fromisoformat(snapshot['now'])))
+
+        if len(batch) > 0:
+            print('Recovering %d spilled snapshot(s)' % len(batch))
+
+        return batch, names
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+#
+
+##################################################
+# DV8 (c) Marcus Dillavou <line72@line72.net
+#  https://github.com/line72/dv8
+##################################################
+
+# MIT License
+#
+# Copyright (c) 2017 Marcus Dillavou <line72@line72.net>
+# https://github.com/line72/dv8
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import time
+import threading
+import contextlib
+import http.server
+import logging
+import logging.handlers
+
+class Metrics:
+    '''Timings for each stage of some work (like fetching or
+    inserting), and counters of what it did (like rows written).
+
+    These can be served on localhost in Prometheus' text format,
+    and summarised every so often into a rolling stats log, which
+    covers just the stages and counts since its last line.'''
+
+    PREFIX = 'dv8'
+    STATS_INTERVAL = 300 # in seconds
+    STATS_MAX_BYTES = 1024 * 1024 # before the log rolls over
+    STATS_BACKUPS = 5
+
+    def __init__(self, stats_log = None, stats_interval = STATS_INTERVAL):
+        self._lock = threading.Lock()
+
+        # stage -> [count, total seconds, max seconds]
+        self._timings = {}
+        # (name, ((label, value), ...)) -> count
+        self._counters = {}
+        # the same, but only since the last stats line
+        self._window_timings = {}
+        self._window_counters = {}
+
+        self._stats = None
+        self._stats_interval = stats_interval
+        self._last_stats = time.monotonic()
+        if stats_log != None:
+            self._stats = logging.getLogger('dv8.stats.%s' % stats_log)
+            self._stats.setLevel(logging.INFO)
+            self._stats.propagate = False
+            handler = logging.handlers.RotatingFileHandler(stats_log,
+                                                           maxBytes = Metrics.STATS_MAX_BYTES,
+                                                           backupCount = Metrics.STATS_BACKUPS)
+            handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            self._stats.addHandler(handler)
+
+        self._server = None
+
+    ## Recording ##
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        '''Time the body of a with statement as `stage`.'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            for timings in (self._timings, self._window_timings):
+                timing = timings.setdefault(stage, [0, 0.0, 0.0])
+                timing[0] += 1
+                timing[1] += seconds
+                timing[2] = max(timing[2], seconds)
+
+    def count(self, name, amount = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            for counters in (self._counters, self._window_counters):
+                counters[key] = counters.get(key, 0) + amount
+
+    def timings(self):
+        '''A copy of the timings, as stage -> (count, total, max).'''
+        with self._lock:
+            return {stage: tuple(t) for stage, t in self._timings.items()}
+
+    def merge(self, timings):
+        '''Add in timings from somewhere else (like another process).'''
+        with self._lock:
+            for stage, (count, total, most) in timings.items():
+                for mine in (self._timings, self._window_timings):
+                    timing = mine.setdefault(stage, [0, 0.0, 0.0])
+                    timing[0] += count
+                    timing[1] += total
+                    timing[2] = max(timing[2], most)
+
+    ## Reporting ##
+
+    def text(self):
+        '''Everything, in Prometheus' text exposition format.'''
+        with self._lock:
+            lines = []
+            if len(self._timings) > 0:
+                name = '%s_stage_seconds' % Metrics.PREFIX
+                lines.append('# TYPE %s summary' % name)
+                for stage, (count, total, most) in sorted(self._timings.items()):
+                    lines.append('%s_sum{stage="%s"} %f' % (name, stage, total))
+                    lines.append('%s_count{stage="%s"} %d' % (name, stage, count))
+                lines.append('# TYPE %s_max gauge' % name)
+                for stage, (count, total, most) in sorted(self._timings.items()):
+                    lines.append('%s_max{stage="%s"} %f' % (name, stage, most))
+
+            typed = set()
+            for (counter, labels), value in sorted(self._counters.items()):
+                name = '%s_%s_total' % (Metrics.PREFIX, counter)
+                if name not in typed:
+                    lines.append('# TYPE %s counter' % name)
+                    typed.add(name)
+                label_text = ','.join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in labels)
+                lines.append('%s%s %d' % (name, '{%s}' % label_text if label_text else '', value))
+
+            return '\n'.join(lines) + '\n'
+
+    def summary(self, timings, counters):
+        '''One line summarising some timings and counters.'''
+        parts = ['%s=%.1fms/%.1fms' % (stage, total / count * 1000, most * 1000)
+                 for stage, (count, total, most) in sorted(timings.items())]
+        for (counter, labels), value in sorted(counters.items()):
+            label_text = ','.join('%s' % v for k, v in labels)
+            parts.append('%s%s=%d' % (counter, '[%s]' % label_text if label_text else '', value))
+
+        return ' '.join(parts)
+
+    def tick(self):
+        '''Write a line to the stats log if it's been long enough,
+        covering everything since the last line. Stages are shown as
+        mean/max.'''
+        if self._stats == None or time.monotonic() - self._last_stats < self._stats_interval:
+            return
+
+        with self._lock:
+            timings = self._window_timings
+            counters = self._window_counters
+            self._window_timings = {}
+            self._window_counters = {}
+            self._last_stats = time.monotonic()
+
+        self._stats.info(self.summary(timings, counters))
+
+    def report(self):
+        '''A table of where the time went, for profiling.'''
+        timings = self.timings()
+        grand_total = sum(t[1] for t in timings.values())
+
+        lines = ['%-12s %10s %7s %8s' % ('stage', 'seconds', 'share', 'calls')]
+        for stage, (count, total, most) in sorted(timings.items(), key = lambda t: -t[1][1]):
+            share = total / grand_total * 100 if grand_total > 0 else 0
+            lines.append('%-12s %10.3f %6.1f%% %8d' % (stage, total, share, count))
+
+        return '\n'.join(lines)
+
+    ## Serving ##
+
+    def serve(self, port, host = '127.0.0.1'):
+        '''Serve the metrics at http://host:port/metrics from a
+        background thread.'''
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+
+                body = metrics.text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer((host, port), Handler)
+        thread = threading.Thread(target = self._server.serve_forever, name = 'metrics', daemon = True)
+        thread.start()
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+#
+
+##################################################
+# DV8 (c) Marcus Dillavou <line72@line72.net
+#  https://github.com/line72/dv8
+##################################################
+
+# MIT License
+#
+# Copyright (c) 2017 Marcus Dillavou <line72@line72.net>
+# https://github.com/line72/dv8
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import sys
+import datetime
+
+import sqlalchemy
+
+from dv8.Database import Base, Point, create_engine, create_schema, create_waypoints_view
+from dv8.Grid import Grid
+from dv8.DataLoader import DataLoader
+
+class Migrator:
+    '''Brings an existing poller database up to date with the
+    schema declared in dv8.Database, in place.'''
+
+    # The hot queries, along with the index we expect
+    #  sqlite to use for each of them.
+    QUERIES = [
+        ('route lookup',
+         'SELECT id FROM routes WHERE rId = :rId',
+         {'rId': '1'},
+         'ix_routes_rId'),
+        ('trip lookup',
+         'SELECT id FROM trips WHERE tId = :tId AND runId = :runId AND route_id = :route_id',
+         {'tId': '1', 'runId': '1', 'route_id': 1},
+         'ix_trips_identity'),
+        ('trips of a route',
+         'SELECT id FROM trips WHERE route_id = :route_id',
+         {'route_id': 1},
+         'ix_trips_route_id'),
+        ('points of a trip',
+         'SELECT * FROM points WHERE trip_id = :trip_id AND time >= :start AND time <= :end',
+         {'trip_id': 1, 'start': 1500508800, 'end': 1500595200},
+         'ix_points_trip_id_time'),
+    ]
+
+    # an example bounding box and day for the graphs' query of the
+    #  points in an area (see area_query)
+    AREA = ((33.50, -86.82, 33.53, -86.78), datetime.datetime(2017, 7, 20), datetime.datetime(2017, 7, 21))
+
+    CHUNK = 50000 # waypoints copied (or given cells) per transaction
+
+    # converts the old waypoints table (w) into points
+    COMPACT = "INSERT OR REPLACE INTO points (id, time, valid_until, latitude, longitude, " \
+              "deviation, onBoard, opStatus_id, direction_id, driver_id, trip_id) " \
+              "SELECT w.id, CAST(strftime('%%s', w.date) AS INTEGER), " \
+              "CAST(strftime('%%s', w.valid_until) AS INTEGER), " \
+              "CAST(round(w.latitude * %d) AS INTEGER), CAST(round(w.longitude * %d) AS INTEGER), " \
+              "w.deviation, w.onBoard, " \
+              "(SELECT id FROM labels WHERE value = w.opStatus), " \
+              "(SELECT id FROM labels WHERE value = w.direction), " \
+              "(SELECT id FROM labels WHERE value = w.driver), " \
+              "w.trip_id FROM waypoints w WHERE w.id >= :start AND w.id < :end" % (Point.SCALE, Point.SCALE)
+    LABELS = "INSERT OR IGNORE INTO labels (value) " \
+             "SELECT opStatus FROM waypoints WHERE id >= :start AND id < :end AND opStatus IS NOT NULL UNION " \
+             "SELECT direction FROM waypoints WHERE id >= :start AND id < :end AND direction IS NOT NULL UNION " \
+             "SELECT driver FROM waypoints WHERE id >= :start AND id < :end AND driver IS NOT NULL"
+
+    # gives points inserted without a cell their cell
+    CELL_TRIGGER = "CREATE TRIGGER IF NOT EXISTS points_cell AFTER INSERT ON points " \
+                   "WHEN NEW.cell IS NULL BEGIN " \
+                   "UPDATE points SET cell = %s WHERE id = NEW.id; END" % Grid.SQL
+
+    def __init__(self, database = 'poller.db'):
+        self._engine = create_engine(database)
+
+    def go(self):
+        # any tables that are missing entirely get created
+        #  along with their indexes, as do any missing columns
+        create_schema(self._engine, legacy = True)
+
+        # convert the old waypoints table to the compact layout
+        self.compact()
+
+        # older pollers still write through the waypoints
+        #  view, which doesn't know about cells
+        with self._engine.begin() as conn:
+            conn.execute(sqlalchemy.text(Migrator.CELL_TRIGGER))
+        self.fill_cells()
+
+        with self._engine.begin() as conn:
+            # the unique indexes can't be created if there
+            #  are already duplicates, so merge those first.
+            self.merge_duplicates(conn, 'routes', ('rId',), 'trips', 'route_id')
+            self.merge_duplicates(conn, 'trips', ('tId', 'runId', 'route_id'), 'points', 'trip_id')
+
+            self.create_indexes(conn)
+            self.mark_days(conn)
+
+        # give the query planner some statistics
+        with self._engine.begin() as conn:
+            conn.execute(sqlalchemy.text('ANALYZE'))
+
+    def compact(self):
+        '''Copy the old waypoints table into points (and labels), then
+        replace it with the compatibility view.
+
+        This is done online: rows are copied a chunk at a time, each
+        in its own short transaction, so an old poller can keep
+        writing to the table in the meantime. Only the final step,
+        which copies whatever is left, re-copies any recent waypoints
+        it may have extended since, and swaps in the view, locks the
+        database for more than a moment. It's safe to interrupt and
+        run again.'''
+        inspector = sqlalchemy.inspect(self._engine)
+        if 'waypoints' not in inspector.get_table_names():
+            return
+
+        # only pollers with dedup added valid_until to the old table
+        if 'valid_until' not in set(c['name'] for c in inspector.get_columns('waypoints')):
+            with self._engine.begin() as conn:
+                conn.execute(sqlalchemy.text('ALTER TABLE waypoints ADD COLUMN valid_until DATETIME'))
+
+        with self._engine.connect() as conn:
+            total = conn.execute(sqlalchemy.text('SELECT MAX(id) FROM waypoints')).scalar() or 0
+            done = conn.execute(sqlalchemy.text('SELECT MAX(id) FROM points')).scalar() or 0
+
+            # anything newer than this might still have its
+            #  valid_until extended while we're copying
+            cutoff = datetime.datetime.now() - Point.MAX_RUN
+            recent = conn.execute(sqlalchemy.text('SELECT MIN(id) FROM waypoints WHERE date >= :cutoff'),
+                                  {'cutoff': cutoff.strftime('%Y-%m-%d %H:%M:%S.%f')}).scalar()
+
+        start = done + 1
+        while start <= total:
+            end = start + Migrator.CHUNK
+            with self._engine.begin() as conn:
+                self.copy_waypoints(conn, start, end)
+            print('Compacted %d of %d waypoints' % (min(end - 1, total), total))
+            start = end
+
+        with self._engine.begin() as conn:
+            if recent != None:
+                start = min(start, recent)
+            self.copy_waypoints(conn, start, sys.maxsize)
+
+            # carry on numbering where the old table (or the rollups'
+            #  high water mark) left off, even if its newest waypoints
+            #  have been archived
+            last = conn.execute(sqlalchemy.text(
+                "SELECT MAX(COALESCE((SELECT MAX(seq) FROM sqlite_sequence WHERE name IN ('points', 'waypoints')), 0), "
+                'COALESCE((SELECT MAX(waypoint_id) FROM rollup_state), 0))')).scalar()
+            conn.execute(sqlalchemy.text("DELETE FROM sqlite_sequence WHERE name IN ('points', 'waypoints')"))
+            conn.execute(sqlalchemy.text("INSERT INTO sqlite_sequence (name, seq) VALUES ('points', :last)"),
+                         {'last': last})
+
+            conn.execute(sqlalchemy.text('DROP TABLE waypoints'))
+            create_waypoints_view(conn)
+        print('Replaced the waypoints table with a view')
+
+    def fill_cells(self):
+        '''Give every point without a grid cell (see dv8.Grid) one.
+        Like compact, this is done a chunk at a time, so the poller
+        can keep writing in the meantime.'''
+        with self._engine.connect() as conn:
+            first = conn.execute(sqlalchemy.text('SELECT MIN(id) FROM points WHERE cell IS NULL')).scalar()
+            total = conn.execute(sqlalchemy.text('SELECT MAX(id) FROM points')).scalar()
+        if first == None:
+            return
+
+        start = first
+        while start <= total:
+            end = start + Migrator.CHUNK
+            with self._engine.begin() as conn:
+                conn.execute(sqlalchemy.text(
+                    'UPDATE points SET cell = %s WHERE id >= :start AND id < :end AND cell IS NULL' % Grid.SQL),
+                    {'start': start, 'end': end})
+            print('Filled in the cells of %d of %d waypoints' % (min(end - 1, total), total))
+            start = end
+
+    def copy_waypoints(self, conn, start, end):
+        '''Copy the waypoints with ids from `start` up to (but not
+        including) `end` into points.'''
+        params = {'start': start, 'end': end}
+        conn.execute(sqlalchemy.text(Migrator.LABELS), params)
+        conn.execute(sqlalchemy.text(Migrator.COMPACT), params)
+
+    def merge_duplicates(self, conn, table, columns, child_table, child_column):
+        '''Find rows of `table` that share the same `columns`, point
+        all of their children at the oldest one, and delete the rest.'''
+        cols = ', '.join(columns)
+        duplicates = conn.execute(sqlalchemy.text(
+            'SELECT %s, MIN(id) FROM %s GROUP BY %s HAVING COUNT(*) > 1' % (cols, table, cols))).fetchall()
+
+        where = ' AND '.join('%s IS :%s' % (c, c) for c in columns)
+        for row in duplicates:
+            params = dict(zip(columns, row))
+            keep = row[-1]
+
+            ids = [r[0] for r in conn.execute(sqlalchemy.text(
+                'SELECT id FROM %s WHERE %s AND id != :keep' % (table, where)),
+                dict(params, keep = keep))]
+
+            print('Merging %d duplicate %s into %s' % (len(ids), table, keep))
+            for i in ids:
+                conn.execute(sqlalchemy.text(
+                    'UPDATE %s SET %s = :keep WHERE %s = :id' % (child_table, child_column, child_column)),
+                    {'keep': keep, 'id': i})
+                conn.execute(sqlalchemy.text('DELETE FROM %s WHERE id = :id' % table), {'id': i})
+
+    def create_indexes(self, conn):
+        '''Create any indexes declared in the schema that the
+        database doesn't have yet.'''
+        inspector = sqlalchemy.inspect(conn)
+
+        for table in Base.metadata.sorted_tables:
+            existing = set(i['name'] for i in inspector.get_indexes(table.name))
+            for index in table.indexes:
+                if index.name not in existing:
+                    print('Creating index %s on %s' % (index.name, table.name))
+                    index.create(conn)
+
+    def mark_days(self, conn):
+        '''Give every day that has waypoints, but no day mark yet, a
+        day mark, so that the series cache can be used for it.'''
+        result = conn.execute(sqlalchemy.text(
+            'INSERT OR IGNORE INTO day_marks (day, version) '
+            "SELECT DISTINCT date(time, 'unixepoch'), 1 FROM points WHERE time IS NOT NULL"))
+        if result.rowcount > 0:
+            print('Marked %d days' % result.rowcount)
+
+    @staticmethod
+    def area_query(conn, bbox, start_date, end_date):
+        '''The query DataLoader loads the points in a bounding box with,
+        as an entry like those in QUERIES.'''
+        session = sqlalchemy.orm.Session(bind = conn)
+        query = DataLoader(session, start_date, end_date, bbox = bbox).query()
+        compiled = query.statement.compile(dialect = sqlalchemy.dialects.sqlite.dialect(paramstyle = 'named'))
+
+        return ('points in an area', str(compiled), compiled.params, 'ix_points_cell_time')
+
+    def explain(self):
+        '''Run EXPLAIN QUERY PLAN on each hot query, returning a
+        list of (name, plan, expected index, uses index).'''
+        results = []
+        with self._engine.connect() as conn:
+            for name, sql, params, index in Migrator.QUERIES + [Migrator.area_query(conn, *Migrator.AREA)]:
+                rows = conn.execute(sqlalchemy.text('EXPLAIN QUERY PLAN %s' % sql), params).fetchall()
+                plan = '; '.join(str(r[-1]) for r in rows)
+                uses = any(('INDEX %s ' % index) in ('%s ' % r[-1]) for r in rows)
+                results.append((name, plan, index, uses))
+
+        return results
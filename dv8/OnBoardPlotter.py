@@ -41,8 +41,11 @@ from dv8.Plotter import Plotter
 class OnBoardPlotter(Plotter):
     '''Simple class to plot how many people are on each
     bus at any given time.'''
-    def y_value(self, waypoint):
-        return waypoint.onBoard
+
+    FIELDS = ('onBoard',)
+
+    def y_value(self, waypoints):
+        return waypoints.onBoard
 
     def output_name(self):
         return 'onboard.pdf'
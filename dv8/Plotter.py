@@ -29,24 +29,68 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import itertools
-import datetime
+import os
 import sys
+import time
+import heapq
+import datetime
+import itertools
+import tempfile
+import concurrent.futures
 
+import numpy
 import sqlalchemy
 import matplotlib.pyplot
 
-from dv8.Database import Base, Route, Trip, WayPoint
+from dv8.Database import Route, create_engine, create_schema
+from dv8.DataLoader import DataLoader, Columns
+from dv8.SeriesCache import SeriesCache
+from dv8.Downsampler import Downsampler
+from dv8.Metrics import Metrics
+
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+def render_page(cls, args, route_id, height, min_x, max_x, show_title, path):
+    '''Worker process entry point for Plotter.go_parallel'''
+    plotter = cls(*args)
+    return plotter.render_page(route_id, height, min_x, max_x, show_title, path)
 
 class Plotter:
     '''Simple abstract base class to plot the data.'''
-    def __init__(self, title, start_date = None, end_date = None):
-        engine = sqlalchemy.create_engine("sqlite:///poller.db")
-        Base.metadata.create_all(engine)
+
+    WIDTH = 200 # in inches
+    HEIGHT = 100 # in inches
+    MIN_PAGE_HEIGHT = 5 # in inches
+
+    # the waypoint fields y_value uses
+    FIELDS = Columns.FIELDS[3:]
+
+    def __init__(self, title, start_date = None, end_date = None, downsample = 'minmax', dpi = 100,
+                 cache = SeriesCache.DIRECTORY):
+        engine = create_engine()
+        create_schema(engine)
 
         Session = sqlalchemy.orm.sessionmaker(bind = engine)
         self._session = Session()
 
+        # so worker processes can make their own copy of us
+        self._args = (title, start_date, end_date, downsample, dpi, cache)
+
+        self._cache = None
+        if cache != None:
+            self._cache = SeriesCache(self._session, self.FIELDS, cache)
+
+        # where the time goes: query, shaping, drawing and savefig
+        self.metrics = Metrics()
+
+        self._downsampler = Downsampler(downsample, Plotter.WIDTH, dpi)
+        self._dpi = dpi
+        # the width of the x axis, in seconds
+        self._x_span = 0
+
         self._title = title
         self._start_date = None
         self._end_date = None
@@ -61,7 +105,10 @@ class Plotter:
                 raise Exception('Invalid end date: %s. Please format as YYYYMMDD (20170523)' % end_date)
 
     ## Callbacks that the sub classes must override ##
-    def y_value(self, waypoint):
+    def y_value(self, waypoints):
+        '''Return an array of y values for a set of waypoints
+        (a dv8.DataLoader.Columns). Values that aren't known
+        can be NaN.'''
         raise NotImplementedError
 
     def output_name(self):
@@ -70,11 +117,24 @@ class Plotter:
 
     ## Public functions ##
             
-    def go(self):
-        # make a subplot for each route
-        routes = self._session.query(Route).all()
+    def go(self, jobs = 1):
+        if jobs > 1:
+            self.go_parallel(jobs)
+            return
 
-        today = datetime.datetime.now()
+        with self.metrics.time('query'):
+            # make a subplot for each route
+            routes = self._session.query(Route).order_by(Route.id).all()
+
+            # load everything in our date range in one go
+            waypoints = self.load()
+
+        if len(waypoints) == 0:
+            print('No data points found in this date range!')
+            sys.exit(1);
+
+        shaping_start = time.perf_counter()
+        y_values = self.y_value(waypoints)
 
         # find the overall max y span, we'll then set up ratios
         #  b/c we want our plots to be different sizes
@@ -83,57 +143,204 @@ class Plotter:
         #  set a ratio based on its vs the maximum span
         #
         # Also find the min/max date (x)
-        spans = []
-        xs = []
-        for r in routes:
-            waypoints = [waypoint for t in r.trips for waypoint in self.waypoints(t)]
-            y_values = [self.y_value(x) for x in waypoints]
-            xs.extend([x.date for x in waypoints])
-            
-            if len(y_values) > 0:
-                spans.append(max(y_values) - min(y_values))
+        route_ids, starts, ends = waypoints.groups('route')
+        # (fmax/fmin skip the NaNs of y values that aren't known)
+        spans = numpy.nan_to_num(numpy.fmax.reduceat(y_values, starts) - numpy.fmin.reduceat(y_values, starts))
+        spans = dict(zip(route_ids.tolist(), spans.tolist()))
+        slices = dict(zip(route_ids.tolist(), zip(starts.tolist(), ends.tolist())))
+
+        dates = waypoints.dates()
+        min_x = dates.min()
+        max_x = dates.max()
+        self._x_span = waypoints.date.max() - waypoints.date.min()
 
-        if len(xs) == 0:
+        self.metrics.observe('shaping', time.perf_counter() - shaping_start)
+
+        fig, plts = self.make_figure(routes, spans)
+        
+        for i, route in enumerate(routes):
+            # draw a dark black line at 0
+            with self.metrics.time('drawing'):
+                plts[i].plot([min_x, max_x], [0, 0], 'k', linewidth = 4.0, zorder=100)
+
+            start, end = slices.get(route.id, (0, 0))
+            self.make_plot(plts[i], route, waypoints[start:end])
+
+        ouput = self.output_name()
+        with self.metrics.time('savefig'):
+            matplotlib.pyplot.savefig(ouput, dpi = self._dpi)
+
+    def go_stream(self):
+        '''Draw every route into a single figure, like go(), but
+        without ever holding more than one series (the readings of a
+        trip on one day) in memory, for date ranges too long to load.
+
+        The extents of each route come from aggregate queries, the
+        date range is applied by the queries themselves, and each
+        series is drawn as soon as it has been read. This doesn't use
+        the cache.'''
+        loader = DataLoader(self._session, self._start_date, self._end_date)
+
+        with self.metrics.time('query'):
+            routes = self._session.query(Route).order_by(Route.id).all()
+            extents = loader.extents(self.FIELDS)
+
+        if len(extents) == 0:
             print('No data points found in this date range!')
             sys.exit(1);
-                
-        max_span = max(spans)
 
-        min_x = min(xs)
-        max_x = max(xs)
-        xs = None
+        with self.metrics.time('shaping'):
+            spans = {route_id: self.y_span(lows, highs)
+                     for route_id, (first, last, lows, highs) in extents.items()}
+
+            first = int(min(e[0] for e in extents.values()))
+            last = int(max(e[1] for e in extents.values()))
+            min_x = numpy.datetime64(first, 's')
+            max_x = numpy.datetime64(last, 's')
+            self._x_span = last - first
+
+        fig, plts = self.make_figure(routes, spans)
+
+        for i, route in enumerate(routes):
+            # draw a dark black line at 0
+            with self.metrics.time('drawing'):
+                plts[i].plot([min_x, max_x], [0, 0], 'k', linewidth = 4.0, zorder=100)
+
+            self.make_plot_stream(plts[i], route, loader)
+
+        with self.metrics.time('savefig'):
+            matplotlib.pyplot.savefig(self.output_name(), dpi = self._dpi)
+
+    def go_parallel(self, jobs):
+        '''Draw each route on its own page in a pool of worker
+        processes, and then merge the pages into a single pdf.
+
+        The shared x limits and height ratios come from aggregate
+        queries (like go_stream's), and each worker only loads the
+        route it's drawing, so no process ever holds more than one
+        route's data, and nothing is loaded twice.'''
+        if pypdf == None:
+            raise Exception('Drawing in parallel requires pypdf. Please install it or use 1 job.')
+
+        loader = DataLoader(self._session, self._start_date, self._end_date)
+
+        with self.metrics.time('query'):
+            routes = self._session.query(Route).order_by(Route.id).all()
+            extents = loader.extents(self.FIELDS)
+
+        if len(extents) == 0:
+            print('No data points found in this date range!')
+            sys.exit(1);
+
+        with self.metrics.time('shaping'):
+            spans = {route_id: self.y_span(lows, highs)
+                     for route_id, (first, last, lows, highs) in extents.items()}
+
+            min_x = numpy.datetime64(int(min(e[0] for e in extents.values())), 's')
+            max_x = numpy.datetime64(int(max(e[1] for e in extents.values())), 's')
+
+        max_span = max(spans.values())
+        height_ratios = [spans[r.id] / max_span if r.id in spans else 0.1 for r in routes]
+
+        # each page gets its share of what would have been
+        #  the height of the single figure
+        total = sum(height_ratios)
+        heights = [max(Plotter.MIN_PAGE_HEIGHT, Plotter.HEIGHT * ratio / total) for ratio in height_ratios]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            pages = [os.path.join(tmp, '%d.pdf' % i) for i in range(len(routes))]
+
+            with concurrent.futures.ProcessPoolExecutor(max_workers = jobs) as pool:
+                futures = [pool.submit(render_page, type(self), self._args,
+                                       route.id, heights[i], min_x, max_x, i == 0, pages[i])
+                           for i, route in enumerate(routes)]
+                for f in futures:
+                    # add up where each worker's time went
+                    self.metrics.merge(f.result())
+
+            with self.metrics.time('merge'):
+                writer = pypdf.PdfWriter()
+                for page in pages:
+                    for p in pypdf.PdfReader(page).pages:
+                        writer.add_page(p)
+                with open(self.output_name(), 'wb') as f:
+                    writer.write(f)
+
+    def render_page(self, route_id, height, min_x, max_x, show_title, path):
+        '''Draw a single route into its own pdf. Returns our timings.'''
+        with self.metrics.time('query'):
+            route = self._session.query(Route).get(route_id)
+            waypoints = self.load(route_id)
+
+        self._x_span = (max_x - min_x) // numpy.timedelta64(1, 's')
+
+        with self.metrics.time('drawing'):
+            fig, ax = matplotlib.pyplot.subplots(1, 1, figsize = (Plotter.WIDTH, height))
+            if show_title:
+                fig.suptitle(self._title, fontsize=128)
+
+            # draw a dark black line at 0
+            ax.plot([min_x, max_x], [0, 0], 'k', linewidth = 4.0, zorder=100)
+
+        self.make_plot(ax, route, waypoints)
+
+        with self.metrics.time('drawing'):
+            # every page shares the same x axis, with
+            #  matplotlib's usual margins
+            margin = (max_x - min_x) * matplotlib.rcParams['axes.xmargin']
+            ax.set_xlim(min_x - margin, max_x + margin)
+
+        with self.metrics.time('savefig'):
+            fig.savefig(path, dpi = self._dpi)
+            matplotlib.pyplot.close(fig)
+
+        return self.metrics.timings()
+
+    ## Internal Functions ##
+
+    def load(self, route_id = None):
+        '''Load the waypoints in our date range, optionally for a
+        single route. When we have a start date, whole days come from
+        the series cache.'''
+        if self._cache != None and self._start_date != None:
+            return self._cache.load(self._start_date, self._end_date, route_id)
+        else:
+            return DataLoader(self._session, self._start_date, self._end_date).load(route_id)
+        
+    def make_figure(self, routes, spans):
+        '''Make a figure with a subplot for each route, each as tall
+        as its span of y values (by route id) allows.'''
+        max_span = max(spans.values())
 
         # now find the height ratios 
         height_ratios = []
         for r in routes:
-            y_values = [self.y_value(waypoint) for t in r.trips for waypoint in self.waypoints(t)]
-            if len(y_values) > 0:
-                ratio = (max(y_values) - min(y_values)) / max_span
+            if r.id in spans:
+                ratio = spans[r.id] / max_span
             else:
                 ratio = 0.1 # not sure what to do here!
             height_ratios.append(ratio)
 
-        fig, plts = matplotlib.pyplot.subplots(len(routes), 1, sharex = True, sharey = False,
-                                               gridspec_kw = {'height_ratios': height_ratios},
-                                               figsize = (200, 100))
+        with self.metrics.time('drawing'):
+            fig, plts = matplotlib.pyplot.subplots(len(routes), 1, sharex = True, sharey = False,
+                                                   gridspec_kw = {'height_ratios': height_ratios},
+                                                   figsize = (Plotter.WIDTH, Plotter.HEIGHT))
 
-        # set a title
-        fig.suptitle(self._title, fontsize=128)
-        
-        for i, route in enumerate(routes):
-            # draw a dark black line at 0
-            plts[i].plot([min_x, max_x], [0, 0], 'k', linewidth = 4.0, zorder=100)
+            # set a title
+            fig.suptitle(self._title, fontsize=128)
 
-            self.make_plot(plts[i], route)
+        return fig, plts
 
-        ouput = self.output_name()
-        matplotlib.pyplot.savefig(ouput)
+    def y_span(self, lows, highs):
+        '''The span of a route's y values, from the lowest and highest
+        value of each of our FIELDS (dicts by field). This assumes
+        y_value never goes down as a field goes up, so subclasses
+        where it does need to override this.'''
+        extremes = Columns(date = [0, 0], **{field: [lows[field], highs[field]] for field in self.FIELDS})
+        y_values = self.y_value(extremes)
+        return numpy.nan_to_num(numpy.fmax.reduce(y_values) - numpy.fmin.reduce(y_values))
 
-    ## Internal Functions ##
-        
-    def make_plot(self, ax, route):
-        # just Plot today
-        today = datetime.datetime.now()
+    def make_plot(self, ax, route, waypoints):
         # cycle through colors
         colors = itertools.cycle('bgrcmy')
         hatches = itertools.cycle('/\\|-+')
@@ -141,110 +348,167 @@ class Plotter:
         # add a title
         title = '%s %s' % (route.rId, route.name)
         print('title=%s' % title)
-        ax.set_title(title, loc = 'left')
+        with self.metrics.time('drawing'):
+            ax.set_title(title, loc = 'left')
 
-        
-        # find all the trips
-        trip_y_values = {}
-        for trip in route.trips:
-            for waypoint in self.waypoints(trip):
-                # Trips restart each day, so we'll need to include
-                #  the date as part of the key
-                key = '%s_%s_%s_%s%s%s' % (trip.tId, trip.runId, trip.name,
-                                           waypoint.date.year, waypoint.date.month, waypoint.date.day)
-                if self.in_date_range(waypoint.date):
-                    if key not in trip_y_values:
-                        trip_y_values[key] = {'x': [], 'y': [], 'color': next(colors)}
-                        
-                    trip_y_values[key]['x'].append(waypoint.date)
-                    trip_y_values[key]['y'].append(self.y_value(waypoint))
-
-        if len(trip_y_values) == 0:
+        with self.metrics.time('shaping'):
+            waypoints = waypoints[self.in_date_range(waypoints.dates())]
+        if len(waypoints) == 0:
             # skip
             return
-                    
-                    
-        flatten = lambda l: [item for sublist in l for item in sublist]
-                    
-        # find an overall min and max
-        all_y = flatten([x['y'] for x in trip_y_values.values()])
-        max_y = max(all_y)
-        min_y = min(all_y)
+
+        shaping_start = time.perf_counter()
+        ys = self.y_value(waypoints)
+
+        starts, ends = self.segment_trips(waypoints)
 
         # place colored bars along the bottom, showing the
-        #  start and end of each trip
-        bars = []
+        #  start and end of each trip. Trips are placed in
+        #  order of their start time.
+        layout_start = time.perf_counter()
+        order = numpy.argsort(waypoints.date[starts], kind = 'stable')
+        lanes = self.assign_lanes(waypoints.date[starts][order], waypoints.date[ends - 1][order])
+        print('  laid out %d trips in %d lanes in %.1fms' %
+              (len(order), lanes.max() + 1, (time.perf_counter() - layout_start) * 1000))
+
+        # colors go in trip order, hatches in start order
+        trip_colors = [next(colors) for i in range(len(starts))]
+        self.metrics.observe('shaping', time.perf_counter() - shaping_start)
+
+        for i, lane in zip(order.tolist(), lanes.tolist()):
+            s = starts[i]
+            e = ends[i]
+            self.draw_series(ax, waypoints.date[s:e], ys[s:e], lane, trip_colors[i], next(hatches))
+
+    def make_plot_stream(self, ax, route, loader):
+        '''Like make_plot, but reading the route's series one at a time
+        from a DataLoader, and drawing each as soon as it's read.'''
+        title = '%s %s' % (route.rId, route.name)
+        print('title=%s' % title)
+        with self.metrics.time('drawing'):
+            ax.set_title(title, loc = 'left')
+
+        # lay the bars out up front, from the first and
+        #  last date of each series
+        with self.metrics.time('query'):
+            series = loader.series(route.id)
+        if len(series) == 0:
+            return
+
+        shaping_start = time.perf_counter()
+        firsts = numpy.array([s[2] for s in series], dtype = 'int64')
+        lasts = numpy.array([s[3] for s in series], dtype = 'int64')
+        order = numpy.argsort(firsts, kind = 'stable')
+        lanes = numpy.empty(len(series), dtype = 'int64')
+        lanes[order] = self.assign_lanes(firsts[order], lasts[order])
+        print('  laid out %d trips in %d lanes' % (len(series), lanes.max() + 1))
+
+        # colors go in trip order, hatches in start order
+        #  (just like make_plot)
+        colors = 'bgrcmy'
+        hatches = '/\\|-+'
+        ranks = numpy.empty(len(series), dtype = 'int64')
+        ranks[order] = numpy.arange(len(series))
+        index = {(s[0], s[1]): i for i, s in enumerate(series)}
+        self.metrics.observe('shaping', time.perf_counter() - shaping_start)
+
+        waypoints = loader.stream(route.id)
+        while True:
+            with self.metrics.time('query'):
+                trip, day, w = next(waypoints, (None, None, None))
+            if w == None:
+                break
+
+            i = index.get((trip, day))
+            if i == None:
+                # written since we laid out the bars
+                continue
+
+            with self.metrics.time('shaping'):
+                ys = self.y_value(w)
+            self.draw_series(ax, w.date, ys, lanes[i], colors[i % len(colors)], hatches[ranks[i] % len(hatches)])
+
+    def draw_series(self, ax, dates, ys, lane, color, hatch):
+        '''Draw a single series (dates in seconds since the epoch), with
+        its bar along the bottom in `lane`.'''
         bar_size = 2.0
-        
-        # order our trips based on their start time
-        sorted_trips = sorted(trip_y_values.values(), key = lambda x: min(x['x']))
+        bar_idx = lane + 1
 
-        for y_value in sorted_trips:
-            bar_idx = self.find_bar_index(bars, y_value) + 1
-            hatch = next(hatches)
-            
+        # there's no point drawing more points than can be
+        #  told apart at our resolution
+        with self.metrics.time('shaping'):
+            keep = self._downsampler.downsample(dates, ys, self._x_span)
+            x = dates[keep].astype('datetime64[s]')
+            y = ys[keep]
+
+        with self.metrics.time('drawing'):
             # make the background fill
-            ax.fill_between(y_value['x'], -(bar_idx * bar_size), -((bar_idx + 1) * bar_size),
-                            color = y_value['color'],
+            ax.fill_between(x, -(bar_idx * bar_size), -((bar_idx + 1) * bar_size),
+                            color = color,
                             alpha = 0.3,
                             hatch = hatch)
             # make a line of the actual data
-            ax.plot(y_value['x'], y_value['y'], y_value['color'],
+            ax.plot(x, y, color,
                     linewidth = 3.0)
             # fill this line
-            ax.fill_between(y_value['x'], y_value['y'], 0,
-                            color = y_value['color'],
+            ax.fill_between(x, y, 0,
+                            color = color,
                             alpha = 0.3,
                             hatch = hatch)
 
-    def find_bar_index(self, bars, trip):
+    def segment_trips(self, waypoints):
+        '''Split waypoints (sorted by trip and date) into one series
+        per trip per service day, since trips restart each day.
+        Returns the start and end index of each series.'''
+        days = waypoints.date // (24 * 60 * 60)
+        breaks = numpy.flatnonzero((waypoints.trip[1:] != waypoints.trip[:-1]) |
+                                   (days[1:] != days[:-1])) + 1
+        starts = numpy.concatenate(([0], breaks))
+        ends = numpy.concatenate((breaks, [len(waypoints)]))
+
+        return starts, ends
+
+    def assign_lanes(self, starts, ends):
         '''
-        Find a y location for this bar based
-        on this trip.
+        Find a y location (lane) for the bar of each trip, given
+        their start and end times sorted by start time. Each trip
+        goes in the lowest lane that's free for its whole span.
+
+        Since trips come in order of their start, a lane is free
+        once the last trip placed in it has ended, so we sweep
+        through keeping a heap of busy lanes ordered by when they
+        free up, and a heap of free lanes ordered by index.
         '''
-        start = min(trip['x'])
-        end = max(trip['x'])
-
-        for idx, bar in enumerate(bars):
-            taken = False
-
-            for i in bar:
-                # Check to make sure our start and end points are not inside
-                #  any others. It IS possible for our start and end points
-                #  to be outside any single other bar, so we need to do a
-                #  reverse check too.
-                if ((start >= i[0] and start <= i[1]) or (end >=i[0] and end <= i[1])) or \
-                   ((i[0] >= start and i[0] <= end) or (i[1] >= start and i[1] <= end)):
-                    taken = True
-                    break
-                
-            if not taken:
-                # insert us
-                bars[idx].append((start, end))
-                return idx
-
-        # add a new index
-        bars.append([(start, end)])
-        
-        return (len(bars) - 1)
+        lanes = numpy.empty(len(starts), dtype = 'int64')
+        busy = []
+        free = []
+        count = 0
+
+        for i, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+            while len(busy) > 0 and busy[0][0] < start:
+                heapq.heappush(free, heapq.heappop(busy)[1])
+
+            if len(free) > 0:
+                lane = heapq.heappop(free)
+            else:
+                lane = count
+                count += 1
+
+            lanes[i] = lane
+            heapq.heappush(busy, (end, lane))
+
+        return lanes
 
-    def waypoints(self, trip):
-        '''Return all the waypoints of a trip within our date range.'''
-        if self._start_date != None and self._end_date != None:
-            return trip.waypoints.filter(WayPoint.date >= self._start_date, WayPoint.date <= self._end_date)
-        elif self._start_date != None:
-            return trip.waypoints.filter(WayPoint.date >= self._start_date)
-        elif self._end_date != None:
-            return trip.waypoints.filter(WayPoint.date <= self._end_date)
-        else:
-            return trip.waypoints
-    
     def in_date_range(self, d):
+        '''Return a mask of which dates (an array of datetime64s)
+        fall within our date range. Note that this only compares
+        the day of the month.'''
+        day = (d.astype('datetime64[D]') - d.astype('datetime64[M]')).astype('int64') + 1
         if self._start_date != None and self._end_date != None:
-            return d.day >= self._start_date.day and d.day <= self._end_date.day
+            return (day >= self._start_date.day) & (day <= self._end_date.day)
         elif self._start_date != None:
-            return d.day >= self._start_date.day
+            return day >= self._start_date.day
         elif self._end_date != None:
-            return d.day <= self._end_date.day
+            return day <= self._end_date.day
         else:
-            return True
+            return numpy.ones(len(d), dtype = bool)
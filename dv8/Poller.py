@@ -34,9 +34,17 @@ import time
 import datetime
 
 import sqlalchemy
-import requests
 
-from dv8.Database import Base, Route, Trip, WayPoint
+from dv8.Database import Point, DayMark, VehicleState, create_engine, create_schema, epoch
+from dv8.IdentityCache import IdentityCache
+from dv8.Feed import Feed
+from dv8.Grid import Grid
+from dv8.Metrics import Metrics
+from dv8.Transport import Transport
+from dv8.Cadence import Cadence
+from dv8.SnapshotLog import SnapshotLog
+from dv8.IngestQueue import IngestQueue
+from dv8.Rollup import Rollup
 
 class Poller:
     '''Simple class to make an HTTP request
@@ -44,101 +52,351 @@ class Poller:
 
     URL = 'https://realtimebjcta.availtec.com/InfoPoint/rest/Routes/GetAllRoutes'
     SLEEP = 30 # in seconds
+    IGNORED_ROUTES = Feed.IGNORED_ROUTES
+    # readings that match on all of these are considered unchanged
+    DEDUP_FIELDS = ('latitude', 'longitude', 'deviation', 'opStatus',
+                    'onBoard', 'direction', 'driver')
     
-    def __init__(self):
-        #!mwd - TODO: don't hardcode this database
-        engine = sqlalchemy.create_engine("sqlite:///poller.db")
-        Base.metadata.create_all(engine)
+    def __init__(self, write_behind = False, dedup = False, rollup = False,
+                 url = URL, database = 'poller.db', metrics_port = None, stats_log = None,
+                 adaptive = False, timeout = Transport.TIMEOUT, snapshot_log = None):
+        self._url = url
+        self._transport = Transport(timeout = timeout)
+        # follow the feed's own update cadence, instead of
+        #  polling every SLEEP seconds
+        self._adaptive = adaptive
+        # optionally keep every raw response, see dv8.Replayer
+        self._snapshots = None
+        if snapshot_log != None:
+            self._snapshots = SnapshotLog(snapshot_log)
 
-        Session = sqlalchemy.orm.sessionmaker(bind = engine)
+        # how long each stage takes, and what we've done
+        self.metrics = Metrics(stats_log)
+        if metrics_port != None:
+            self.metrics.serve(metrics_port)
+
+        engine = create_engine(database)
+        create_schema(engine)
+
+        # don't expire on commit, otherwise every cached route
+        #  and trip would be reloaded on its next use
+        Session = sqlalchemy.orm.sessionmaker(bind = engine, expire_on_commit = False)
         self._session = Session()
 
+        self._cache = IdentityCache(self._session)
+        # end the transaction the cache was loaded in, so we don't
+        #  hang on to a connection from this thread
+        self._session.commit()
+
+        # the last reading of each trip, when deduplicating
+        self._dedup = dedup
+        self._last_readings = {}
+
+        # optionally keep the hourly rollups up to date
+        #  (see dv8.Rollup for why not with dedup)
+        if rollup and dedup:
+            raise Exception('Rollups count every reading, so they can\'t be kept with dedup')
+        self._rollup = None
+        if rollup:
+            self._rollup = Rollup(self._session)
+
+        # optionally hand snapshots off to a writer thread
+        self._queue = None
+        if write_behind:
+            self._queue = IngestQueue(self.ingest_batch)
+            self._queue.start()
+
         # all ready
 
     def go(self):
+        cadence = Cadence() if self._adaptive else None
+
         while True:
+            start = time.perf_counter()
             try:
                 print('Requesting...')
-                r = requests.get(Poller.URL, headers = {'content-type': 'application/json'})
-
-                # get the json
-                data = r.json()
+                with self.metrics.time('fetch'):
+                    r = self._transport.fetch(self._url)
 
                 now = datetime.datetime.now()
-                
-                # iterate
-                for route_info in data:
-                    # if we don't know about this route yet
-                    #  then create it.
-                    route = self.get_or_create_route(route_info)
-                    
-                    if route == None:
-                        # We ignore some routes
-                        continue
-
-                    for vehicle_info in route_info['Vehicles']:
-                        self.add_waypoint(route, vehicle_info, now)
-
-                # commit our changes
-                self._session.commit()
-                
+
+                # get the json, unless nothing has changed
+                data = None
+                if r != None:
+                    self.log('default', r.content, now)
+                    with self.metrics.time('decode'):
+                        data = r.json()
             except Exception as e:
                 print('Error: %s' % e, file = sys.stderr)
+                self.metrics.count('errors', stage = 'fetch', type = type(e).__name__)
+            else:
+                if cadence != None:
+                    cadence.observe(data)
+
+                if data == None:
+                    print('Unchanged')
+                    self.metrics.count('unchanged')
+                else:
+                    try:
+                        self.submit(data, now)
+                    except Exception as e:
+                        # ingest_batch has already counted this
+                        print('Error: %s' % e, file = sys.stderr)
+
+            self.metrics.observe('cycle', time.perf_counter() - start)
+            self.metrics.tick()
 
             # sleep
-            time.sleep(Poller.SLEEP)
+            delay = self.delay(self._url, cadence, Poller.SLEEP)
+            time.sleep(delay if delay != None else Poller.SLEEP)
+
+    def log(self, feed, body, now):
+        '''Append a raw response to the snapshot log, if we're keeping one.'''
+        if self._snapshots == None:
+            return
 
-    def get_or_create_route(self, route_info):
         try:
-            #!mwd Route 999 and 80 is some fake thing,
-            #  skip it.
-            if route_info.get('RouteId') in (80, 999):
-                return None
-            
-            return self._session.query(Route).filter(Route.rId == str(route_info["RouteId"])).one()
-        except sqlalchemy.orm.exc.NoResultFound:
-            print('Creating new route: %s' % route_info['RouteId'])
-            # create one
-            route = Route(rId = str(route_info["RouteId"]),
-                          name = route_info["LongName"])
-            self._session.add(route)
-
-            return route
+            with self.metrics.time('log'):
+                self._snapshots.append(feed, body, now)
+        except Exception as e:
+            # we can still record it
+            print('Error: logging snapshot: %s' % e, file = sys.stderr)
+            self.metrics.count('errors', stage = 'log', type = type(e).__name__)
 
-    def get_or_create_trip(self, route, vehicle_info):
+    def delay(self, url, cadence, interval):
+        '''How long to wait before polling `url` again, if it's
+        failing or we know its cadence, otherwise None.'''
+        delay = self._transport.backoff(url, interval)
+        if delay != None:
+            print('%s: backing off for %.1fs' % (url, delay), file = sys.stderr)
+            return delay
+
+        if cadence != None:
+            return cadence.delay()
+
+        return None
+
+    def submit(self, data, now):
+        '''Record a GetAllRoutes response, either right away or,
+        in write behind mode, by queueing it for the writer thread.'''
+        if self._queue != None:
+            self._queue.put(data, now)
+        else:
+            self.ingest(data, now)
+
+    def ingest(self, data, now):
+        '''Record one GetAllRoutes response.'''
+        return self.ingest_batch([(data, now)])
+
+    def ingest_batch(self, snapshots):
+        '''Record a list of (GetAllRoutes response, time) snapshots
+        in a single transaction.'''
+        created = (self._cache.created_routes, self._cache.created_trips)
         try:
-            return self._session.query(Trip).filter(sqlalchemy.and_(Trip.tId == str(vehicle_info["TripId"]),
-                                                                    Trip.runId == str(vehicle_info["RunId"]),
-                                                                    Trip.route_id == route.id)).one()
-        except sqlalchemy.orm.exc.NoResultFound:
-            print('Creating new trip: %s' % vehicle_info['TripId'])
+            with self.metrics.time('resolve'):
+                rows = []
+                for data, now in snapshots:
+                    rows.extend(self.waypoint_rows(data, now))
+                readings = rows
 
-            trip = Trip(tId = str(vehicle_info['TripId']),
-                        name = vehicle_info['Name'],
-                        runId = str(vehicle_info['RunId']))
-            route.trips.append(trip)
+                extended = []
+                if self._dedup:
+                    rows, extended = self.dedup(rows)
 
-            self._session.add(trip)
-            self._session.add(route)
+            start = time.perf_counter()
+            with self.metrics.time('insert'):
+                self.add_waypoints(rows)
+                self.extend_waypoints(extended)
+                self.update_vehicle_state(readings)
 
-            return trip
+                # let any caches know these days have changed
+                days = set(row['date'].date() for row in rows)
+                for update in extended:
+                    # a run now covers every day up to its valid_until
+                    day = update['b_date'].date()
+                    while day <= update['b_valid_until'].date():
+                        days.add(day)
+                        day += datetime.timedelta(days = 1)
+                DayMark.bump(self._session, days)
+
+            # commit our changes
+            with self.metrics.time('commit'):
+                self._session.commit()
+        except:
+            self.metrics.count('errors', stage = 'ingest', type = sys.exc_info()[0].__name__)
+            # anything we created in this transaction is gone, so
+            #  the cache can't be trusted anymore either
+            self._session.rollback()
+            self._cache.load()
+            self._session.commit()
+            self._last_readings.clear()
+            raise
+
+        self.metrics.count('snapshots', len(snapshots))
+        self.metrics.count('rows_written', len(rows))
+        self.metrics.count('rows_extended', len(extended))
+        self.metrics.count('new_routes', self._cache.created_routes - created[0])
+        self.metrics.count('new_trips', self._cache.created_trips - created[1])
+
+        elapsed = time.perf_counter() - start
+        if elapsed > 0:
+            print('Inserted %d waypoints in %.3fs (%.0f rows/sec)' % (len(rows), elapsed, len(rows) / elapsed))
+        if len(extended) > 0:
+            print('Extended %d unchanged waypoints' % len(extended))
+
+        if self._rollup != None:
+            try:
+                with self.metrics.time('rollup'):
+                    self._rollup.update()
+            except Exception as e:
+                # the waypoints are safe, the rollups
+                #  will catch up next time
+                self._session.rollback()
+                print('Error: updating rollups: %s' % e, file = sys.stderr)
+                self.metrics.count('errors', stage = 'rollup', type = type(e).__name__)
+
+        self.metrics.tick()
+
+        return len(rows)
+
+    def dedup(self, rows):
+        '''Split waypoint rows into those that need inserting, and
+        those that are just a repeat of their trip's last reading.
+        For the repeats, return the updates that extend the
+        `valid_until` of that last reading instead. Readings older
+        than their trip's last one are always inserted.'''
+        inserts = []
+        pending = {}
+        extended = {}
+
+        for row in rows:
+            trip_id = row['trip_id']
+            reading = tuple(row[field] for field in Poller.DEDUP_FIELDS)
+            last = self._last_readings.get(trip_id)
+
+            if last != None and row['date'] < last[0]:
+                # a late snapshot (recovered from a spill, say), which
+                #  can't extend a run that's newer than it
+                row['valid_until'] = None
+                inserts.append(row)
+                continue
+
+            if last != None and last[1] == reading and row['date'] - last[0] <= Point.MAX_RUN:
+                if trip_id in pending:
+                    # the reading we're repeating is in this same batch
+                    pending[trip_id]['valid_until'] = row['date']
+                else:
+                    extended[trip_id] = {'b_trip_id': trip_id, 'b_date': last[0], 'b_valid_until': row['date']}
+            else:
+                row['valid_until'] = None
+                inserts.append(row)
+                pending[trip_id] = row
+                self._last_readings[trip_id] = (row['date'], reading)
+
+        # forget about trips that haven't reported in a while
+        if len(rows) > 0:
+            cutoff = rows[-1]['date'] - Point.MAX_RUN
+            self._last_readings = {trip_id: last for trip_id, last in self._last_readings.items()
+                                   if last[0] >= cutoff}
+
+        return inserts, list(extended.values())
+
+    def waypoint_rows(self, data, now):
+        '''Resolve the routes and trips of a GetAllRoutes response,
+        and return a waypoint row for each vehicle.'''
+        # We ignore some routes
+        data = [route_info for route_info in data
+                if route_info.get('RouteId') not in Poller.IGNORED_ROUTES]
+
+        # if we don't know about any of these routes or trips
+        #  yet, then look them up or create them in one go.
+        self._cache.prefetch(data, now)
+        # new trips need an id before we can insert waypoints
+        #  that point to them
+        self._session.flush()
+
+        # iterate
+        rows = []
+        for route_info in data:
+            route = self.get_or_create_route(route_info)
+
+            self.metrics.count('vehicles', len(route_info['Vehicles']))
+            for vehicle_info in route_info['Vehicles']:
+                trip = self.get_or_create_trip(route, vehicle_info)
+                if trip:
+                    rows.append(self.waypoint_row(trip, vehicle_info, now))
+
+        return rows
+
+    def get_or_create_route(self, route_info):
+        if route_info.get('RouteId') in Poller.IGNORED_ROUTES:
+            return None
+
+        return self._cache.get_or_create_route(route_info)
+
+    def get_or_create_trip(self, route, vehicle_info):
+        return self._cache.get_or_create_trip(route, vehicle_info)
         
-    def add_waypoint(self, route, vehicle_info, now):
-        trip = self.get_or_create_trip(route, vehicle_info)
-        if trip:
-            waypoint = WayPoint(date = now,
-                                latitude = float(vehicle_info['Latitude']),
-                                longitude = float(vehicle_info['Longitude']),
-                                deviation = int(vehicle_info['Deviation']),
-                                opStatus = vehicle_info['OpStatus'],
-                                onBoard = int(vehicle_info['OnBoard']),
-                                direction = vehicle_info['Direction'],
-                                driver = vehicle_info['DriverName'])
-
-            trip.waypoints.append(waypoint)
-
-            self._session.add(trip)
-            self._session.add(waypoint)
+    def waypoint_row(self, trip, vehicle_info, now):
+        '''Turn a vehicle from the feed into a row for the
+        waypoints table.'''
+        return {'date': now,
+                'latitude': float(vehicle_info['Latitude']),
+                'longitude': float(vehicle_info['Longitude']),
+                'deviation': int(vehicle_info['Deviation']),
+                'opStatus': vehicle_info['OpStatus'],
+                'onBoard': int(vehicle_info['OnBoard']),
+                'direction': vehicle_info['Direction'],
+                'driver': vehicle_info['DriverName'],
+                'trip_id': trip.id}
+
+    def point_row(self, row):
+        '''Turn a waypoint row into a row for the (compact)
+        points table.'''
+        latitude = round(row['latitude'] * Point.SCALE)
+        longitude = round(row['longitude'] * Point.SCALE)
+        return {'time': epoch(row['date']),
+                'valid_until': None if row.get('valid_until') == None else epoch(row['valid_until']),
+                'latitude': latitude,
+                'longitude': longitude,
+                'cell': Grid.cell(latitude, longitude),
+                'deviation': row['deviation'],
+                'onBoard': row['onBoard'],
+                'opStatus_id': self._cache.label_id(row['opStatus']),
+                'direction_id': self._cache.label_id(row['direction']),
+                'driver_id': self._cache.label_id(row['driver']),
+                'trip_id': row['trip_id']}
+
+    def add_waypoints(self, rows):
+        '''Insert a batch of waypoint rows with a single executemany,
+        skipping the ORM's per object bookkeeping.'''
+        if len(rows) > 0:
+            self._session.execute(Point.__table__.insert(), [self.point_row(row) for row in rows])
+
+    def update_vehicle_state(self, rows):
+        '''Record the latest of a batch of waypoint rows for each
+        trip in vehicle_state, and expire the trips that have ended.'''
+        if len(rows) == 0:
+            return
+
+        latest = {}
+        for row in rows:
+            latest[row['trip_id']] = row
+
+        VehicleState.upsert(self._session, [self.point_row(row) for row in latest.values()])
+        VehicleState.expire(self._session, max(row['date'] for row in rows))
+
+    def extend_waypoints(self, updates):
+        '''Push forward the `valid_until` of existing waypoints.'''
+        if len(updates) > 0:
+            table = Point.__table__
+            self._session.execute(table.update().
+                                  where(sqlalchemy.and_(table.c.trip_id == sqlalchemy.bindparam('b_trip_id'),
+                                                        table.c.time == sqlalchemy.bindparam('b_time'))).
+                                  values(valid_until = sqlalchemy.bindparam('b_valid_until')),
+                                  [{'b_trip_id': u['b_trip_id'],
+                                    'b_time': epoch(u['b_date']),
+                                    'b_valid_until': epoch(u['b_valid_until'])} for u in updates])
 
 if __name__ == '__main__':
     poller = Poller()
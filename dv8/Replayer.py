@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+#
+
+##################################################
+# DV8 (c) Marcus Dillavou <line72@line72.net
+#  https://github.com/line72/dv8
+##################################################
+
+# MIT License
+#
+# Copyright (c) 2017 Marcus Dillavou <line72@line72.net>
+# https://github.com/line72/dv8
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import sys
+import json
+import time
+import datetime
+import collections
+import concurrent.futures
+
+import sqlalchemy
+
+from dv8.Database import DayMark, create_engine, epoch
+from dv8.Poller import Poller
+from dv8.Feed import Feed
+from dv8.Archive import Archive
+from dv8.Rollup import Rollup
+from dv8.SnapshotLog import SnapshotLog
+
+# the parts of a response the poller uses
+ROUTE_FIELDS = ('RouteId', 'LongName')
+VEHICLE_FIELDS = ('TripId', 'RunId', 'Name', 'Latitude', 'Longitude', 'Deviation',
+                  'OpStatus', 'OnBoard', 'Direction', 'DriverName')
+
+def load_snapshots(chunk):
+    '''Worker process entry point for Replayer.go. Reads, decompresses
+    and decodes a chunk of (feed, path, time, offset, length) log
+    entries, and returns them as (data, now) snapshots, trimmed down
+    to what the poller needs so there's less to send back.'''
+    snapshots = []
+    errors = 0
+    files = {}
+    try:
+        for feed, path, t, offset, length in chunk:
+            if path not in files:
+                files[path] = open(path, 'rb')
+
+            try:
+                data = json.loads(SnapshotLog.read(files[path], offset, length))
+            except Exception as e:
+                print('Error: %s at %s: %s' % (path, offset, e), file = sys.stderr)
+                errors += 1
+                continue
+
+            data = [dict({field: route_info.get(field) for field in ROUTE_FIELDS},
+                         Vehicles = [{field: vehicle_info.get(field) for field in VEHICLE_FIELDS}
+                                     for vehicle_info in route_info.get('Vehicles') or []])
+                    for route_info in data]
+
+            # (this drops the ignored routes too, just like polling)
+            snapshots.append((Replayer.feed(feed).rewrite(data), SnapshotLog.time(t)))
+    finally:
+        for f in files.values():
+            f.close()
+
+    return snapshots, errors
+
+class Replayer:
+    '''Re-ingests a time range of a snapshot log (see dv8.SnapshotLog)
+    as fast as we can, to rebuild or backfill a database.
+
+    Responses from every feed are merged in time order and split into
+    chunks, which a pool of worker processes decompress and decode,
+    while this process records each chunk in a single transaction
+    through the poller's bulk path (so day marks, dedup and rollups
+    work just like they do when polling). Only a few chunks are in
+    flight at a time, so memory use doesn't grow with the range.'''
+
+    BATCH = 100 # snapshots per chunk and transaction
+
+    def __init__(self, directory = SnapshotLog.DIRECTORY, database = 'poller.db',
+                 jobs = None, dedup = False, rollup = False, archive = Archive.DIRECTORY):
+        self._log = SnapshotLog(directory)
+        self._archive = Archive(archive)
+        self._engine = create_engine(database)
+        self._jobs = jobs if jobs != None else os.cpu_count()
+        self._poller = Poller(dedup = dedup, rollup = rollup, database = database)
+
+    @staticmethod
+    def feed(name):
+        '''The feed a log directory is from. Like start_poller,
+        the default feed's route ids aren't prefixed.'''
+        return Feed(name, None, prefix = None if name == 'default' else name)
+
+    def entries(self, start = None, end = None):
+        '''Every log entry from `start` up to `end`, from all feeds,
+        as a list of (feed, path, time, offset, length), in time order.'''
+        entries = []
+        for feed in self._log.feeds():
+            for path, records in self._log.entries(feed, start, end):
+                entries.extend((feed, path, int(r['time']), int(r['offset']), int(r['length']))
+                               for r in records)
+
+        entries.sort(key = lambda e: e[2])
+        return entries
+
+    def replace(self, start, end):
+        '''Delete the waypoints already recorded from `start` up
+        to `end`, in the database and the archive, so replaying them
+        doesn't duplicate them, and recount the rollups for those
+        hours.'''
+        archived = self._archive.remove(start, end)
+
+        session = sqlalchemy.orm.Session(bind = self._engine)
+        days = [d for (d,) in session.execute(sqlalchemy.text(
+            "SELECT DISTINCT date(time, 'unixepoch') FROM points WHERE time >= :start AND time < :end"),
+            {'start': epoch(start), 'end': epoch(end)})]
+        deleted = session.execute(sqlalchemy.text(
+            'DELETE FROM points WHERE time >= :start AND time < :end'),
+            {'start': epoch(start), 'end': epoch(end)}).rowcount
+        Rollup(session).rebuild(start, end, self._archive)
+        DayMark.bump(session, set([datetime.datetime.strptime(d, '%Y-%m-%d').date() for d in days] + archived))
+        session.commit()
+        session.close()
+        print('Deleted %d waypoints' % deleted)
+        if len(archived) > 0:
+            print('Removed the range from %d archived days' % len(archived))
+
+    def go(self, start = None, end = None, replace = False):
+        '''Replay the log from `start` up to `end` (naive datetimes,
+        either can be None). With `replace`, whatever was already
+        recorded in that range is deleted first. Returns the number
+        of waypoints written.'''
+        entries = self.entries(start, end)
+        if len(entries) == 0:
+            print('No snapshots found in this date range!')
+            return 0
+
+        if replace:
+            self.replace(start if start != None else SnapshotLog.time(entries[0][2]),
+                         end if end != None else SnapshotLog.time(entries[-1][2] + 1000000))
+
+        chunks = [entries[i:i + Replayer.BATCH] for i in range(0, len(entries), Replayer.BATCH)]
+        print('Replaying %d snapshots from %s to %s' % (len(entries),
+                                                         SnapshotLog.time(entries[0][2]),
+                                                         SnapshotLog.time(entries[-1][2])))
+
+        begin = time.perf_counter()
+        total = 0
+        errors = 0
+        with concurrent.futures.ProcessPoolExecutor(max_workers = self._jobs) as pool:
+            pending = collections.deque()
+            chunks = iter(chunks)
+            while True:
+                # keep every worker busy, with one chunk queued up
+                #  behind each, but no more
+                while len(pending) < self._jobs * 2:
+                    chunk = next(chunks, None)
+                    if chunk == None:
+                        break
+                    pending.append(pool.submit(load_snapshots, chunk))
+
+                if len(pending) == 0:
+                    break
+
+                snapshots, failed = pending.popleft().result()
+                errors += failed
+                if len(snapshots) > 0:
+                    total += self._poller.ingest_batch(snapshots)
+
+        elapsed = time.perf_counter() - begin
+        print('Replayed %d waypoints in %.1fs (%.0f rows/sec)' % (total, elapsed, total / elapsed))
+        if errors > 0:
+            print('Skipped %d snapshots that couldn\'t be read' % errors, file = sys.stderr)
+
+        return total
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+#
+
+##################################################
+# DV8 (c) Marcus Dillavou <line72@line72.net
+#  https://github.com/line72/dv8
+##################################################
+
+# MIT License
+#
+# Copyright (c) 2017 Marcus Dillavou <line72@line72.net>
+# https://github.com/line72/dv8
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import datetime
+
+from dv8.Database import Route, RouteHour
+
+class Report:
+    '''Answers questions about on time performance and ridership
+    using only the route_hours rollups, so it never has to touch
+    the raw waypoints.'''
+
+    GROUPS = ('hour', 'hour-of-day', 'day', 'route')
+    FIELDS = ('route', 'direction', 'period', 'count', 'on_time_pct',
+              'mean_deviation', 'min_deviation', 'max_deviation',
+              'p50_deviation', 'p90_deviation', 'mean_onBoard', 'max_onBoard')
+
+    def __init__(self, session, start_date = None, end_date = None,
+                 routes = None, group = 'hour', by_direction = False):
+        if group not in Report.GROUPS:
+            raise Exception('Invalid group: %s. Please use one of %s' % (group, ', '.join(Report.GROUPS)))
+
+        self._session = session
+        self._start_date = start_date
+        self._end_date = end_date
+        self._routes = routes
+        self._group = group
+        self._by_direction = by_direction
+
+    def rows(self):
+        '''Return a dict for each (route, direction, period), with
+        the keys in Report.FIELDS.'''
+        query = self._session.query(Route.rId, RouteHour).join(RouteHour, RouteHour.route_id == Route.id)
+
+        if self._start_date != None:
+            query = query.filter(RouteHour.hour >= self._start_date)
+        if self._end_date != None:
+            # the end date is inclusive
+            query = query.filter(RouteHour.hour < self._end_date + datetime.timedelta(days = 1))
+        if self._routes != None and len(self._routes) > 0:
+            query = query.filter(Route.rId.in_(self._routes))
+
+        groups = {}
+        for rId, hour in query:
+            key = (rId, hour.direction if self._by_direction else '', self.period(hour.hour))
+            group = groups.get(key)
+            if group == None:
+                group = groups[key] = {'count': 0, 'deviation_sum': 0, 'on_time': 0,
+                                       'deviation_min': None, 'deviation_max': None,
+                                       'onBoard_sum': 0, 'onBoard_max': 0, 'histogram': {}}
+
+            group['count'] += hour.count
+            group['deviation_sum'] += hour.deviation_sum
+            group['on_time'] += hour.on_time
+            group['onBoard_sum'] += hour.onBoard_sum
+            group['onBoard_max'] = max(group['onBoard_max'], hour.onBoard_max)
+            if group['deviation_min'] == None or hour.deviation_min < group['deviation_min']:
+                group['deviation_min'] = hour.deviation_min
+            if group['deviation_max'] == None or hour.deviation_max > group['deviation_max']:
+                group['deviation_max'] = hour.deviation_max
+
+            for deviation, count in json.loads(hour.histogram).items():
+                group['histogram'][int(deviation)] = group['histogram'].get(int(deviation), 0) + count
+
+        rows = []
+        for (rId, direction, period), group in sorted(groups.items(), key = lambda x: self.sort_key(x[0])):
+            count = group['count']
+            rows.append({'route': rId,
+                         'direction': direction,
+                         'period': period,
+                         'count': count,
+                         'on_time_pct': round(100.0 * group['on_time'] / count, 2),
+                         'mean_deviation': round(group['deviation_sum'] / count, 2),
+                         'min_deviation': group['deviation_min'],
+                         'max_deviation': group['deviation_max'],
+                         'p50_deviation': self.percentile(group['histogram'], count, 50),
+                         'p90_deviation': self.percentile(group['histogram'], count, 90),
+                         'mean_onBoard': round(group['onBoard_sum'] / count, 2),
+                         'max_onBoard': group['onBoard_max']})
+
+        return rows
+
+    def period(self, hour):
+        if self._group == 'hour':
+            return hour.strftime('%Y-%m-%d %H:00')
+        elif self._group == 'hour-of-day':
+            return hour.strftime('%H:00')
+        elif self._group == 'day':
+            return hour.strftime('%Y-%m-%d')
+        else:
+            return ''
+
+    def sort_key(self, key):
+        # sort route ids numerically where we can
+        rId, direction, period = key
+        return (0, int(rId), '') if rId.isdigit() else (1, 0, rId), direction, period
+
+    def percentile(self, histogram, count, p):
+        '''The smallest deviation that at least p% of the readings
+        are at or below.'''
+        target = count * p / 100.0
+        seen = 0
+        for deviation in sorted(histogram.keys()):
+            seen += histogram[deviation]
+            if seen >= target:
+                return deviation
+
+        return None
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+#
+
+##################################################
+# DV8 (c) Marcus Dillavou <line72@line72.net
+#  https://github.com/line72/dv8
+##################################################
+
+# MIT License
+#
+# Copyright (c) 2017 Marcus Dillavou <line72@line72.net>
+# https://github.com/line72/dv8
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import datetime
+
+import sqlalchemy
+
+from dv8.Database import Trip, Point, Label, RouteHour, RollupState, epoch
+
+class Rollup:
+    '''Keeps the route_hours table up to date.
+
+    Only waypoints newer than the last one processed (the high water
+    mark in rollup_state) are looked at, and they're aggregated by
+    sqlite before being merged into the existing hourly rows. The
+    merge and the new high water mark are committed together.
+
+    Rollups can't be kept for a deduplicating poller's waypoints: a
+    run of identical readings is stored as one row, which keeps being
+    extended after we've counted it, so the counts, on time share and
+    means would no longer match the readings.'''
+
+    NAME = 'route_hours'
+    CHUNK = 500000 # waypoints per transaction
+    # a bus is on time if it's no more than 1 minute
+    #  early or 5 minutes late
+    ON_TIME = (-1, 5)
+
+    def __init__(self, session):
+        self._session = session
+
+    def update(self):
+        '''Process every new waypoint. Returns how many were counted
+        (waypoints without a deviation aren't).'''
+        total = 0
+        while True:
+            count = self.update_chunk()
+            if count == None:
+                return total
+            total += count
+
+    def update_chunk(self):
+        '''Process the next chunk of new waypoints. Returns how many
+        were counted, or None once there are no new ones left.'''
+        state = self._session.query(RollupState).get(Rollup.NAME)
+        if state == None:
+            state = RollupState(name = Rollup.NAME, waypoint_id = 0)
+            self._session.add(state)
+
+        last_id = self._session.query(sqlalchemy.func.max(Point.id)).scalar()
+        if last_id == None or last_id <= state.waypoint_id:
+            self._session.commit()
+            return None
+
+        start = state.waypoint_id
+        end = min(last_id, start + Rollup.CHUNK)
+
+        runs = self._session.query(Point.id).filter(Point.id > start, Point.id <= end,
+                                                    Point.valid_until != None).first()
+        if runs != None:
+            self._session.rollback()
+            raise Exception('Waypoint %d is a deduplicated run, rollups can\'t count those' % runs[0])
+
+        count = self.merge(self.groups(Point.id > start, Point.id <= end))
+
+        state.waypoint_id = end
+        self._session.commit()
+
+        return count
+
+    def rebuild(self, start, end, archive = None):
+        '''Recount every hour touching `start` up to `end` from the
+        waypoints the rollup has already seen (and those in `archive`,
+        a dv8.Archive), after waypoints in that range were deleted.
+        Doesn't commit.'''
+        state = self._session.query(RollupState).get(Rollup.NAME)
+        if state == None:
+            return
+
+        first = start.replace(minute = 0, second = 0, microsecond = 0)
+        last = end.replace(minute = 0, second = 0, microsecond = 0)
+        if last < end:
+            last += datetime.timedelta(hours = 1)
+
+        self._session.query(RouteHour).filter(RouteHour.hour >= first,
+                                              RouteHour.hour < last).delete()
+        self._session.flush()
+
+        groups = self.groups(Point.time >= epoch(first), Point.time < epoch(last),
+                             Point.id <= state.waypoint_id)
+        if archive != None:
+            groups += archive.groups(first, last)
+        self.merge(groups)
+
+    def groups(self, *criteria):
+        '''Aggregate the waypoints matching `criteria` into
+        (route_id, hour, direction, deviation, count, onBoard_sum,
+        onBoard_max) groups.'''
+        hour = sqlalchemy.func.strftime('%Y-%m-%d %H:00:00', Point.time, 'unixepoch')
+        return self._session.query(Trip.route_id,
+                                   hour,
+                                   Label.value,
+                                   Point.deviation,
+                                   sqlalchemy.func.count(),
+                                   sqlalchemy.func.sum(Point.onBoard),
+                                   sqlalchemy.func.max(Point.onBoard)).\
+            join(Trip, Point.trip_id == Trip.id).\
+            outerjoin(Label, Point.direction_id == Label.id).\
+            filter(*criteria).\
+            group_by(Trip.route_id, hour, Point.direction_id, Point.deviation).all()
+
+    def merge(self, groups):
+        '''Add aggregated groups into the hourly rows. Returns how
+        many waypoints were added.'''
+        rows = self.existing_rows(groups)
+        histograms = {}
+        total = 0
+        for route_id, h, direction, deviation, count, onBoard_sum, onBoard_max in groups:
+            if deviation == None:
+                continue
+
+            key = (route_id, h, direction)
+            row = rows.get(key)
+            if row == None:
+                row = RouteHour(route_id = route_id,
+                                hour = datetime.datetime.strptime(h, '%Y-%m-%d %H:%M:%S'),
+                                direction = direction,
+                                count = 0, deviation_sum = 0, on_time = 0,
+                                onBoard_sum = 0, onBoard_max = 0,
+                                histogram = '{}')
+                self._session.add(row)
+                rows[key] = row
+
+            row.count += count
+            total += count
+            row.deviation_sum += deviation * count
+            row.deviation_min = deviation if row.deviation_min == None else min(row.deviation_min, deviation)
+            row.deviation_max = deviation if row.deviation_max == None else max(row.deviation_max, deviation)
+            if deviation >= Rollup.ON_TIME[0] and deviation <= Rollup.ON_TIME[1]:
+                row.on_time += count
+            row.onBoard_sum += onBoard_sum or 0
+            row.onBoard_max = max(row.onBoard_max, onBoard_max or 0)
+
+            if key not in histograms:
+                histograms[key] = json.loads(row.histogram)
+            histogram = histograms[key]
+            histogram[str(deviation)] = histogram.get(str(deviation), 0) + count
+
+        for key, histogram in histograms.items():
+            rows[key].histogram = json.dumps(histogram, sort_keys = True)
+
+        return total
+
+    def existing_rows(self, groups):
+        '''Load the hourly rows that the aggregated groups will be
+        merged into, keyed by (route_id, hour, direction).'''
+        if len(groups) == 0:
+            return {}
+
+        hours = [g[1] for g in groups]
+        first = datetime.datetime.strptime(min(hours), '%Y-%m-%d %H:%M:%S')
+        last = datetime.datetime.strptime(max(hours), '%Y-%m-%d %H:%M:%S')
+
+        rows = {}
+        for row in self._session.query(RouteHour).filter(RouteHour.hour >= first,
+                                                         RouteHour.hour <= last):
+            rows[(row.route_id, row.hour.strftime('%Y-%m-%d %H:%M:%S'), row.direction)] = row
+
+        return rows
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+#
+
+##################################################
+# DV8 (c) Marcus Dillavou <line72@line72.net
+#  https://github.com/line72/dv8
+##################################################
+
+# MIT License
+#
+# Copyright (c) 2017 Marcus Dillavou <line72@line72.net>
+# https://github.com/line72/dv8
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import datetime
+
+import numpy
+
+from dv8.Database import DayMark
+from dv8.DataLoader import DataLoader, Columns
+
+class SeriesCache:
+    '''An on disk cache of each day's waypoints, prepared for
+    plotting, so regenerating a graph only has to query the days that
+    have changed.
+
+    There's one file per metric (the fields a plotter needs) and
+    service day, holding the date, route, trip and metric columns of
+    every route, sorted by route, trip and date. When only one route
+    is wanted (like by the workers of a parallel plot), that route
+    gets a file of its own, so it never has to read everyone else's. Each is stamped with
+    the day's version from the day_marks table, and is thrown away
+    once that changes. Only days that are over, and have a day mark,
+    are cached. Once the cache grows past its size limit, the least
+    recently used files are deleted.'''
+
+    DIRECTORY = '.dv8cache'
+    MAX_SIZE = 1024 * 1024 * 1024 # in bytes
+
+    def __init__(self, session, fields, directory = DIRECTORY, max_size = MAX_SIZE):
+        self._session = session
+        self._fields = ('date', 'route', 'trip') + tuple(f for f in fields if f not in ('date', 'route', 'trip'))
+        self._directory = directory
+        self._max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, start_date, end_date, route_id = None):
+        '''Load the waypoints between two datetimes (inclusive), using
+        the cache for every whole day in between. The result is
+        sorted by route, trip and date, just like DataLoader's.'''
+        if end_date == None:
+            end_date = datetime.datetime.combine(datetime.date.today(), datetime.time.max)
+
+        marks = dict(self._session.query(DayMark.day, DayMark.version).
+                     filter(DayMark.day >= start_date.date().isoformat(),
+                            DayMark.day <= end_date.date().isoformat()))
+        today = datetime.date.today()
+
+        parts = []
+        # a stretch of days that can't come from the cache,
+        #  these are loaded in one query
+        pending = None
+
+        day = start_date.date()
+        while day <= end_date.date():
+            day_start = datetime.datetime.combine(day, datetime.time.min)
+            day_end = datetime.datetime.combine(day, datetime.time.max)
+
+            version = marks.get(day.isoformat())
+            if day_start >= start_date and day_end <= end_date and day < today and version != None:
+                if pending != None:
+                    parts.append(DataLoader(self._session, *pending).load(route_id))
+                    pending = None
+                parts.append(self.day(day, version, route_id))
+            else:
+                # only part of this day is wanted, it isn't over
+                #  yet, or we don't know its version
+                if pending == None:
+                    pending = (max(start_date, day_start), min(end_date, day_end))
+                else:
+                    pending = (pending[0], min(end_date, day_end))
+
+            day += datetime.timedelta(days = 1)
+
+        if pending != None:
+            parts.append(DataLoader(self._session, *pending).load(route_id))
+
+        self._session.commit()
+
+        if len(parts) == 0:
+            return Columns()
+
+        waypoints = Columns.concatenate(parts, self._fields)
+
+        # the days are each sorted by route, trip and date,
+        #  put the whole thing in that order
+        order = numpy.lexsort((waypoints.date, waypoints.trip, waypoints.route))
+        return waypoints[order]
+
+    def day(self, day, version, route_id = None):
+        '''A whole day's waypoints (of every route, or just one),
+        from the cache if it's up to date, and from the database
+        (filling the cache) if not.'''
+        name = '%s-%s' % ('_'.join(self._fields[3:]), day.strftime('%Y%m%d'))
+        if route_id != None:
+            name = '%s-%s' % (name, route_id)
+        path = os.path.join(self._directory, name + '.npz')
+
+        waypoints = self.read(path, version)
+        if waypoints == None:
+            self.misses += 1
+
+            start = datetime.datetime.combine(day, datetime.time.min)
+            end = datetime.datetime.combine(day, datetime.time.max)
+            waypoints = DataLoader(self._session, start, end).load(route_id)
+            waypoints = Columns.concatenate([waypoints], self._fields)
+
+            self.write(path, version, waypoints)
+        else:
+            self.hits += 1
+
+        return waypoints
+
+    def read(self, path, version):
+        try:
+            with numpy.load(path) as f:
+                if int(f['version']) != version:
+                    return None
+                waypoints = Columns(**{field: f[field] for field in self._fields})
+        except (IOError, KeyError, ValueError):
+            return None
+
+        # mark it as recently used
+        os.utime(path)
+
+        return waypoints
+
+    def write(self, path, version, waypoints):
+        os.makedirs(self._directory, exist_ok = True)
+
+        # write to a temp file first, so another process
+        #  never sees a half written file
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            numpy.savez_compressed(f, version = version,
+                                   **{field: getattr(waypoints, field) for field in self._fields})
+        os.replace(tmp, path)
+
+        self.evict()
+
+    def evict(self):
+        '''Delete the least recently used files until we're
+        under our size limit.'''
+        files = []
+        for name in os.listdir(self._directory):
+            if name.endswith('.npz'):
+                path = os.path.join(self._directory, name)
+                st = os.stat(path)
+                files.append((st.st_mtime, st.st_size, path))
+
+        total = sum(f[1] for f in files)
+        for mtime, size, path in sorted(files):
+            if total <= self._max_size:
+                break
+            os.remove(path)
+            total -= size
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+#
+
+##################################################
+# DV8 (c) Marcus Dillavou <line72@line72.net
+#  https://github.com/line72/dv8
+##################################################
+
+# MIT License
+#
+# Copyright (c) 2017 Marcus Dillavou <line72@line72.net>
+# https://github.com/line72/dv8
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import gzip
+import datetime
+
+import numpy
+
+from dv8.Archive import microseconds
+
+class SnapshotLog:
+    '''An append only log of the raw responses from each feed, so
+    history can be rebuilt (see dv8.Replayer) if the way we parse or
+    store them ever changes.
+
+    Each feed has a directory, with a file per day (YYYYMMDD.gz) that
+    every response is appended to as its own gzip member, so a day is
+    still a valid .gz file that zcat can read. Next to it is a time
+    index (YYYYMMDD.idx) of (time, offset, length) records, which
+    lets a range of responses be read back without decompressing the
+    whole day. A response is only indexed once it's safely written,
+    so a crash can at worst leave one unindexed member behind.'''
+
+    DIRECTORY = 'snapshots'
+    LEVEL = 6 # gzip compression level, 9 is much slower for little gain
+    # time is in microseconds since the epoch, like dv8.Archive
+    INDEX = numpy.dtype([('time', '<i8'), ('offset', '<i8'), ('length', '<i8')])
+
+    def __init__(self, directory = DIRECTORY):
+        self._directory = directory
+
+    def feeds(self):
+        '''The names of the feeds we have responses from.'''
+        if not os.path.isdir(self._directory):
+            return []
+
+        return sorted(name for name in os.listdir(self._directory)
+                      if os.path.isdir(os.path.join(self._directory, name)))
+
+    def days(self, feed):
+        '''The days we have responses from a feed for, as datetime.dates'''
+        directory = os.path.join(self._directory, feed)
+        if not os.path.isdir(directory):
+            return []
+
+        return sorted(datetime.datetime.strptime(name[:8], '%Y%m%d').date()
+                      for name in os.listdir(directory)
+                      if name.endswith('.idx') and name[:8].isdigit())
+
+    def path(self, feed, day):
+        '''The log file for a feed and day, without its extension.'''
+        return os.path.join(self._directory, feed, day.strftime('%Y%m%d'))
+
+    ## Writing ##
+
+    def append(self, feed, body, now):
+        '''Log the raw `body` (bytes) of a response from `feed`
+        received at `now` (a naive datetime).'''
+        path = self.path(feed, now.date())
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+
+        member = gzip.compress(body, compresslevel = SnapshotLog.LEVEL)
+        with open(path + '.gz', 'ab') as f:
+            offset = f.seek(0, os.SEEK_END)
+            f.write(member)
+
+        record = numpy.array([(microseconds(now), offset, len(member))], dtype = SnapshotLog.INDEX)
+        with open(path + '.idx', 'ab') as f:
+            f.write(record.tobytes())
+
+    ## Reading ##
+
+    def index(self, feed, day):
+        path = self.path(feed, day) + '.idx'
+        # ignore any partially written record at the end
+        size = os.path.getsize(path) // SnapshotLog.INDEX.itemsize
+        return numpy.fromfile(path, dtype = SnapshotLog.INDEX, count = size)
+
+    def entries(self, feed, start = None, end = None):
+        '''Yield (path, index records) for each day of a feed's log,
+        with only the records from `start` up to `end` (naive
+        datetimes, either can be None).'''
+        for day in self.days(feed):
+            if start != None and day < start.date():
+                continue
+            if end != None and day > end.date():
+                continue
+
+            records = self.index(feed, day)
+            if start != None:
+                records = records[records['time'] >= microseconds(start)]
+            if end != None:
+                records = records[records['time'] < microseconds(end)]
+
+            if len(records) > 0:
+                yield self.path(feed, day) + '.gz', records
+
+    @staticmethod
+    def read(f, offset, length):
+        '''The raw body of one response, from an open log file.'''
+        f.seek(offset)
+        return gzip.decompress(f.read(length))
+
+    @staticmethod
+    def time(t):
+        '''An index time as a naive datetime.'''
+        return datetime.datetime(1970, 1, 1) + datetime.timedelta(microseconds = int(t))
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+#
+
+##################################################
+# DV8 (c) Marcus Dillavou <line72@line72.net
+#  https://github.com/line72/dv8
+##################################################
+
+# MIT License
+#
+# Copyright (c) 2017 Marcus Dillavou <line72@line72.net>
+# https://github.com/line72/dv8
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import random
+import hashlib
+import threading
+
+import requests
+
+class Transport:
+    '''Fetches feeds over one pooled, keep-alive HTTP session.
+
+    Responses are gzip/deflate compressed when the server supports
+    it, and every request is conditional: the ETag and Last-Modified
+    of the last response from each url are sent back, so an unchanged
+    feed costs a 304 instead of a full body. Servers that ignore those
+    headers are caught by comparing a hash of the body. Either way,
+    `fetch` returns None when nothing has changed.
+
+    Failures are counted per url, and `backoff` gives a jittered,
+    exponentially growing delay to wait before trying that url again.'''
+
+    TIMEOUT = 10 # in seconds
+    MAX_BACKOFF = 300 # in seconds
+
+    def __init__(self, pool_size = 1, timeout = TIMEOUT):
+        self._timeout = timeout
+
+        self._http = requests.Session()
+        self._http.headers.update({'Accept': 'application/json',
+                                   'Accept-Encoding': 'gzip, deflate'})
+        adapter = requests.adapters.HTTPAdapter(pool_connections = pool_size,
+                                                pool_maxsize = pool_size)
+        self._http.mount('http://', adapter)
+        self._http.mount('https://', adapter)
+
+        self._lock = threading.Lock()
+        # url => (etag, last modified, body hash)
+        self._validators = {}
+        # url => consecutive failures
+        self._failures = {}
+
+    def fetch(self, url, timeout = None):
+        '''Request `url`, returning the raw response, or None if it
+        hasn't changed since the last time.'''
+        with self._lock:
+            etag, modified, digest = self._validators.get(url, (None, None, None))
+
+        headers = {}
+        if etag != None:
+            headers['If-None-Match'] = etag
+        if modified != None:
+            headers['If-Modified-Since'] = modified
+
+        try:
+            r = self._http.get(url, headers = headers,
+                               timeout = timeout if timeout != None else self._timeout)
+            if r.status_code != 304:
+                r.raise_for_status()
+        except Exception:
+            with self._lock:
+                self._failures[url] = self._failures.get(url, 0) + 1
+            raise
+
+        with self._lock:
+            self._failures.pop(url, None)
+
+            if r.status_code == 304:
+                return None
+
+            body = hashlib.sha1(r.content).digest()
+            self._validators[url] = (r.headers.get('ETag'), r.headers.get('Last-Modified'), body)
+
+        if body == digest:
+            return None
+
+        return r
+
+    def failures(self, url):
+        with self._lock:
+            return self._failures.get(url, 0)
+
+    def backoff(self, url, interval):
+        '''How long to wait before polling `url` again after it
+        failed, or None if its last request succeeded. Doubles with
+        every consecutive failure, starting from `interval`, and is
+        jittered so many pollers don't all retry in step.'''
+        failures = self.failures(url)
+        if failures == 0:
+            return None
+
+        delay = min(Transport.MAX_BACKOFF, interval * 2 ** (failures - 1))
+        return random.uniform(delay / 2, delay)
+
+    def close(self):
+        self._http.close()
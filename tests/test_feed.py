@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+#
+
+##################################################
+# DV8 (c) Marcus Dillavou <line72@line72.net
+#  https://github.com/line72/dv8
+##################################################
+
+# MIT License
+#
+# Copyright (c) 2017 Marcus Dillavou <line72@line72.net>
+# https://github.com/line72/dv8
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import time
+import sqlite3
+import asyncio
+import datetime
+
+from dv8.AsyncPoller import AsyncPoller
+from dv8.Feed import Feed
+from dv8.FeedServer import FeedServer
+from dv8.Fleet import Fleet
+
+# a time when the fleet is out on the road
+NOW = datetime.datetime(2017, 7, 20, 12, 0, 0)
+
+class Server:
+    '''A FeedServer that remembers when it was asked for a snapshot.'''
+
+    def __init__(self, delay = 0):
+        self.requests = []
+        self._server = FeedServer(Fleet(routes = 3, vehicles = 2), port = 0, clock = self.clock, delay = delay)
+
+    def clock(self):
+        self.requests.append(time.monotonic())
+        return NOW
+
+    def url(self):
+        return self._server.url()
+
+    def __enter__(self):
+        self._server.start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.stop()
+
+def run_for(poller, seconds):
+    '''Let a poller run for a while, then stop it.'''
+    async def run():
+        try:
+            await asyncio.wait_for(poller.run(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    asyncio.run(run())
+
+def test_fixed_rate(tmp_path):
+    # each response takes a good chunk of the interval, which
+    #  shouldn't push the polls after it back
+    with Server(delay = 0.2) as server:
+        poller = AsyncPoller([Feed('a', server.url())], interval = 0.5, database = str(tmp_path / 'poller.db'))
+        run_for(poller, 1.9)
+
+    assert len(server.requests) == 4
+    gaps = [b - a for a, b in zip(server.requests, server.requests[1:])]
+    for gap in gaps:
+        assert abs(gap - 0.5) < 0.1, gaps
+
+def test_timeout(tmp_path, capsys):
+    with Server(delay = 2) as slow, Server() as fast:
+        poller = AsyncPoller([Feed('slow', slow.url(), prefix = 'slow', timeout = 0.2),
+                              Feed('fast', fast.url(), prefix = 'fast')],
+                             interval = 0.5, database = str(tmp_path / 'poller.db'))
+        run_for(poller, 1.2)
+
+    # the slow feed gave up, and didn't hold up the fast one
+    errors = capsys.readouterr().err
+    assert 'Error: slow' in errors
+    assert 'Error: fast' not in errors
+    assert len(fast.requests) == 3
+
+def test_prefix(tmp_path):
+    path = str(tmp_path / 'poller.db')
+    with Server() as a, Server() as b:
+        poller = AsyncPoller([Feed('a', a.url()), Feed('b', b.url(), prefix = 'b')],
+                             interval = 0.5, database = path)
+        run_for(poller, 0.3)
+
+    conn = sqlite3.connect(path)
+    route_ids = set(r[0] for r in conn.execute('SELECT rId FROM routes'))
+    conn.close()
+
+    # the same routes from each feed, kept apart by the prefix
+    assert route_ids == set(['1', '2', '3', 'b:1', 'b:2', 'b:3'])
+
+def test_rewrite():
+    data = [{'RouteId': 1, 'Vehicles': []}, {'RouteId': 80, 'Vehicles': []}, {'RouteId': 999, 'Vehicles': []}]
+
+    # the ignored routes are the agency's own ids
+    assert Feed('a', 'http://a').rewrite(data) == [{'RouteId': 1, 'Vehicles': []}]
+    assert Feed('b', 'http://b', prefix = 'b').rewrite(data) == [{'RouteId': 'b:1', 'Vehicles': []}]
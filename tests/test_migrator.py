@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+#
+
+##################################################
+# DV8 (c) Marcus Dillavou <line72@line72.net
+#  https://github.com/line72/dv8
+##################################################
+
+# MIT License
+#
+# Copyright (c) 2017 Marcus Dillavou <line72@line72.net>
+# https://github.com/line72/dv8
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import sqlite3
+
+from dv8.Migrator import Migrator
+
+# the schema of a database from before any indexes
+LEGACY_SCHEMA = '''
+CREATE TABLE routes (id INTEGER NOT NULL, rId VARCHAR, name VARCHAR, PRIMARY KEY (id));
+CREATE TABLE trips (id INTEGER NOT NULL, tId VARCHAR, name VARCHAR, runId VARCHAR,
+                    route_id INTEGER, PRIMARY KEY (id), FOREIGN KEY(route_id) REFERENCES routes (id));
+CREATE TABLE waypoints (id INTEGER NOT NULL, date DATETIME, latitude FLOAT, longitude FLOAT,
+                        deviation INTEGER, opStatus VARCHAR, onBoard INTEGER, direction VARCHAR,
+                        driver VARCHAR, trip_id INTEGER, PRIMARY KEY (id),
+                        FOREIGN KEY(trip_id) REFERENCES trips (id));
+'''
+
+ROUTES = 30
+TRIPS = 40 # per route, every 25 minutes
+READINGS = 60 # per trip, a minute apart
+
+def legacy_database(path):
+    '''Create an old style database with a day's worth of
+    waypoints, spread across town like a real fleet's, and one
+    route recorded twice.'''
+    conn = sqlite3.connect(path)
+    conn.executescript(LEGACY_SCHEMA)
+    conn.executemany('INSERT INTO routes (id, rId, name) VALUES (?, ?, ?)',
+                     [(r, str(r), 'Route %d' % r) for r in range(1, ROUTES + 1)] + [(ROUTES + 1, '1', 'Route 1')])
+
+    trips = []
+    waypoints = []
+    for t in range((ROUTES + 1) * TRIPS):
+        route = 1 + t // TRIPS
+        trips.append((t + 1, str(t), 'Trip %d' % t, str(t % 7), route))
+
+        # each route runs out from downtown in its own direction
+        for i in range(READINGS):
+            minute = 5 * 60 + (t % TRIPS) * 25 + i
+            waypoints.append(('2017-07-20 %02d:%02d:00.000000' % (minute // 60, minute % 60),
+                              33.52 + 0.004 * i * (route % 3 - 1), -86.80 + 0.004 * i * (route % 4 - 1.5),
+                              i % 7 - 2, 'ONTIME', i % 30, 'Inbound', 'Driver %d' % (t % 5), t + 1))
+
+    conn.executemany('INSERT INTO trips (id, tId, name, runId, route_id) VALUES (?, ?, ?, ?, ?)', trips)
+    conn.executemany('INSERT INTO waypoints (date, latitude, longitude, deviation, opStatus, onBoard, '
+                     'direction, driver, trip_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', waypoints)
+    conn.commit()
+    conn.close()
+
+def test_migrate_legacy(tmp_path):
+    path = str(tmp_path / 'poller.db')
+    legacy_database(path)
+
+    migrator = Migrator(path)
+    migrator.go()
+
+    results = migrator.explain()
+    assert len(results) == len(Migrator.QUERIES) + 1
+    for name, plan, index, uses in results:
+        assert uses, '%s should use %s, but the plan was: %s' % (name, index, plan)
+        assert index in plan
+
+    conn = sqlite3.connect(path)
+    # the duplicate route was merged, and no waypoints were lost
+    assert conn.execute("SELECT COUNT(*) FROM routes WHERE rId = '1'").fetchone()[0] == 1
+    assert conn.execute('SELECT COUNT(*) FROM waypoints').fetchone()[0] == (ROUTES + 1) * TRIPS * READINGS
+    conn.close()
+
+def test_migrate_twice(tmp_path):
+    path = str(tmp_path / 'poller.db')
+    legacy_database(path)
+
+    Migrator(path).go()
+    migrator = Migrator(path)
+    migrator.go()
+
+    for name, plan, index, uses in migrator.explain():
+        assert uses, '%s should use %s, but the plan was: %s' % (name, index, plan)